@@ -2,15 +2,20 @@
 Админ-панель для управления ботом
 """
 
+import asyncio
 import logging
+import shutil
+import tempfile
 from html import escape
 from datetime import datetime
-from typing import Dict, List
+from pathlib import Path
+from typing import Dict, List, Optional
 
 from aiogram import Bot, F, Router
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import BaseStorage
 from aiogram.types import (
     CallbackQuery,
     InlineKeyboardButton,
@@ -18,20 +23,38 @@ from aiogram.types import (
     Message,
 )
 
+from analytics import MATCH_END, MATCH_START
+from backup import backup_database, restore_backup
+from broadcast import BroadcastJob, launch_broadcast
 from config import ADMIN_IDS, CHANNEL_ID, SUBSCRIPTION_DAYS
-from database import (
+from database import from_epoch
+from export import cleanup_export
+from fsm_storage import PersistentFSMStorage
+from keyboards import renewal_offer_keyboard
+from messages import format_message
+from payments import PaymentFactory
+from records import CancellationRecord, SubscriptionRecord, UserRecord
+from rollups import render_report
+from storage import (
     cancel_subscription,
+    churn_themes,
+    count_user_cancellations,
+    count_users,
+    create_broadcast_job,
     create_subscription,
-    get_all_users,
-    get_db,
+    export_users_csv,
+    find_users_by_usernames,
+    get_storage,
     get_subscription,
+    get_user,
     get_user_stats,
     is_subscription_active,
+    recent_cancellations,
+    search_cancellations,
+    search_users,
+    stats_report,
+    users_page,
 )
-from keyboards import renewal_offer_keyboard
-from messages import format_message
-from payments import PaymentFactory
-from subscription_tasks import backup_database
 
 logger = logging.getLogger(__name__)
 admin_router = Router()
@@ -45,25 +68,44 @@ class AdminStates(StatesGroup):
     waiting_for_manual_sub_user = State()
     waiting_for_manual_sub_days = State()
     waiting_for_legacy_usernames = State()
+    waiting_for_cancellation_search = State()
 
 
 # ==================== PAGINATION ====================
 
 
-class UsersPaginator:
-    """Пагинация для списка пользователей"""
+def _encode_users_cursor(user: Dict) -> str:
+    """Ключ (join_date, user_id) строки для callback_data (лимит Telegram - 64 байта)."""
+    return f"{user.get('join_date') or 0}_{user['user_id']}"
+
 
-    def __init__(self, users: List[Dict], page: int = 0, per_page: int = 10):
+def _decode_users_cursor(raw: str) -> tuple:
+    join_date, user_id = raw.split("_")
+    return int(join_date), int(user_id)
+
+
+class UsersPaginator:
+    """Пагинация для списка пользователей (keyset-курсоры вместо смещений)"""
+
+    def __init__(
+        self,
+        users: List[Dict],
+        page: int = 0,
+        total: int = 0,
+        per_page: int = 10,
+        has_prev: bool = False,
+        has_next: bool = False,
+    ):
         self.users = users
         self.page = page
         self.per_page = per_page
-        self.total_pages = (len(users) + per_page - 1) // per_page
+        self.total_pages = max((total + per_page - 1) // per_page, 1)
+        self.has_prev = has_prev
+        self.has_next = has_next
 
     def get_page_users(self) -> List[Dict]:
         """Получить пользователей текущей страницы"""
-        start = self.page * self.per_page
-        end = start + self.per_page
-        return self.users[start:end]
+        return self.users
 
     def get_keyboard(self) -> InlineKeyboardMarkup:
         """Создать клавиатуру со списком пользователей"""
@@ -94,10 +136,11 @@ class UsersPaginator:
         # Навигация
         nav_buttons = []
 
-        if self.page > 0:
+        if self.has_prev and self.users:
             nav_buttons.append(
                 InlineKeyboardButton(
-                    text="⬅️ Назад", callback_data=f"users_page_{self.page - 1}"
+                    text="⬅️ Назад",
+                    callback_data=f"users_prev_{self.page - 1}_{_encode_users_cursor(self.users[0])}",
                 )
             )
 
@@ -108,10 +151,11 @@ class UsersPaginator:
             )
         )
 
-        if self.page < self.total_pages - 1:
+        if self.has_next and self.users:
             nav_buttons.append(
                 InlineKeyboardButton(
-                    text="Вперед ➡️", callback_data=f"users_page_{self.page + 1}"
+                    text="Вперед ➡️",
+                    callback_data=f"users_next_{self.page + 1}_{_encode_users_cursor(self.users[-1])}",
                 )
             )
 
@@ -210,12 +254,14 @@ def user_profile_keyboard(user_id: int) -> InlineKeyboardMarkup:
     )
 
 
-def _format_join_date(value) -> str:
-    """Формат даты регистрации для админки."""
+def _format_date(value) -> str:
+    """Формат даты из БД (секунды Unix) для админки."""
     if not value:
         return "Неизвестно"
     if isinstance(value, datetime):
         return value.strftime("%d.%m.%Y %H:%M")
+    if isinstance(value, int):
+        return from_epoch(value).strftime("%d.%m.%Y %H:%M")
     try:
         parsed = datetime.fromisoformat(str(value))
         return parsed.strftime("%d.%m.%Y %H:%M")
@@ -223,14 +269,14 @@ def _format_join_date(value) -> str:
         return str(value)
 
 
-def _format_subscription_info(sub: Dict) -> str:
+def _format_subscription_info(sub: Optional[SubscriptionRecord]) -> str:
     """Единый формат блока подписки."""
     if not sub:
         return "Статус: нет подписки"
 
-    status = sub.get("status")
-    expires_at = sub.get("expires_at")
-    provider = sub.get("payment_provider", "не указан")
+    status = sub.status
+    expires_at = sub.expires_at
+    provider = sub.payment_provider or "не указан"
 
     if status == "active":
         if not expires_at:
@@ -262,26 +308,22 @@ def _format_subscription_info(sub: Dict) -> str:
 
 
 def _build_profile_text(
-    user_id: int,
-    first_name: str,
-    username: str,
-    join_date,
-    has_payment: bool,
+    user: UserRecord,
     cancellations_count: int,
-    sub: Dict,
+    sub: Optional[SubscriptionRecord],
 ) -> str:
     """Единый рендер профиля пользователя для админки."""
-    first_name_text = escape(first_name or "не указано")
-    username_text = f"@{escape(username)}" if username else "не указан"
-    payment_attempts = "Да" if has_payment else "Нет"
+    first_name_text = escape(user.first_name or "не указано")
+    username_text = f"@{escape(user.username)}" if user.username else "не указан"
+    payment_attempts = "Да" if user.has_payment_attempt else "Нет"
     subscription_info = escape(_format_subscription_info(sub))
 
     return (
         "<b>ПРОФИЛЬ ПОЛЬЗОВАТЕЛЯ</b>\n\n"
-        f"<b>ID:</b> <code>{user_id}</code>\n"
+        f"<b>ID:</b> <code>{user.user_id}</code>\n"
         f"<b>Имя:</b> {first_name_text}\n"
         f"<b>Username:</b> {username_text}\n"
-        f"<b>Регистрация:</b> {_format_join_date(join_date)}\n"
+        f"<b>Регистрация:</b> {_format_date(user.join_epoch)}\n"
         f"<b>Попытки оплаты:</b> {payment_attempts}\n"
         f"<b>Отмен подписок:</b> {cancellations_count}\n\n"
         f"<b>Подписка:</b>\n{subscription_info}"
@@ -378,48 +420,34 @@ async def show_users_list(callback: CallbackQuery):
     await show_users_page(callback, page=0)
 
 
-@admin_router.callback_query(F.data.startswith("users_page_"))
+@admin_router.callback_query(F.data == "users_page_current")
+async def current_users_page(callback: CallbackQuery):
+    await callback.answer()
+
+
+@admin_router.callback_query(F.data.startswith("users_next_") | F.data.startswith("users_prev_"))
 async def navigate_users_page(callback: CallbackQuery):
     """Навигация по страницам пользователей"""
     if callback.from_user.id not in ADMIN_IDS:
         return
 
-    page_data = callback.data.split("_")[-1]
-
-    if page_data == "current":
-        await callback.answer()
-        return
-
-    page = int(page_data)
-    await show_users_page(callback, page)
+    # users_{next|prev}_{page}_{join_date}_{user_id}
+    _, direction, page, raw_cursor = callback.data.split("_", 3)
+    await show_users_page(
+        callback,
+        page=int(page),
+        cursor=_decode_users_cursor(raw_cursor),
+        backwards=direction == "prev",
+    )
 
 
-async def show_users_page(callback: CallbackQuery, page: int):
+async def show_users_page(
+    callback: CallbackQuery, page: int, cursor: tuple = None, backwards: bool = False
+):
     """Отобразить страницу со списком пользователей"""
+    per_page = 10
     try:
-        # Получаем пользователей с дополнительной информацией
-        async with get_db() as db:
-            async with db.execute(
-                """
-                SELECT u.user_id, u.username, u.first_name, u.join_date,
-                       s.status, s.expires_at
-                FROM users u
-                LEFT JOIN subscriptions s ON u.user_id = s.user_id
-                ORDER BY u.join_date DESC
-                """
-            ) as cursor:
-                rows = await cursor.fetchall()
-                users = [
-                    {
-                        "user_id": row[0],
-                        "username": row[1],
-                        "first_name": row[2],
-                        "join_date": row[3],
-                        "sub_status": row[4],
-                        "expires_at": row[5],
-                    }
-                    for row in rows
-                ]
+        users, has_more, total = await users_page(cursor, backwards=backwards, limit=per_page)
 
         if not users:
             await callback.message.edit_text(
@@ -428,12 +456,24 @@ async def show_users_page(callback: CallbackQuery, page: int):
             await callback.answer()
             return
 
-        paginator = UsersPaginator(users, page=page, per_page=10)
+        if backwards:
+            has_prev, has_next = has_more, True
+        else:
+            has_prev, has_next = cursor is not None, has_more
+
+        paginator = UsersPaginator(
+            users,
+            page=page,
+            total=total,
+            per_page=per_page,
+            has_prev=has_prev,
+            has_next=has_next,
+        )
 
         # Формируем текст с информацией
         text = (
             f"👥 <b>СПИСОК ПОЛЬЗОВАТЕЛЕЙ</b>\n\n"
-            f"📊 Всего: {len(users)}\n"
+            f"📊 Всего: {total}\n"
             f"📄 Страница {page + 1} из {paginator.total_pages}\n\n"
             f"Выберите пользователя:"
         )
@@ -460,48 +500,23 @@ async def show_user_profile(callback: CallbackQuery):
     user_id = int(callback.data.split("_")[-1])
 
     try:
-        async with get_db() as db:
-            # Получаем информацию о пользователе
-            async with db.execute(
-                "SELECT user_id, username, first_name, join_date, has_payment_attempt FROM users WHERE user_id = ?",
-                (user_id,),
-            ) as cursor:
-                user = await cursor.fetchone()
-
-            if not user:
-                await callback.answer("❌ Пользователь не найден", show_alert=True)
-                return
-
-            username = user[1] or ""
-            first_name = user[2] or ""
-            join_date = user[3]
-            has_payment = user[4]
-
-            # Проверка подписки
-            sub = await get_subscription(user_id)
-
-            # Количество отмен подписок
-            async with db.execute(
-                "SELECT COUNT(*) FROM cancellations WHERE user_id = ?", (user_id,)
-            ) as cursor:
-                cancellations_count = (await cursor.fetchone())[0]
-
-            profile_text = _build_profile_text(
-                user_id=user_id,
-                first_name=first_name,
-                username=username,
-                join_date=join_date,
-                has_payment=has_payment,
-                cancellations_count=cancellations_count,
-                sub=sub,
-            )
+        user = await get_user(user_id)
+        if not user:
+            await callback.answer("❌ Пользователь не найден", show_alert=True)
+            return
 
-            await callback.message.edit_text(
-                profile_text,
-                reply_markup=user_profile_keyboard(user_id),
-                parse_mode="HTML",
-            )
-            await callback.answer()
+        profile_text = _build_profile_text(
+            user,
+            cancellations_count=await count_user_cancellations(user_id),
+            sub=await get_subscription(user_id),
+        )
+
+        await callback.message.edit_text(
+            profile_text,
+            reply_markup=user_profile_keyboard(user_id),
+            parse_mode="HTML",
+        )
+        await callback.answer()
 
     except Exception as e:
         logger.error(f"Error showing user profile: {e}", exc_info=True)
@@ -526,12 +541,12 @@ async def show_subscription_details(callback: CallbackQuery):
         details = (
             f"💎 <b>ДЕТАЛИ ПОДПИСКИ</b>\n\n"
             f"👤 User ID: <code>{user_id}</code>\n\n"
-            f"📊 <b>Статус:</b> {escape(str(sub['status']))}\n"
-            f"💳 <b>Провайдер:</b> {escape(str(sub['payment_provider']))}\n"
-            f"🔗 <b>Invite Link:</b> {escape(str(sub.get('invite_link', 'Нет')))}\n"
-            f"📅 <b>Истекает:</b> {sub['expires_at'].strftime('%d.%m.%Y %H:%M')}\n"
-            f"🆔 <b>Payment Sub ID:</b> {escape(str(sub.get('stripe_subscription_id', 'N/A')))}\n"
-            f"👤 <b>Customer ID:</b> {escape(str(sub.get('stripe_customer_id', 'N/A')))}"
+            f"📊 <b>Статус:</b> {escape(str(sub.status))}\n"
+            f"💳 <b>Провайдер:</b> {escape(str(sub.payment_provider))}\n"
+            f"🔗 <b>Invite Link:</b> {escape(str(sub.invite_link or 'Нет'))}\n"
+            f"📅 <b>Истекает:</b> {sub.expires_at.strftime('%d.%m.%Y %H:%M')}\n"
+            f"🆔 <b>Payment Sub ID:</b> {escape(str(sub.stripe_subscription_id or 'N/A'))}\n"
+            f"👤 <b>Customer ID:</b> {escape(str(sub.stripe_customer_id or 'N/A'))}"
         )
 
         await callback.message.edit_text(
@@ -574,56 +589,50 @@ async def show_detailed_stats(callback: CallbackQuery):
         return
 
     try:
-        async with get_db() as db:
-            # Общие данные
-            async with db.execute("SELECT COUNT(*) FROM users") as cursor:
-                total_users = (await cursor.fetchone())[0]
-
-            async with db.execute(
-                "SELECT COUNT(*) FROM subscriptions WHERE status = 'active' AND expires_at > ?",
-                (datetime.now().isoformat(),),
-            ) as cursor:
-                active_subs = (await cursor.fetchone())[0]
-
-            async with db.execute(
-                "SELECT COUNT(*) FROM subscriptions WHERE status = 'cancelled'"
-            ) as cursor:
-                cancelled_subs = (await cursor.fetchone())[0]
-
-            # Статистика по дням
-            async with db.execute(
-                "SELECT COUNT(*) FROM users WHERE DATE(join_date) = DATE('now')"
-            ) as cursor:
-                today_users = (await cursor.fetchone())[0]
-
-            async with db.execute(
-                "SELECT COUNT(*) FROM subscriptions WHERE DATE(created_at) = DATE('now')"
-            ) as cursor:
-                today_subs = (await cursor.fetchone())[0]
-
-            # Доход
-            from config import SUBSCRIPTION_PRICE
-
-            revenue = active_subs * SUBSCRIPTION_PRICE
-
-            stats_text = (
-                f"📊 <b>ДЕТАЛЬНАЯ СТАТИСТИКА</b>\n\n"
-                f"👥 <b>Пользователи:</b>\n"
-                f"├ Всего: {total_users}\n"
-                f"└ Новых сегодня: {today_users}\n\n"
-                f"💎 <b>Подписки:</b>\n"
-                f"├ Активных: {active_subs}\n"
-                f"├ Отмененных: {cancelled_subs}\n"
-                f"└ Оформлено сегодня: {today_subs}\n\n"
-                f"💰 <b>Приблизительный доход:</b>\n"
-                f"└ ${revenue:.2f} (активные подписки)\n\n"
-                f"📅 Обновлено: {datetime.now().strftime('%d.%m.%Y %H:%M')}"
-            )
+        # Счетчики поддерживаются триггерами, "сегодня" - диапазон по индексу;
+        # все читается из одного снимка в пуле аналитики
+        today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        report = await stats_report(today)
+        counters = report["counters"]
+        total_users = counters.get("users_total", 0)
+        active_subs = counters.get("subscriptions_active", 0)
+        cancelled_subs = counters.get("subscriptions_cancelled", 0)
+
+        today_users = report["recent"]["users"]
+        today_subs = report["recent"]["subscriptions"]
+        trend = "\n".join(render_report(report["series"]))
+
+        # Доход
+        from config import SUBSCRIPTION_PRICE
+
+        revenue = active_subs * SUBSCRIPTION_PRICE
+        cache = get_storage().stats()["cache"]
+
+        stats_text = (
+            f"📊 <b>ДЕТАЛЬНАЯ СТАТИСТИКА</b>\n\n"
+            f"👥 <b>Пользователи:</b>\n"
+            f"├ Всего: {total_users}\n"
+            f"└ Новых сегодня: {today_users}\n\n"
+            f"💎 <b>Подписки:</b>\n"
+            f"├ Активных: {active_subs}\n"
+            f"├ Отмененных: {cancelled_subs}\n"
+            f"└ Оформлено сегодня: {today_subs}\n\n"
+            f"💰 <b>Приблизительный доход:</b>\n"
+            f"└ ${revenue:.2f} (активные подписки)\n\n"
+            f"📈 <b>Динамика за 30 / 90 / 365 дней:</b>\n"
+            f"<pre>{escape(trend)}</pre>\n\n"
+            f"⚙️ <b>Кэш подписок:</b>\n"
+            f"├ Попаданий: {cache['hits']}\n"
+            f"├ Промахов: {cache['misses']}\n"
+            f"├ Вытеснений: {cache['evictions']}\n"
+            f"└ Записей: {cache['size']}\n\n"
+            f"📅 Обновлено: {datetime.now().strftime('%d.%m.%Y %H:%M')}"
+        )
 
-            await callback.message.edit_text(
-                stats_text, reply_markup=back_to_admin_keyboard(), parse_mode="HTML"
-            )
-            await callback.answer()
+        await callback.message.edit_text(
+            stats_text, reply_markup=back_to_admin_keyboard(), parse_mode="HTML"
+        )
+        await callback.answer()
 
     except Exception as e:
         logger.error(f"Error getting stats: {e}", exc_info=True)
@@ -677,10 +686,10 @@ async def confirm_broadcast(message: Message, state: FSMContext, bot: Bot):
     # Массовая рассылка
     await state.update_data(broadcast_text=message.text)
 
-    users = await get_all_users()
+    total = await count_users()
     await message.answer(
         f"📢 <b>ПОДТВЕРЖДЕНИЕ РАССЫЛКИ</b>\n\n"
-        f"Получателей: {len(users)}\n\n"
+        f"Получателей: {total}\n\n"
         f"<b>Текст сообщения:</b>\n{escape(message.text)}\n\n"
         f"Отправить?",
         reply_markup=confirm_broadcast_keyboard(),
@@ -701,37 +710,28 @@ async def execute_broadcast(callback: CallbackQuery, state: FSMContext, bot: Bot
         await callback.answer("❌ Текст не найден", show_alert=True)
         return
 
-    users = await get_all_users()
-    success = 0
-    failed = 0
+    total = await count_users()
 
-    await callback.message.edit_text(
-        f"📤 Отправка сообщения {len(users)} пользователям...\n\nПожалуйста, подождите."
+    status = await callback.message.edit_text(
+        f"📤 Рассылка запущена: {total} получателей.\n\n"
+        "Прогресс будет обновляться в этом сообщении."
     )
 
-    for user in users:
-        try:
-            await bot.send_message(user["user_id"], broadcast_text)
-            success += 1
-            import asyncio
-
-            await asyncio.sleep(0.05)
-        except Exception as e:
-            failed += 1
-            logger.warning(f"Failed to send to {user['user_id']}: {e}")
-
-    await callback.message.edit_text(
-        f"✅ <b>РАССЫЛКА ЗАВЕРШЕНА</b>\n\n"
-        f"✅ Отправлено: {success}\n"
-        f"❌ Ошибок: {failed}\n"
-        f"📊 Всего: {len(users)}",
-        reply_markup=back_to_admin_keyboard(),
-        parse_mode="HTML",
+    job_id = await create_broadcast_job(
+        broadcast_text, status.chat.id, status.message_id, total
     )
+    job = {
+        "id": job_id,
+        "text": broadcast_text,
+        "status_chat_id": status.chat.id,
+        "status_message_id": status.message_id,
+        "total": total,
+    }
+    launch_broadcast(BroadcastJob(bot, job, done_markup=back_to_admin_keyboard()))
 
     await state.clear()
-    await callback.answer("✅ Готово!")
-    logger.info(f"Broadcast completed: {success} sent, {failed} failed")
+    await callback.answer("📤 Рассылка запущена")
+    logger.info(f"Admin {callback.from_user.id} started broadcast {job_id} to {total} users")
 
 
 # ==================== LEGACY-УВЕДОМЛЕНИЯ ====================
@@ -767,16 +767,7 @@ async def process_legacy_notify(message: Message, state: FSMContext, bot: Bot):
         )
         return
 
-    placeholders = ",".join(["?"] * len(usernames))
-
-    async with get_db() as db:
-        async with db.execute(
-            f"SELECT user_id, username FROM users WHERE lower(username) IN ({placeholders})",
-            usernames,
-        ) as cursor:
-            rows = await cursor.fetchall()
-
-    found = {str(row[1]).lower(): row[0] for row in rows if row[1]}
+    found = await find_users_by_usernames(usernames)
     missed = [u for u in usernames if u not in found]
 
     payment_url = await PaymentFactory.create_payment(message.from_user.id)
@@ -835,7 +826,8 @@ async def start_user_search(callback: CallbackQuery, state: FSMContext):
         "🔍 <b>ПОИСК ПОЛЬЗОВАТЕЛЯ</b>\n\n"
         "Отправьте:\n"
         "• User ID (например: 123456789)\n"
-        "• Username (например: @username)",
+        "• Начало username (например: @user)\n"
+        "• Часть имени или username (от 3 символов)",
         reply_markup=back_to_admin_keyboard(),
         parse_mode="HTML",
     )
@@ -843,52 +835,77 @@ async def start_user_search(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
+SEARCH_PAGE_SIZE = 10
+
+
+def _search_results_keyboard(
+    users: List[UserRecord], page: int, has_more: bool
+) -> InlineKeyboardMarkup:
+    keyboard = []
+    for user in users:
+        display_name = f"@{user.username}" if user.username else (user.first_name or "Неизвестно")
+        keyboard.append(
+            [
+                InlineKeyboardButton(
+                    text=f"👤 {display_name} (ID: {user.user_id})"[:64],
+                    callback_data=f"user_profile_{user.user_id}",
+                )
+            ]
+        )
+
+    nav_buttons = []
+    if page > 0:
+        nav_buttons.append(InlineKeyboardButton(text="⏮ В начало", callback_data="usearch_0_0"))
+    if has_more:
+        nav_buttons.append(
+            InlineKeyboardButton(
+                text="Вперед ➡️", callback_data=f"usearch_{page + 1}_{users[-1].user_id}"
+            )
+        )
+    if nav_buttons:
+        keyboard.append(nav_buttons)
+    keyboard.append(
+        [InlineKeyboardButton(text="🔙 Назад в админку", callback_data="admin_panel")]
+    )
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+
+def _search_results_text(query: str, page: int) -> str:
+    return (
+        f"🔍 <b>РЕЗУЛЬТАТЫ ПОИСКА</b>\n\n"
+        f"Запрос: <code>{escape(query)}</code>\n"
+        f"📄 Страница {page + 1}\n\n"
+        f"Отправьте новый запрос, чтобы искать снова."
+    )
+
+
 @admin_router.message(AdminStates.waiting_for_user_search)
 async def process_user_search(message: Message, state: FSMContext):
-    """Обработка поиска"""
-    query = message.text.strip().lstrip("@")
+    """Обработка поиска: один результат - сразу профиль, несколько - список по страницам"""
+    query = (message.text or "").strip()
 
     try:
-        async with get_db() as db:
-            if query.isdigit():
-                async with db.execute(
-                    "SELECT user_id FROM users WHERE user_id = ?", (int(query),)
-                ) as cursor:
-                    user = await cursor.fetchone()
-            else:
-                async with db.execute(
-                    "SELECT user_id FROM users WHERE username = ?", (query,)
-                ) as cursor:
-                    user = await cursor.fetchone()
-
-            if not user:
-                await message.answer(
-                    "❌ Пользователь не найден", reply_markup=back_to_admin_keyboard()
-                )
-                await state.clear()
-                return
+        users, has_more = await search_users(query, limit=SEARCH_PAGE_SIZE)
 
-            user_id = user[0]
-
-            # Показываем профиль найденного пользователя
+        if not users:
+            await message.answer(
+                "❌ Пользователь не найден", reply_markup=back_to_admin_keyboard()
+            )
             await state.clear()
+            return
 
-            # Создаем фейковый callback для переиспользования функции
-            from aiogram.types import CallbackQuery as CQ
-
-            fake_callback = type(
-                "obj",
-                (object,),
-                {
-                    "message": message,
-                    "from_user": message.from_user,
-                    "data": f"user_profile_{user_id}",
-                    "answer": lambda text="", show_alert=False: None,
-                },
-            )()
+        if len(users) == 1 and not has_more:
+            await state.clear()
+            await show_user_profile_from_search(message, users[0].user_id)
+            return
 
-            # Используем существующую функцию показа профиля
-            await show_user_profile_from_search(message, user_id)
+        # Состояние поиска сохраняется: запрос нужен для следующих страниц
+        await state.update_data(search_query=query)
+        await message.answer(
+            _search_results_text(query, 0),
+            reply_markup=_search_results_keyboard(users, 0, has_more),
+            parse_mode="HTML",
+        )
 
     except Exception as e:
         logger.error(f"Search error: {e}", exc_info=True)
@@ -896,47 +913,56 @@ async def process_user_search(message: Message, state: FSMContext):
         await state.clear()
 
 
+@admin_router.callback_query(F.data.startswith("usearch_"))
+async def navigate_user_search(callback: CallbackQuery, state: FSMContext):
+    """Страницы результатов поиска (keyset по user_id)"""
+    if callback.from_user.id not in ADMIN_IDS:
+        return
+
+    # usearch_{page}_{after_user_id}
+    _, page, after_user_id = callback.data.split("_")
+    query = (await state.get_data()).get("search_query")
+    if not query:
+        await callback.answer("⌛ Поиск устарел, начните заново", show_alert=True)
+        return
+
+    try:
+        users, has_more = await search_users(
+            query, after_user_id=int(after_user_id), limit=SEARCH_PAGE_SIZE
+        )
+        if not users:
+            await callback.answer("Больше результатов нет")
+            return
+        await callback.message.edit_text(
+            _search_results_text(query, int(page)),
+            reply_markup=_search_results_keyboard(users, int(page), has_more),
+            parse_mode="HTML",
+        )
+        await callback.answer()
+    except Exception as e:
+        logger.error(f"Search paging error: {e}", exc_info=True)
+        await callback.answer("❌ Ошибка поиска", show_alert=True)
+
+
 async def show_user_profile_from_search(message: Message, user_id: int):
     """Показать профиль после поиска"""
     try:
-        async with get_db() as db:
-            async with db.execute(
-                "SELECT user_id, username, first_name, join_date, has_payment_attempt FROM users WHERE user_id = ?",
-                (user_id,),
-            ) as cursor:
-                user = await cursor.fetchone()
-
-            if not user:
-                await message.answer("❌ Пользователь не найден")
-                return
-
-            username = user[1] or ""
-            first_name = user[2] or ""
-            join_date = user[3]
-            has_payment = user[4]
-
-            sub = await get_subscription(user_id)
-
-            async with db.execute(
-                "SELECT COUNT(*) FROM cancellations WHERE user_id = ?", (user_id,)
-            ) as cursor:
-                cancellations_count = (await cursor.fetchone())[0]
-
-            profile_text = _build_profile_text(
-                user_id=user_id,
-                first_name=first_name,
-                username=username,
-                join_date=join_date,
-                has_payment=has_payment,
-                cancellations_count=cancellations_count,
-                sub=sub,
-            )
+        user = await get_user(user_id)
+        if not user:
+            await message.answer("❌ Пользователь не найден")
+            return
 
-            await message.answer(
-                profile_text,
-                reply_markup=user_profile_keyboard(user_id),
-                parse_mode="HTML",
-            )
+        profile_text = _build_profile_text(
+            user,
+            cancellations_count=await count_user_cancellations(user_id),
+            sub=await get_subscription(user_id),
+        )
+
+        await message.answer(
+            profile_text,
+            reply_markup=user_profile_keyboard(user_id),
+            parse_mode="HTML",
+        )
 
     except Exception as e:
         logger.error(f"Error: {e}", exc_info=True)
@@ -1111,18 +1137,43 @@ async def revoke_subscription(callback: CallbackQuery):
 # ==================== ПРИЧИНЫ ОТМЕН ====================
 
 
+CHURN_THEME_WINDOWS = (7, 30, 90)
+CANCELLATION_SEARCH_PAGE_SIZE = 8
+
+
+def _cancellations_keyboard() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(text="🔍 Поиск по причинам", callback_data="admin_cancel_search")],
+            [
+                InlineKeyboardButton(text=f"🏷 Темы за {days} дн.", callback_data=f"cthemes_{days}")
+                for days in CHURN_THEME_WINDOWS
+            ],
+            [InlineKeyboardButton(text="🔙 Назад в админку", callback_data="admin_panel")],
+        ]
+    )
+
+
+def _format_themes(report: Dict) -> str:
+    if not report["themes"]:
+        text = "Тем пока нет"
+    else:
+        text = "\n".join(
+            f"{i}. {escape(term)} — {count}" for i, (term, count) in enumerate(report["themes"], 1)
+        )
+    if report["pending"]:
+        text += f"\n⏳ Еще не обработано причин: {report['pending']}"
+    return text
+
+
 @admin_router.callback_query(F.data == "admin_cancellations")
 async def show_cancellations(callback: CallbackQuery):
-    """Показать причины отмен"""
+    """Показать причины отмен и главные темы за 30 дней"""
     if callback.from_user.id not in ADMIN_IDS:
         return
 
     try:
-        async with get_db() as db:
-            async with db.execute(
-                "SELECT username, reason, cancelled_at FROM cancellations ORDER BY cancelled_at DESC LIMIT 20"
-            ) as cursor:
-                cancellations = await cursor.fetchall()
+        cancellations = await recent_cancellations(20)
 
         if not cancellations:
             await callback.message.edit_text(
@@ -1136,11 +1187,14 @@ async def show_cancellations(callback: CallbackQuery):
             username = escape(row[0] or "Неизвестно")
             reason = row[1][:50] + "..." if len(row[1]) > 50 else row[1]
             reason = escape(reason)
-            date = row[2]
+            date = _format_date(row[2])
             text += f"{i}. @{username}\n💬 {reason}\n📅 {date}\n\n"
 
+        themes = await churn_themes(30, limit=5)
+        text += f"🏷 <b>Темы за 30 дней:</b>\n{_format_themes(themes)}"
+
         await callback.message.edit_text(
-            text, reply_markup=back_to_admin_keyboard(), parse_mode="HTML"
+            text, reply_markup=_cancellations_keyboard(), parse_mode="HTML"
         )
         await callback.answer()
 
@@ -1149,77 +1203,180 @@ async def show_cancellations(callback: CallbackQuery):
         await callback.answer("❌ Ошибка", show_alert=True)
 
 
-# ==================== ЭКСПОРТ ====================
+@admin_router.callback_query(F.data.startswith("cthemes_"))
+async def show_churn_themes(callback: CallbackQuery):
+    """Топ терминов причин отмен за окно дат (из предрасчитанных частот)"""
+    if callback.from_user.id not in ADMIN_IDS:
+        return
+
+    days = int(callback.data.split("_")[1])
+    try:
+        themes = await churn_themes(days, limit=20)
+        await callback.message.edit_text(
+            f"🏷 <b>ТЕМЫ ОТМЕН ЗА {days} ДН.</b>\n"
+            f"<i>Сколько причин упоминают слово</i>\n\n"
+            f"{_format_themes(themes)}",
+            reply_markup=_cancellations_keyboard(),
+            parse_mode="HTML",
+        )
+        await callback.answer()
+    except Exception as e:
+        logger.error(f"Error getting churn themes: {e}", exc_info=True)
+        await callback.answer("❌ Ошибка", show_alert=True)
 
 
-@admin_router.callback_query(F.data == "admin_export")
-async def export_data(callback: CallbackQuery):
-    """Экспорт всех пользователей с данными подписок в CSV"""
+@admin_router.callback_query(F.data == "admin_cancel_search")
+async def start_cancellation_search(callback: CallbackQuery, state: FSMContext):
+    """Поиск по текстам причин отмен"""
     if callback.from_user.id not in ADMIN_IDS:
         return
 
-    try:
-        from aiogram.types import BufferedInputFile
-
-        async with get_db() as db:
-            async with db.execute("""
-                SELECT
-                    u.user_id,
-                    u.username,
-                    u.first_name,
-                    u.join_date,
-                    u.has_payment_attempt,
-                    COALESCE(s.status, 'none') AS sub_status,
-                    s.expires_at,
-                    s.payment_provider
-                FROM users u
-                LEFT JOIN subscriptions s ON u.user_id = s.user_id
-                ORDER BY u.join_date DESC
-            """) as cursor:
-                rows = await cursor.fetchall()
-
-        lines = ["user_id,username,first_name,join_date,has_payment_attempt,subscription_status,expires_at,payment_provider"]
-        for row in rows:
-            user_id, username, first_name, join_date, has_attempt, sub_status, expires_at, provider = row
-            lines.append(
-                f"{user_id},"
-                f"{_csv_escape(username)},"
-                f"{_csv_escape(first_name)},"
-                f"{join_date or ''},"
-                f"{'yes' if has_attempt else 'no'},"
-                f"{sub_status},"
-                f"{expires_at or ''},"
-                f"{provider or ''}"
+    await callback.message.edit_text(
+        "🔍 <b>ПОИСК ПО ПРИЧИНАМ ОТМЕН</b>\n\n"
+        "Отправьте слова или их начало (например: <code>дорог цена</code>).\n"
+        "Найдутся причины, где есть все слова.",
+        reply_markup=back_to_admin_keyboard(),
+        parse_mode="HTML",
+    )
+    await state.set_state(AdminStates.waiting_for_cancellation_search)
+    await callback.answer()
+
+
+def _format_snippet(snippet: str) -> str:
+    return escape(snippet).replace(MATCH_START, "<b>").replace(MATCH_END, "</b>")
+
+
+def _cancellation_results_text(
+    query: str, page: int, records: List[CancellationRecord], snippets: List[str]
+) -> str:
+    text = (
+        f"🔍 <b>ПРИЧИНЫ ОТМЕН</b>: <code>{escape(query)}</code>\n"
+        f"📄 Страница {page + 1}\n\n"
+    )
+    for record, snippet in zip(records, snippets):
+        username = escape(record.username or "Неизвестно")
+        text += (
+            f"@{username} (ID: {record.user_id}) · {_format_date(record.cancelled_at)}\n"
+            f"💬 {_format_snippet(snippet)}\n\n"
+        )
+    return text + "Отправьте новый запрос, чтобы искать снова."
+
+
+def _cancellation_results_keyboard(
+    records: List[CancellationRecord], page: int, has_more: bool
+) -> InlineKeyboardMarkup:
+    nav_buttons = []
+    if page > 0:
+        nav_buttons.append(InlineKeyboardButton(text="⏮ В начало", callback_data="csearch_0_0"))
+    if has_more:
+        nav_buttons.append(
+            InlineKeyboardButton(
+                text="Дальше ➡️", callback_data=f"csearch_{page + 1}_{records[-1].id}"
             )
+        )
+    keyboard = [nav_buttons] if nav_buttons else []
+    keyboard.append(
+        [InlineKeyboardButton(text="📋 К причинам отмен", callback_data="admin_cancellations")]
+    )
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
-        csv_bytes = "\n".join(lines).encode("utf-8-sig")  # utf-8-sig для корректного открытия в Excel
-        filename = f"users_{datetime.now().strftime('%Y%m%d_%H%M')}.csv"
 
-        file = BufferedInputFile(csv_bytes, filename=filename)
-        await callback.message.answer_document(
-            document=file,
-            caption=(
-                f"📥 <b>Экспорт пользователей</b>\n\n"
-                f"👥 Всего записей: {len(rows)}\n"
-                f"📅 Дата: {datetime.now().strftime('%d.%m.%Y %H:%M')}"
-            ),
+@admin_router.message(AdminStates.waiting_for_cancellation_search)
+async def process_cancellation_search(message: Message, state: FSMContext):
+    """Результаты поиска по причинам отмен, новые сверху"""
+    query = (message.text or "").strip()
+
+    try:
+        records, snippets, has_more = await search_cancellations(
+            query, limit=CANCELLATION_SEARCH_PAGE_SIZE
+        )
+        if not records:
+            await message.answer(
+                "❌ Ничего не найдено. Отправьте другой запрос.",
+                reply_markup=back_to_admin_keyboard(),
+            )
+            return
+
+        await state.update_data(cancellation_query=query)
+        await message.answer(
+            _cancellation_results_text(query, 0, records, snippets),
+            reply_markup=_cancellation_results_keyboard(records, 0, has_more),
             parse_mode="HTML",
         )
-        await callback.answer("✅ Файл отправлен")
+    except Exception as e:
+        logger.error(f"Cancellation search error: {e}", exc_info=True)
+        await message.answer("❌ Ошибка поиска", reply_markup=back_to_admin_keyboard())
+        await state.clear()
+
 
+@admin_router.callback_query(F.data.startswith("csearch_"))
+async def navigate_cancellation_search(callback: CallbackQuery, state: FSMContext):
+    """Страницы поиска по причинам (keyset по id отмены)"""
+    if callback.from_user.id not in ADMIN_IDS:
+        return
+
+    # csearch_{page}_{before_id}, 0 - с самых новых
+    _, page, before_id = callback.data.split("_")
+    query = (await state.get_data()).get("cancellation_query")
+    if not query:
+        await callback.answer("⌛ Поиск устарел, начните заново", show_alert=True)
+        return
+
+    try:
+        records, snippets, has_more = await search_cancellations(
+            query, before_id=int(before_id) or None, limit=CANCELLATION_SEARCH_PAGE_SIZE
+        )
+        if not records:
+            await callback.answer("Больше результатов нет")
+            return
+        await callback.message.edit_text(
+            _cancellation_results_text(query, int(page), records, snippets),
+            reply_markup=_cancellation_results_keyboard(records, int(page), has_more),
+            parse_mode="HTML",
+        )
+        await callback.answer()
     except Exception as e:
-        logger.error(f"Export error: {e}", exc_info=True)
-        await callback.answer("❌ Ошибка экспорта", show_alert=True)
+        logger.error(f"Cancellation search paging error: {e}", exc_info=True)
+        await callback.answer("❌ Ошибка поиска", show_alert=True)
 
 
-def _csv_escape(value: str) -> str:
-    """Экранирует значение для CSV (оборачивает в кавычки если нужно)."""
-    if not value:
-        return ""
-    value = str(value)
-    if "," in value or '"' in value or "\n" in value:
-        return '"' + value.replace('"', '""') + '"'
-    return value
+# ==================== ЭКСПОРТ ====================
+
+
+@admin_router.callback_query(F.data == "admin_export")
+async def export_data(callback: CallbackQuery):
+    """Экспорт всех пользователей с данными подписок в CSV"""
+    if callback.from_user.id not in ADMIN_IDS:
+        return
+
+    await callback.answer("⏳ Готовлю экспорт...")
+
+    parts = []
+    try:
+        from aiogram.types import FSInputFile
+
+        parts, rows_total = await export_users_csv()
+        for index, path in enumerate(parts, start=1):
+            part_line = f"🧩 Часть: {index} из {len(parts)}\n" if len(parts) > 1 else ""
+            await callback.message.answer_document(
+                document=FSInputFile(str(path), filename=path.name),
+                caption=(
+                    f"📥 <b>Экспорт пользователей</b>\n\n"
+                    f"👥 Всего записей: {rows_total}\n"
+                    f"{part_line}"
+                    f"📅 Дата: {datetime.now().strftime('%d.%m.%Y %H:%M')}"
+                ),
+                parse_mode="HTML",
+            )
+
+    except Exception as e:
+        logger.error(f"Export error: {e}", exc_info=True)
+        await callback.message.answer(
+            "❌ Ошибка экспорта",
+            reply_markup=back_to_admin_keyboard(),
+        )
+    finally:
+        cleanup_export(parts)
 
 
 # ==================== БЕКАП ====================
@@ -1231,31 +1388,48 @@ async def trigger_backup(callback: CallbackQuery):
     if callback.from_user.id not in ADMIN_IDS:
         return
 
+    if get_storage().name != "sqlite":
+        await callback.answer()
+        await callback.message.answer(
+            "ℹ️ Бекап доступен только для SQLite. Для PostgreSQL используйте pg_dump.",
+            reply_markup=back_to_admin_keyboard(),
+        )
+        return
+
     await callback.answer("⏳ Создаю бекап...")
 
+    restore_dir = None
     try:
         from aiogram.types import FSInputFile
 
-        backup_path = await backup_database()
+        report = await backup_database()
 
-        if not backup_path:
+        if not report:
             await callback.message.answer(
                 "❌ Не удалось создать бекап. Проверьте логи.",
                 reply_markup=back_to_admin_keyboard(),
             )
             return
 
+        # В хранилище бекап лежит чанками - собираем файл для отправки
+        restore_dir = Path(tempfile.mkdtemp(prefix="backup_"))
+        backup_path = await restore_backup(report["name"], restore_dir / f"{report['name']}.db")
         file = FSInputFile(str(backup_path), filename=backup_path.name)
         await callback.message.answer_document(
             document=file,
             caption=(
                 f"💾 <b>Бекап базы данных</b>\n\n"
                 f"📁 Файл: <code>{backup_path.name}</code>\n"
+                f"📦 Размер: {report['bytes'] / 1024 / 1024:.1f} МБ\n"
+                f"🧩 Новых чанков: {report['new_chunks']} из {report['chunks']} "
+                f"({report['stored_bytes'] / 1024:.1f} КБ)\n"
+                f"⏱ Время: {report['duration']:.2f} с "
+                f"({report['throughput'] / 1024 / 1024:.1f} МБ/с)\n"
                 f"📅 Дата: {datetime.now().strftime('%d.%m.%Y %H:%M')}"
             ),
             parse_mode="HTML",
         )
-        logger.info(f"Admin {callback.from_user.id} requested manual backup: {backup_path}")
+        logger.info(f"Admin {callback.from_user.id} requested manual backup: {report['name']}")
 
     except Exception as e:
         logger.error(f"Backup error: {e}", exc_info=True)
@@ -1263,6 +1437,9 @@ async def trigger_backup(callback: CallbackQuery):
             "❌ Ошибка при создании бекапа",
             reply_markup=back_to_admin_keyboard(),
         )
+    finally:
+        if restore_dir:
+            shutil.rmtree(restore_dir, ignore_errors=True)
 
 
 # ==================== ДИАГНОСТИКА И ТЕСТ ОПЛАТЫ ====================
@@ -1283,8 +1460,48 @@ def _diagnostics_keyboard(channel_ok: bool) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 
+def _storage_diagnostics(stats: Dict) -> List[str]:
+    """Строки диагностики пулов и очередей текущего хранилища."""
+    pool = stats["pool"]
+    if stats["backend"] == "postgres":
+        if not pool:
+            return ["\n🐘 <b>PostgreSQL:</b> пул не открыт"]
+        return [
+            f"\n🐘 <b>Пул PostgreSQL:</b> соединений {pool['size']} "
+            f"(свободно {pool['idle']}, лимит {pool['min']}–{pool['max']})"
+        ]
+
+    lines = []
+    if pool:
+        lines.append(
+            f"\n🗄 <b>Пул БД:</b> читателей {pool['readers']} "
+            f"(свободно {pool['idle_readers']}), в работе {pool['in_flight']}, "
+            f"выдач {pool['checkouts']}, ожиданий {pool['waits']}"
+        )
+    analytics = stats["analytics"]
+    lines.append(
+        f"📊 <b>Пул аналитики:</b> потоков {analytics['workers']}, "
+        f"заданий {analytics['jobs']} (в работе {analytics['in_flight']}, "
+        f"в очереди {analytics['queued']}, ошибок {analytics['failed']})"
+    )
+    queue = stats["write_queue"]
+    lines.append(
+        f"✍️ <b>Очередь записи:</b> глубина {queue['depth']} (макс. {queue['max_depth']}), "
+        f"коммитов {queue['batches']}, запросов {queue['requests']}, "
+        f"в пачке в среднем {queue['avg_batch']} (макс. {queue['max_batch']}), "
+        f"ошибок {queue['failed']}"
+    )
+    writes = stats["user_writes"]
+    lines.append(
+        f"📝 <b>Буфер записи users:</b> в очереди {writes['pending']}, "
+        f"пропущено без изменений {writes['skipped']} из {writes['staged'] + writes['skipped']}, "
+        f"сбросов {writes['flushes']} ({writes['rows_flushed']} строк)"
+    )
+    return lines
+
+
 @admin_router.callback_query(F.data == "admin_diagnostics")
-async def show_diagnostics(callback: CallbackQuery, bot: Bot):
+async def show_diagnostics(callback: CallbackQuery, bot: Bot, fsm_storage: BaseStorage):
     """Диагностика: Stripe, канал, webhook"""
     if callback.from_user.id not in ADMIN_IDS:
         return
@@ -1311,12 +1528,16 @@ async def show_diagnostics(callback: CallbackQuery, bot: Bot):
         lines.append("❌ <b>Price ID:</b> не задан (STRIPE_PRICE_ID)")
     elif STRIPE_SECRET_KEY:
         try:
-            price = stripe_lib.Price.retrieve(STRIPE_PRICE_ID)
+            from payments.stripe_pay import StripePaymentHandler
+
+            price = await StripePaymentHandler.retrieve_price(STRIPE_PRICE_ID)
             amount = f"{price.unit_amount / 100:.2f}" if price.unit_amount else "?"
             currency = (price.currency or "").upper()
             lines.append(f"✅ <b>Price ID:</b> {amount} {currency} — найден в Stripe")
         except stripe_lib.StripeError as e:
             lines.append(f"❌ <b>Price ID:</b> ошибка Stripe — {getattr(e, 'user_message', None) or e}")
+        except asyncio.TimeoutError:
+            lines.append("❌ <b>Price ID:</b> Stripe не ответил вовремя")
         except Exception as e:
             lines.append(f"❌ <b>Price ID:</b> {e}")
     else:
@@ -1364,6 +1585,16 @@ async def show_diagnostics(callback: CallbackQuery, bot: Bot):
 
     channel_ok = channel_ok and invite_ok
 
+    # ── Хранилище ─────────────────────────────────────────────
+    lines.extend(_storage_diagnostics(get_storage().stats()))
+    if isinstance(fsm_storage, PersistentFSMStorage):
+        fsm = fsm_storage.stats()
+        lines.append(
+            f"💬 <b>FSM-диалоги:</b> в памяти {fsm['size']}, не сброшено {fsm['pending']}, "
+            f"попаданий {fsm['hits']}, промахов {fsm['misses']}, "
+            f"брошенных {fsm['expired']}, сбросов {fsm['flushes']} ({fsm['rows_flushed']} строк)"
+        )
+
     text = "\n".join(lines)
     await callback.message.edit_text(
         text,
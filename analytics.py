@@ -0,0 +1,232 @@
+"""
+Аналитические чтения админки: список пользователей, статистика, отмены
+(поиск и темы оттока), экспорт.
+
+Эти запросы идут мимо пула бота: каждое задание открывает отдельное
+соединение file:...?mode=ro и выполняется в своем пуле из
+ANALYTICS_MAX_WORKERS потоков. Задание целиком читает один снимок WAL
+(транзакция чтения открыта до его конца), поэтому отчет согласован, а
+долгий экспорт не занимает ни читателей пула, ни писателя - оплаты и
+планировщик подписок его не ждут.
+"""
+
+import asyncio
+import logging
+import re
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import date, datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+import database
+from config import ANALYTICS_MAX_WORKERS, DATABASE_BUSY_TIMEOUT_MS
+from records import CANCELLATION_COLUMNS, CancellationRecord, cancellation_factory, users_page_result
+from rollups import DAILY_STATS_SQL, RECENT_COLUMNS, SERIES_WINDOWS, build_series, series_start
+
+logger = logging.getLogger(__name__)
+
+_executor: Optional[ThreadPoolExecutor] = None
+_stats = {"jobs": 0, "failed": 0, "in_flight": 0, "max_in_flight": 0}
+
+
+@contextmanager
+def snapshot_connection(db_path: str):
+    """Read-only соединение, закрепленное на одном снимке БД."""
+    conn = sqlite3.connect(
+        f"file:{db_path}?mode=ro",
+        uri=True,
+        isolation_level=None,
+        timeout=DATABASE_BUSY_TIMEOUT_MS / 1000,
+    )
+    conn.row_factory = sqlite3.Row
+    try:
+        # Снимок фиксируется первым чтением после BEGIN
+        conn.execute("BEGIN")
+        conn.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchone()
+        yield conn
+    finally:
+        conn.close()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=ANALYTICS_MAX_WORKERS, thread_name_prefix="analytics"
+        )
+    return _executor
+
+
+def _run_job(db_path: str, job: Callable, args: tuple):
+    with snapshot_connection(db_path) as conn:
+        return job(conn, *args)
+
+
+async def run_snapshot(job: Callable, *args, db_path: Optional[str] = None):
+    """
+    Выполняет job(conn, *args) в пуле аналитики на снимке БД.
+    Заданий одновременно не больше ANALYTICS_MAX_WORKERS, остальные ждут в очереди.
+    """
+    # Отложенные записи users должны попасть в снимок
+    await database.flush_user_writes()
+    loop = asyncio.get_running_loop()
+    _stats["jobs"] += 1
+    _stats["in_flight"] += 1
+    _stats["max_in_flight"] = max(_stats["max_in_flight"], _stats["in_flight"])
+    try:
+        return await loop.run_in_executor(
+            _get_executor(), _run_job, db_path or database.DATABASE_PATH, job, args
+        )
+    except Exception:
+        _stats["failed"] += 1
+        raise
+    finally:
+        _stats["in_flight"] -= 1
+
+
+def get_analytics_stats() -> Dict:
+    return {
+        **_stats,
+        "workers": ANALYTICS_MAX_WORKERS,
+        "queued": max(0, _stats["in_flight"] - ANALYTICS_MAX_WORKERS),
+    }
+
+
+async def shutdown_analytics() -> None:
+    """Отменяет задания в очереди и ждет текущие, не блокируя цикл событий."""
+    global _executor
+    if _executor is not None:
+        executor, _executor = _executor, None
+        await asyncio.to_thread(executor.shutdown, wait=True, cancel_futures=True)
+
+
+# ==================== ЗАПРОСЫ ====================
+
+
+def _users_page(conn: sqlite3.Connection, cursor, backwards: bool, limit: int) -> tuple:
+    sql, params = database.users_page_query(cursor, backwards, limit)
+    users, has_more = users_page_result(conn.execute(sql, params).fetchall(), backwards, limit)
+    row = conn.execute("SELECT value FROM stats_counters WHERE name = 'users_total'").fetchone()
+    return users, has_more, row[0] if row else 0
+
+
+async def users_page(
+    cursor: Optional[tuple] = None, backwards: bool = False, limit: int = 10
+) -> tuple:
+    """Страница пользователей как get_users_page() плюс общее число: (users, has_more, total)."""
+    return await run_snapshot(_users_page, cursor, backwards, limit)
+
+
+def _stats_report(conn: sqlite3.Connection, since: datetime, days: int) -> Dict:
+    counters = {row[0]: row[1] for row in conn.execute("SELECT name, value FROM stats_counters")}
+    recent = {
+        table: conn.execute(
+            f"SELECT COUNT(*) FROM {table} WHERE {column} >= ?", (database.to_epoch(since),)
+        ).fetchone()[0]
+        for table, column in RECENT_COLUMNS.items()
+    }
+    rows = conn.execute(DAILY_STATS_SQL, (series_start(days).isoformat(),)).fetchall()
+    return {"counters": counters, "recent": recent, "series": build_series(rows, days)}
+
+
+async def stats_report(since: datetime, days: int = max(SERIES_WINDOWS)) -> Dict:
+    """
+    Счетчики, число новых записей с since по таблицам и дневные ряды за days
+    дней - из одного снимка, так что цифры отчета согласованы между собой.
+    """
+    return await run_snapshot(_stats_report, since, days)
+
+
+def _recent_cancellations(conn: sqlite3.Connection, limit: int) -> List[sqlite3.Row]:
+    return conn.execute(
+        "SELECT username, reason, cancelled_at FROM cancellations ORDER BY cancelled_at DESC LIMIT ?",
+        (limit,),
+    ).fetchall()
+
+
+async def recent_cancellations(limit: int = 20) -> List[sqlite3.Row]:
+    return await run_snapshot(_recent_cancellations, limit)
+
+
+# Маркеры совпадений в snippet(): текст экранируется для HTML уже после выборки
+MATCH_START = "\ue000"
+MATCH_END = "\ue001"
+
+
+def cancellation_match_query(text: str) -> str:
+    """
+    Запрос FTS5 из текста админа: все слова должны встретиться, каждое -
+    как начало слова (префикс вместо морфологии: "дорог" найдет "дорого").
+    Слова берутся в кавычки, операторы FTS5 в тексте не интерпретируются.
+    """
+    words = re.findall(r"\w+", text.lower())
+    return " ".join('"' + word + '"*' for word in words)
+
+
+def _search_cancellations(
+    conn: sqlite3.Connection, match: str, before_id: Optional[int], limit: int
+) -> Tuple[List[CancellationRecord], List[str], bool]:
+    cursor = conn.cursor()
+    rows = cursor.execute(
+        f"""
+        SELECT {CANCELLATION_COLUMNS},
+               snippet(cancellations_fts, 0, ?, ?, '…', 12)
+        FROM cancellations_fts f
+        JOIN cancellations c ON c.id = f.rowid
+        WHERE cancellations_fts MATCH ? AND f.rowid < ?
+        ORDER BY f.rowid DESC
+        LIMIT ?
+        """,
+        (MATCH_START, MATCH_END, match, before_id or 2**63 - 1, limit + 1),
+    ).fetchall()
+    page = rows[:limit]
+    records = [cancellation_factory(None, tuple(row)[:5]) for row in page]
+    return records, [row[5] for row in page], len(rows) > limit
+
+
+async def search_cancellations(
+    query: str, before_id: Optional[int] = None, limit: int = 10
+) -> Tuple[List[CancellationRecord], List[str], bool]:
+    """
+    Полнотекстовый поиск по причинам отмен, новые сверху, постранично по id
+    (before_id - последний id предыдущей страницы).
+    Возвращает (записи, фрагменты с маркерами MATCH_START/MATCH_END, has_more).
+    """
+    match = cancellation_match_query(query)
+    if not match:
+        return [], [], False
+    return await run_snapshot(_search_cancellations, match, before_id, limit)
+
+
+def _churn_themes(conn: sqlite3.Connection, since: str, until: str, limit: int) -> Dict:
+    themes = conn.execute(
+        """
+        SELECT term, SUM(count) AS total
+        FROM cancellation_terms
+        WHERE day BETWEEN ? AND ?
+        GROUP BY term
+        ORDER BY total DESC, term
+        LIMIT ?
+        """,
+        (since, until, limit),
+    ).fetchall()
+    indexed = conn.execute(
+        "SELECT value FROM job_state WHERE name = 'cancellation_terms'"
+    ).fetchone()
+    pending = conn.execute(
+        "SELECT COUNT(*) FROM cancellations WHERE id > ?", (indexed[0] if indexed else 0,)
+    ).fetchone()[0]
+    return {"themes": [(row[0], row[1]) for row in themes], "pending": pending}
+
+
+async def churn_themes(days: int = 30, limit: int = 10, today: Optional[date] = None) -> Dict:
+    """
+    Самые частые термины причин отмен за последние days дней (локальные даты)
+    из cancellation_terms: {"themes": [(термин, число причин)], "pending": еще
+    не проиндексированных отмен}.
+    """
+    today = today or date.today()
+    return await run_snapshot(
+        _churn_themes, series_start(days, today).isoformat(), today.isoformat(), limit
+    )
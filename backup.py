@@ -0,0 +1,138 @@
+"""
+Онлайн-бекап базы через SQLite backup API.
+
+Копия снимается в отдельном потоке порциями по BACKUP_PAGES_PER_STEP
+страниц с паузой между порциями. Все шаги читают один снимок БД (открытая
+транзакция чтения в режиме WAL), поэтому копия согласована и учитывает
+содержимое -wal файла, а запись бота во время бекапа не блокируется.
+Снимок затем раскладывается по чанкам в хранилище (см. backup_store.py).
+"""
+
+import asyncio
+import logging
+import sqlite3
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Optional
+
+from backup_store import BackupStore, BackupStoreError
+from config import BACKUP_PAGES_PER_STEP, BACKUP_STEP_PAUSE_MS, DATABASE_PATH
+from database import flush_user_writes
+
+logger = logging.getLogger(__name__)
+
+BACKUP_KEEP_COUNT = 7
+
+
+def _backup_sync(src: Path, dst: Path, pages: int, pause: float) -> Dict:
+    tmp = dst.with_name(dst.name + ".part")
+    tmp.unlink(missing_ok=True)
+    steps = 0
+
+    def progress(status, remaining, total):
+        nonlocal steps
+        steps += 1
+        if remaining and pause:
+            # Отдаем диск и GIL живому трафику между порциями
+            time.sleep(pause)
+
+    started = time.monotonic()
+    source = sqlite3.connect(str(src), isolation_level=None)
+    target = sqlite3.connect(str(tmp))
+    try:
+        # Снимок фиксируется первым чтением; шаги бекапа используют эту
+        # транзакцию и не перезапускаются из-за параллельной записи
+        source.execute("BEGIN")
+        page_size = source.execute("PRAGMA page_size").fetchone()[0]
+        page_count = source.execute("PRAGMA page_count").fetchone()[0]
+        source.backup(target, pages=pages, progress=progress)
+        source.execute("COMMIT")
+    except BaseException:
+        target.close()
+        tmp.unlink(missing_ok=True)
+        raise
+    finally:
+        source.close()
+    target.close()
+    tmp.replace(dst)
+
+    duration = max(time.monotonic() - started, 1e-6)
+    size = page_size * page_count
+    return {
+        "path": dst,
+        "pages": page_count,
+        "steps": steps,
+        "bytes": size,
+        "duration": duration,
+        "throughput": size / duration,
+    }
+
+
+async def backup_sqlite(
+    src: Path,
+    dst: Path,
+    pages: int = BACKUP_PAGES_PER_STEP,
+    pause_ms: int = BACKUP_STEP_PAUSE_MS,
+) -> Dict:
+    """Согласованная копия src в dst. Возвращает отчет о бекапе."""
+    return await asyncio.to_thread(_backup_sync, Path(src), Path(dst), pages, pause_ms / 1000)
+
+
+def _backup_name() -> str:
+    return f"bot_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+
+
+def default_store(db_path: Optional[str] = None) -> BackupStore:
+    return BackupStore(Path(db_path or DATABASE_PATH).parent / "backups")
+
+
+async def backup_database(db_path: Optional[str] = None) -> Optional[Dict]:
+    """
+    Снимает согласованную копию БД и сохраняет ее в хранилище бекапов
+    (записываются только измененные чанки). Хранит последние
+    BACKUP_KEEP_COUNT бекапов, ненужные чанки удаляет.
+    Возвращает отчет (name, bytes, new_chunks, duration...) или None при ошибке.
+    """
+    db_path = Path(db_path or DATABASE_PATH)
+    if not db_path.exists():
+        logger.warning("⚠️ Файл БД не найден, бекап пропущен: %s", db_path)
+        return None
+
+    store = default_store(str(db_path))
+    store.root.mkdir(parents=True, exist_ok=True)
+    name = _backup_name()
+    snapshot = store.root / f".{name}.snapshot"
+
+    try:
+        # Отложенные записи users должны попасть в снимок
+        await flush_user_writes()
+        report = await backup_sqlite(db_path, snapshot)
+        report.update(await asyncio.to_thread(store.add, snapshot, name))
+        pruned = await asyncio.to_thread(store.prune, BACKUP_KEEP_COUNT)
+    except (OSError, sqlite3.Error, BackupStoreError) as e:
+        logger.error("❌ Ошибка создания бекапа: %s", e)
+        return None
+    finally:
+        snapshot.unlink(missing_ok=True)
+    del report["path"]
+
+    logger.info(
+        "✅ Бекап создан: %s (%.1f МБ за %.2f с, %.1f МБ/с; новых чанков %d из %d, "
+        "записано %.1f КБ; удалено бекапов %d, чанков %d)",
+        name,
+        report["bytes"] / 1024 / 1024,
+        report["duration"],
+        report["throughput"] / 1024 / 1024,
+        report["new_chunks"],
+        report["chunks"],
+        report["stored_bytes"] / 1024,
+        pruned["removed_backups"],
+        pruned["removed_chunks"],
+    )
+    return report
+
+
+async def restore_backup(name: str, target: Path, db_path: Optional[str] = None) -> Path:
+    """Собирает файл БД из хранилища (name - имя бекапа или latest)."""
+    return await asyncio.to_thread(default_store(db_path).restore, name, Path(target))
@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+"""
+Инкрементальное хранилище бекапов.
+
+Снимок БД режется на чанки по BACKUP_CHUNK_PAGES страниц, каждый чанк
+сжимается zlib и хранится один раз под своим sha256 (chunks/ab/abcd...).
+Бекап - это небольшой манифест со списком хешей (manifests/<name>.json),
+поэтому ежедневный бекап стоит только измененных страниц.
+
+Использование:
+    python backup_store.py list
+    python backup_store.py verify [name]
+    python backup_store.py restore <name|latest> <target.db>
+    python backup_store.py gc [--keep N]
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_VERSION = 1
+BACKUP_CHUNK_PAGES = 16
+# Чанки моложе этого возраста сборщик мусора не трогает: их может
+# записывать бекап, манифест которого еще не сохранен
+GC_GRACE_SECONDS = 3600
+
+# Запись манифестов и сборка мусора внутри процесса идут по очереди
+_store_lock = threading.Lock()
+
+
+class BackupStoreError(Exception):
+    """Хранилище повреждено или манифест не найден."""
+
+
+def _write_atomic(path: Path, data: bytes) -> None:
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class BackupStore:
+    """Каталог с чанками и манифестами бекапов."""
+
+    def __init__(self, root: Path) -> None:
+        self.root = Path(root)
+        self.chunks_dir = self.root / "chunks"
+        self.manifests_dir = self.root / "manifests"
+
+    def _chunk_path(self, digest: str) -> Path:
+        return self.chunks_dir / digest[:2] / digest
+
+    def _read_chunk(self, digest: str) -> bytes:
+        path = self._chunk_path(digest)
+        if not path.exists():
+            raise BackupStoreError(f"Чанк {digest} отсутствует")
+        try:
+            data = zlib.decompress(path.read_bytes())
+        except zlib.error as e:
+            raise BackupStoreError(f"Чанк {digest} не распаковывается: {e}") from e
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise BackupStoreError(f"Чанк {digest}: хеш не совпадает")
+        return data
+
+    # ==================== БЕКАП ====================
+
+    def add(self, snapshot: Path, name: str) -> Dict:
+        """
+        Сохраняет согласованный снимок БД как новый бекап.
+        Записываются только чанки, которых еще нет в хранилище.
+        """
+        conn = sqlite3.connect(f"file:{snapshot}?mode=ro", uri=True)
+        try:
+            page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        finally:
+            conn.close()
+        chunk_size = page_size * BACKUP_CHUNK_PAGES
+
+        with _store_lock:
+            self.manifests_dir.mkdir(parents=True, exist_ok=True)
+            digests: List[str] = []
+            new_chunks = 0
+            stored_bytes = 0
+            size = 0
+            with open(snapshot, "rb") as f:
+                while True:
+                    data = f.read(chunk_size)
+                    if not data:
+                        break
+                    size += len(data)
+                    digest = hashlib.sha256(data).hexdigest()
+                    digests.append(digest)
+                    path = self._chunk_path(digest)
+                    if path.exists():
+                        continue
+                    path.parent.mkdir(parents=True, exist_ok=True)
+                    packed = zlib.compress(data, 6)
+                    _write_atomic(path, packed)
+                    new_chunks += 1
+                    stored_bytes += len(packed)
+
+            manifest = {
+                "version": MANIFEST_VERSION,
+                "name": name,
+                "created_at": datetime.now().isoformat(timespec="seconds"),
+                "page_size": page_size,
+                "chunk_size": chunk_size,
+                "size": size,
+                "chunks": digests,
+            }
+            _write_atomic(
+                self.manifests_dir / f"{name}.json",
+                json.dumps(manifest).encode("utf-8"),
+            )
+
+        return {
+            "name": name,
+            "bytes": size,
+            "chunks": len(digests),
+            "new_chunks": new_chunks,
+            "stored_bytes": stored_bytes,
+        }
+
+    # ==================== МАНИФЕСТЫ ====================
+
+    def list_backups(self) -> List[str]:
+        """Имена бекапов от старых к новым."""
+        if not self.manifests_dir.exists():
+            return []
+        return sorted(p.stem for p in self.manifests_dir.glob("*.json"))
+
+    def load_manifest(self, name: str) -> Dict:
+        if name == "latest":
+            names = self.list_backups()
+            if not names:
+                raise BackupStoreError("В хранилище нет бекапов")
+            name = names[-1]
+        path = self.manifests_dir / f"{name}.json"
+        if not path.exists():
+            raise BackupStoreError(f"Бекап {name} не найден")
+        manifest = json.loads(path.read_text(encoding="utf-8"))
+        if manifest.get("version") != MANIFEST_VERSION:
+            raise BackupStoreError(f"Неизвестная версия манифеста: {manifest.get('version')}")
+        return manifest
+
+    # ==================== ВОССТАНОВЛЕНИЕ И ПРОВЕРКА ====================
+
+    def restore(self, name: str, target: Path) -> Path:
+        """Собирает файл БД из чанков, проверяя хеш каждого."""
+        manifest = self.load_manifest(name)
+        target = Path(target)
+        tmp = target.with_name(target.name + ".part")
+        try:
+            with open(tmp, "wb") as f:
+                for digest in manifest["chunks"]:
+                    f.write(self._read_chunk(digest))
+            if tmp.stat().st_size != manifest["size"]:
+                raise BackupStoreError(f"Размер бекапа {manifest['name']} не совпадает")
+            os.replace(tmp, target)
+        except BaseException:
+            tmp.unlink(missing_ok=True)
+            raise
+        return target
+
+    def verify(self, name: Optional[str] = None) -> Dict:
+        """Проверяет наличие и хеши чанков одного или всех бекапов."""
+        names = [name] if name else self.list_backups()
+        checked: Dict[str, Optional[str]] = {}
+        problems: List[str] = []
+        for backup_name in names:
+            manifest = self.load_manifest(backup_name)
+            for digest in manifest["chunks"]:
+                if digest not in checked:
+                    try:
+                        self._read_chunk(digest)
+                        checked[digest] = None
+                    except BackupStoreError as e:
+                        checked[digest] = str(e)
+                if checked[digest]:
+                    problems.append(f"{manifest['name']}: {checked[digest]}")
+        return {"backups": len(names), "chunks": len(checked), "problems": problems}
+
+    # ==================== ХРАНЕНИЕ ====================
+
+    def prune(self, keep: int) -> Dict:
+        """Оставляет последние keep бекапов и удаляет ненужные чанки."""
+        with _store_lock:
+            removed_backups = 0
+            for name in self.list_backups()[:-keep] if keep > 0 else []:
+                (self.manifests_dir / f"{name}.json").unlink(missing_ok=True)
+                removed_backups += 1
+            removed_chunks = self._collect_garbage()
+        return {"removed_backups": removed_backups, "removed_chunks": removed_chunks}
+
+    def _collect_garbage(self) -> int:
+        referenced: Set[str] = set()
+        for name in self.list_backups():
+            referenced.update(self.load_manifest(name)["chunks"])
+
+        if not self.chunks_dir.exists():
+            return 0
+        horizon = time.time() - GC_GRACE_SECONDS
+        removed = 0
+        for path in self.chunks_dir.glob("*/*"):
+            if path.name in referenced or path.suffix == ".tmp":
+                continue
+            try:
+                if path.stat().st_mtime > horizon:
+                    continue
+                path.unlink()
+                removed += 1
+            except OSError:
+                pass
+        return removed
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    from backup import BACKUP_KEEP_COUNT, default_store
+
+    parser = argparse.ArgumentParser(description="Хранилище бекапов бота")
+    parser.add_argument("--store", help="Каталог хранилища (по умолчанию data/backups)")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("list", help="Список бекапов")
+    verify_cmd = commands.add_parser("verify", help="Проверить хеши чанков")
+    verify_cmd.add_argument("name", nargs="?")
+    restore_cmd = commands.add_parser("restore", help="Восстановить БД из бекапа")
+    restore_cmd.add_argument("name", help="Имя бекапа или latest")
+    restore_cmd.add_argument("target", help="Путь к восстановленному файлу")
+    gc_cmd = commands.add_parser("gc", help="Удалить старые бекапы и ненужные чанки")
+    gc_cmd.add_argument("--keep", type=int, default=BACKUP_KEEP_COUNT)
+    args = parser.parse_args(argv)
+
+    store = BackupStore(Path(args.store)) if args.store else default_store()
+    try:
+        if args.command == "list":
+            for name in store.list_backups():
+                manifest = store.load_manifest(name)
+                print(f"{name}  {manifest['size'] / 1024 / 1024:.1f} МБ  чанков: {len(manifest['chunks'])}")
+        elif args.command == "verify":
+            result = store.verify(args.name)
+            for problem in result["problems"]:
+                print(f"❌ {problem}")
+            print(f"Проверено бекапов: {result['backups']}, чанков: {result['chunks']}")
+            return 1 if result["problems"] else 0
+        elif args.command == "restore":
+            path = store.restore(args.name, Path(args.target))
+            print(f"✅ Восстановлено: {path}")
+        elif args.command == "gc":
+            result = store.prune(args.keep)
+            print(
+                f"🗑 Удалено бекапов: {result['removed_backups']}, "
+                f"чанков: {result['removed_chunks']}"
+            )
+    except BackupStoreError as e:
+        print(f"❌ {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -13,11 +13,12 @@ from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command, CommandStart
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import CallbackQuery, Message
 from aiohttp import web
 
-from admin import admin_router
+from admin import admin_router, back_to_admin_keyboard
+from analytics import shutdown_analytics
+from broadcast import resume_broadcasts
 from config import (
     ADMIN_IDS,
     BOT_TOKEN,
@@ -33,19 +34,7 @@ from config import (
     WEBHOOK_PORT,
     validate_config,
 )
-from database import (
-    cancel_subscription,
-    create_subscription,
-    get_subscription,
-    get_user_stats,
-    has_payment_attempt,
-    init_db,
-    is_subscription_active,
-    mark_payment_attempt,
-    save_cancellation_reason,
-    save_user,
-    update_subscription_period,
-)
+from fsm_storage import PersistentFSMStorage
 from keyboards import (
     back_to_status_keyboard,
     cancel_confirm_keyboard,
@@ -60,6 +49,18 @@ from keyboards import (
 from messages import format_message
 from payments import PaymentFactory
 from payments.stripe_pay import StripePaymentHandler
+from storage import (
+    cancel_subscription,
+    close_storage,
+    create_subscription,
+    get_subscription,
+    get_user_stats,
+    init_storage,
+    load_user_context,
+    mark_payment_attempt,
+    save_cancellation_reason,
+    update_subscription_period,
+)
 from subscription_tasks import subscription_enforcer
 
 logging.basicConfig(
@@ -74,7 +75,8 @@ logger = logging.getLogger(__name__)
 
 
 bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
+fsm_storage = PersistentFSMStorage()
+dp = Dispatcher(storage=fsm_storage)
 dp.include_router(admin_router)
 
 subscription_task = None
@@ -95,12 +97,14 @@ async def process_successful_payment(
         logger.info(
             f"🔄 Обработка платежа для user {user_id}, amount={amount}, session={session_id}, status={status}"
         )
+        # Оплаченная Checkout Session больше не годится для повторного показа
+        await PaymentFactory.invalidate(user_id)
 
         if status == "renewed":
             # Auto-renewal: extend existing expiry, user is already in the channel
             sub = await get_subscription(user_id)
-            if sub and sub["status"] == "active":
-                new_expires = sub["expires_at"] + timedelta(days=SUBSCRIPTION_DAYS)
+            if sub and sub.status == "active":
+                new_expires = sub.expires_at + timedelta(days=SUBSCRIPTION_DAYS)
             else:
                 new_expires = datetime.now() + timedelta(days=SUBSCRIPTION_DAYS)
             await update_subscription_period(user_id, new_expires)
@@ -154,7 +158,7 @@ async def stripe_webhook_handler(request: web.Request):
             logger.warning("⛔ Invalid Stripe webhook signature")
             return web.Response(status=403, text="Forbidden")
 
-        result = StripePaymentHandler.parse_webhook(payload, signature)
+        result = await StripePaymentHandler.parse_webhook(payload, signature)
 
         logger.info(f"🔍 Stripe webhook result: {result}")
 
@@ -179,23 +183,24 @@ async def stripe_webhook_handler(request: web.Request):
 # ==================== ХЕНДЛЕРЫ БОТА ====================
 
 
+def _main_keyboard(context: dict):
+    """Главное меню в зависимости от состояния пользователя."""
+    if context["is_active"]:
+        return main_keyboard_subscribed()
+    if context["has_payment_attempt"]:
+        return main_keyboard_after_payment_attempt()
+    return main_keyboard_new_user()
+
+
 @dp.message(CommandStart())
 async def cmd_start(message: Message):
     user = message.from_user
-    await save_user(user.id, user.username, user.first_name)
-
-    is_active = await is_subscription_active(user.id)
-    has_attempt = await has_payment_attempt(user.id)
-
-    if is_active:
-        keyboard = main_keyboard_subscribed()
-    elif has_attempt:
-        keyboard = main_keyboard_after_payment_attempt()
-    else:
-        keyboard = main_keyboard_new_user()
+    context = await load_user_context(user.id, user.username, user.first_name)
 
     await message.answer(
-        format_message("welcome"), reply_markup=keyboard, parse_mode="HTML"
+        format_message("welcome"),
+        reply_markup=_main_keyboard(context),
+        parse_mode="HTML",
     )
     logger.info(f"👤 User {user.id} (@{user.username}) started bot")
 
@@ -215,7 +220,8 @@ async def process_payment(callback: CallbackQuery):
     user_id = callback.from_user.id
     username = callback.from_user.username
 
-    if await is_subscription_active(user_id):
+    context = await load_user_context(user_id, username, callback.from_user.first_name)
+    if context["is_active"]:
         await callback.answer("✅ У вас уже есть активная подписка!", show_alert=True)
         return
 
@@ -248,10 +254,10 @@ async def process_payment(callback: CallbackQuery):
 
 @dp.callback_query(F.data == "status")
 async def show_status(callback: CallbackQuery):
-    user_id = callback.from_user.id
-    sub = await get_subscription(user_id)
+    user = callback.from_user
+    context = await load_user_context(user.id, user.username, user.first_name)
 
-    if not sub or sub["status"] != "active":
+    if context["status"] != "active":
         await callback.message.edit_text(
             format_message("no_subscription"),
             reply_markup=subscription_offer_keyboard(),
@@ -260,7 +266,7 @@ async def show_status(callback: CallbackQuery):
         await callback.answer()
         return
 
-    days_left = (sub["expires_at"] - datetime.now()).days
+    days_left = (context["expires_at"] - datetime.now()).days
     if days_left < 0:
         await callback.message.edit_text(
             format_message("no_subscription"),
@@ -316,7 +322,7 @@ async def process_cancel_reason(message: Message, state: FSMContext):
     sub = await get_subscription(user_id)
     await cancel_subscription(user_id)
     await save_cancellation_reason(
-        user_id, username, reason, sub.get("stripe_subscription_id") if sub else None
+        user_id, username, reason, sub.stripe_subscription_id if sub else None
     )
 
     if SUPPORT_USER_ID:
@@ -361,19 +367,13 @@ async def renewal_decline(callback: CallbackQuery):
 
 @dp.callback_query(F.data == "back_to_main")
 async def back_to_main(callback: CallbackQuery):
-    user_id = callback.from_user.id
-    is_active = await is_subscription_active(user_id)
-    has_attempt = await has_payment_attempt(user_id)
-
-    if is_active:
-        keyboard = main_keyboard_subscribed()
-    elif has_attempt:
-        keyboard = main_keyboard_after_payment_attempt()
-    else:
-        keyboard = main_keyboard_new_user()
+    user = callback.from_user
+    context = await load_user_context(user.id, user.username, user.first_name)
 
     await callback.message.edit_text(
-        format_message("welcome"), reply_markup=keyboard, parse_mode="HTML"
+        format_message("welcome"),
+        reply_markup=_main_keyboard(context),
+        parse_mode="HTML",
     )
     await callback.answer()
 
@@ -401,7 +401,9 @@ async def on_startup():
         logger.error(f"❌ Ошибка конфигурации: {e}")
         raise
 
-    await init_db()
+    storage = await init_storage()
+    logger.info(f"🗄 Хранилище: {storage.name}")
+    fsm_storage.start()
     provider = PaymentFactory.get_provider_name()
     logger.info(f"💳 Платежный провайдер: {provider}")
 
@@ -417,6 +419,10 @@ async def on_startup():
             "   2. Бот добавлен в канал как администратор с правом приглашать участников"
         )
 
+    resumed = await resume_broadcasts(bot, done_markup=back_to_admin_keyboard())
+    if resumed:
+        logger.info(f"🔁 Возобновлено рассылок: {resumed}")
+
     logger.info("✅ Бот успешно запущен!")
 
     global subscription_task
@@ -428,6 +434,9 @@ async def on_shutdown():
     global subscription_task
     if subscription_task:
         subscription_task.cancel()
+    # Сначала сбрасываем отложенные записи, долгий экспорт их не задерживает
+    await close_storage()
+    await shutdown_analytics()
     await bot.session.close()
 
 
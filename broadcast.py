@@ -0,0 +1,252 @@
+"""
+Фоновая массовая рассылка: несколько отправителей, общий лимитер Telegram
+и периодический отчет о прогрессе в статусном сообщении администратора.
+Задачи рассылки хранятся в БД и продолжаются после перезапуска бота.
+"""
+
+import asyncio
+import logging
+import time
+from typing import AsyncIterable, Dict, Iterable, List, Optional, Set, Tuple, Union
+
+from aiogram import Bot
+from aiogram.types import InlineKeyboardMarkup
+
+from config import BROADCAST_BATCH_SIZE, BROADCAST_CONCURRENCY, BROADCAST_PROGRESS_INTERVAL
+from storage import (
+    finish_broadcast_job,
+    get_unfinished_broadcast_jobs,
+    record_broadcast_results,
+    reserve_broadcast_recipients,
+)
+from throttling import TelegramRateLimiter, send_message_limited
+
+logger = logging.getLogger(__name__)
+
+# Ссылки на запущенные задачи, чтобы их не собрал сборщик мусора
+_running: Set[asyncio.Task] = set()
+
+
+class BroadcastEngine:
+    """Рассылка одного текста списку получателей."""
+
+    def __init__(
+        self,
+        bot: Bot,
+        text: str,
+        status_chat_id: Optional[int] = None,
+        status_message_id: Optional[int] = None,
+        concurrency: int = BROADCAST_CONCURRENCY,
+        limiter: Optional[TelegramRateLimiter] = None,
+        progress_interval: float = BROADCAST_PROGRESS_INTERVAL,
+        done_markup: Optional[InlineKeyboardMarkup] = None,
+    ) -> None:
+        self.bot = bot
+        self.text = text
+        self.status_chat_id = status_chat_id
+        self.status_message_id = status_message_id
+        self.concurrency = max(1, concurrency)
+        self.limiter = limiter or TelegramRateLimiter()
+        self.progress_interval = progress_interval
+        self.done_markup = done_markup
+        self.total = 0
+        self.expected = 0
+        self.sent = 0
+        self.failed = 0
+        self.started_at = 0.0
+
+    async def _produce(self, queue: asyncio.Queue, recipients) -> None:
+        try:
+            if hasattr(recipients, "__aiter__"):
+                async for user_id in recipients:
+                    self.total += 1
+                    await queue.put(user_id)
+            else:
+                for user_id in recipients:
+                    self.total += 1
+                    await queue.put(user_id)
+        finally:
+            # Отправители должны завершиться, даже если источник получателей упал
+            for _ in range(self.concurrency):
+                await queue.put(None)
+
+    async def _worker(self, queue: asyncio.Queue) -> None:
+        while True:
+            user_id = await queue.get()
+            if user_id is None:
+                return
+            try:
+                await send_message_limited(self.bot, self.limiter, user_id, self.text)
+                self.sent += 1
+                await self._on_delivery(user_id, True)
+            except Exception as e:
+                self.failed += 1
+                logger.warning(f"Failed to send to {user_id}: {e}")
+                await self._on_delivery(user_id, False)
+
+    async def _on_delivery(self, user_id: int, ok: bool) -> None:
+        """Точка расширения: результат отправки одному получателю."""
+
+    async def _on_finished(self) -> None:
+        """Точка расширения: все отправители завершили работу."""
+
+    def _progress_text(self, finished: bool) -> str:
+        elapsed = max(time.monotonic() - self.started_at, 0.001)
+        done = self.sent + self.failed
+        if finished:
+            return (
+                f"✅ <b>РАССЫЛКА ЗАВЕРШЕНА</b>\n\n"
+                f"✅ Отправлено: {self.sent}\n"
+                f"❌ Ошибок: {self.failed}\n"
+                f"📊 Всего: {self.total}\n"
+                f"⏱ Время: {elapsed:.0f} с"
+            )
+        return (
+            f"📤 <b>РАССЫЛКА ИДЕТ</b>\n\n"
+            f"Обработано: {done} из {max(self.expected, self.total)}\n"
+            f"✅ Отправлено: {self.sent}\n"
+            f"❌ Ошибок: {self.failed}\n"
+            f"⚡ Скорость: {done / elapsed:.1f} сообщ./с"
+        )
+
+    async def _report(self, finished: bool = False, text: Optional[str] = None) -> None:
+        if self.status_chat_id is None or self.status_message_id is None:
+            return
+        try:
+            await self.bot.edit_message_text(
+                text or self._progress_text(finished),
+                chat_id=self.status_chat_id,
+                message_id=self.status_message_id,
+                reply_markup=self.done_markup if finished else None,
+                parse_mode="HTML",
+            )
+        except Exception as e:
+            # "message is not modified" и прочие ошибки отчета не должны ронять рассылку
+            logger.debug(f"Broadcast progress update skipped: {e}")
+
+    async def _report_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            await self._report()
+
+    async def run(self, recipients: Union[Iterable[int], AsyncIterable[int]]) -> Dict:
+        self.started_at = time.monotonic()
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency * 4)
+        reporter = asyncio.create_task(self._report_periodically())
+        try:
+            await asyncio.gather(
+                self._produce(queue, recipients),
+                *(self._worker(queue) for _ in range(self.concurrency)),
+            )
+        finally:
+            reporter.cancel()
+
+        await self._on_finished()
+        await self._report(finished=True)
+        logger.info(
+            f"Broadcast completed: {self.sent} sent, {self.failed} failed "
+            f"in {time.monotonic() - self.started_at:.1f}s"
+        )
+        return {"sent": self.sent, "failed": self.failed, "total": self.total}
+
+
+class BroadcastJob(BroadcastEngine):
+    """
+    Рассылка, сохраненная в broadcast_jobs / broadcast_deliveries.
+    Получатели читаются из users пачками по user_id, результаты
+    фиксируются пачками. Пользователь резервируется до отправки, поэтому
+    при падении посреди пачки сообщение может не дойти, но не уйдет дважды.
+    """
+
+    def __init__(self, bot: Bot, job: Dict, **kwargs) -> None:
+        super().__init__(
+            bot,
+            job["text"],
+            status_chat_id=job.get("status_chat_id"),
+            status_message_id=job.get("status_message_id"),
+            **kwargs,
+        )
+        self.job_id = job["id"]
+        self.expected = job.get("total", 0)
+        self.sent = job.get("sent", 0)
+        self.failed = job.get("failed", 0)
+        self.total = self.sent + self.failed
+        self.batch_size = BROADCAST_BATCH_SIZE
+        self._results: List[Tuple[int, str]] = []
+
+    async def _recipients(self):
+        while True:
+            user_ids = await reserve_broadcast_recipients(self.job_id, self.batch_size)
+            if not user_ids:
+                return
+            for user_id in user_ids:
+                yield user_id
+
+    async def _on_delivery(self, user_id: int, ok: bool) -> None:
+        self._results.append((user_id, "sent" if ok else "failed"))
+        if len(self._results) >= self.batch_size:
+            await self._checkpoint()
+
+    async def _checkpoint(self, final: bool = False) -> None:
+        """
+        Фиксирует накопленные результаты. При ошибке они возвращаются в
+        очередь и уходят со следующей пачкой; ошибка последней фиксации
+        пробрасывается - задание остается незавершенным и продолжится
+        после перезапуска.
+        """
+        results, self._results = self._results, []
+        try:
+            await record_broadcast_results(self.job_id, results)
+        except Exception as e:
+            self._results = results + self._results
+            logger.error(f"Broadcast {self.job_id}: failed to checkpoint results: {e}")
+            if final:
+                raise
+
+    async def _on_finished(self) -> None:
+        await self._checkpoint(final=True)
+        counts = await finish_broadcast_job(self.job_id)
+        self.sent, self.failed = counts["sent"], counts["failed"]
+
+    def _interrupted_text(self) -> str:
+        return (
+            f"⚠️ <b>РАССЫЛКА ПРЕРВАНА</b>\n\n"
+            f"Обработано: {self.sent + self.failed} из {max(self.expected, self.total)}\n"
+            f"✅ Отправлено: {self.sent}\n"
+            f"❌ Ошибок: {self.failed}\n\n"
+            f"Результаты не удалось сохранить, рассылка продолжится после перезапуска бота."
+        )
+
+    async def run(self, recipients=None) -> Dict:
+        try:
+            return await super().run(self._recipients() if recipients is None else recipients)
+        except Exception:
+            # Задание осталось незавершенным: иначе статус так и висел бы на "идет"
+            await self._report(finished=True, text=self._interrupted_text())
+            raise
+
+
+def _on_broadcast_done(task: asyncio.Task) -> None:
+    _running.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Broadcast failed", exc_info=task.exception())
+
+
+def launch_broadcast(engine: BroadcastEngine, recipients=None) -> asyncio.Task:
+    """Запускает рассылку в фоне и возвращает задачу (ошибка рассылки пишется в лог)."""
+    task = asyncio.create_task(engine.run(recipients))
+    _running.add(task)
+    task.add_done_callback(_on_broadcast_done)
+    return task
+
+
+async def resume_broadcasts(bot: Bot, **kwargs) -> int:
+    """Продолжает рассылки, прерванные перезапуском бота."""
+    jobs = await get_unfinished_broadcast_jobs()
+    for job in jobs:
+        logger.info(
+            f"🔁 Resuming broadcast {job['id']} after user_id {job['last_user_id']} "
+            f"({job['sent']} sent, {job['failed']} failed so far)"
+        )
+        launch_broadcast(BroadcastJob(bot, job, **kwargs))
+    return len(jobs)
@@ -0,0 +1,85 @@
+"""
+Темы оттока: частоты терминов в причинах отмен по дням.
+
+Фоновая задача читает отмены после отметки job_state.cancellation_terms,
+разбивает причины на термины и прибавляет их к cancellation_terms
+(день, термин) -> сколько причин за день содержат термин. Пачка, счетчики и
+новая отметка пишутся одной транзакцией, поэтому повторный запуск после
+сбоя ничего не посчитает дважды. Отмены только добавляются, удаленные
+строки из частот не вычитаются.
+
+Топ тем за окно дат - сумма по первичному ключу (day, term), тексты причин
+при этом не читаются (см. Storage.churn_themes). Разбор текста здесь,
+хранение частот - в хранилище (Storage.index_cancellation_terms).
+"""
+
+import asyncio
+import logging
+import re
+from typing import Dict, List
+
+import storage
+from config import CHURN_TERMS_BATCH_SIZE, CHURN_TERMS_INTERVAL_MIN
+
+logger = logging.getLogger(__name__)
+
+MIN_TERM_LENGTH = 3
+MAX_TERM_LENGTH = 32
+
+# Слова без смысловой нагрузки в причинах отмен
+STOPWORDS = frozenset(
+    """
+    без больше был была были было быть вам вас весь все всего всех где
+    даже для его еще если есть зачем здесь или как какой когда кто меня
+    мне мной могу может мой моя нам нас нет них ничего однако она они оно
+    очень пока потом потому почему при про просто раз так также там тебе
+    тем теперь только тоже тут уже хочу чем через что чтобы эта эти это
+    этого этой этот сейчас будет вот совсем пожалуйста спасибо
+    подписка подписки подписку подписке подпиской отменить отменяю отмена
+    the and for not but you are was with this that have too its just
+    """.split()
+)
+
+_WORD_RE = re.compile(r"[^\W\d_]+")
+
+
+def tokenize(text: str) -> List[str]:
+    """Уникальные термины причины: слова в нижнем регистре (ё -> е) без стоп-слов."""
+    terms = []
+    seen = set()
+    for word in _WORD_RE.findall(text.lower().replace("ё", "е")):
+        if len(word) < MIN_TERM_LENGTH or word in STOPWORDS:
+            continue
+        # Длинные слова с общим началом дают один термин, он считается один раз
+        term = word[:MAX_TERM_LENGTH]
+        if term in seen:
+            continue
+        seen.add(term)
+        terms.append(term)
+    return terms
+
+
+async def catch_up(batch_size: int = CHURN_TERMS_BATCH_SIZE) -> Dict:
+    """Индексирует все новые отмены пачками. Возвращает {"reasons", "batches"}."""
+    report = {"reasons": 0, "batches": 0}
+    while True:
+        processed = await storage.index_cancellation_terms(batch_size, tokenize)
+        if processed:
+            report["reasons"] += processed
+            report["batches"] += 1
+        if processed < batch_size:
+            return report
+        # Между пачками отдаем очередь записи оплатам и планировщику
+        await asyncio.sleep(0)
+
+
+async def churn_terms_indexer(interval_min: int = CHURN_TERMS_INTERVAL_MIN) -> None:
+    """Фоновая задача: раз в interval_min минут дописывает частоты новых причин."""
+    while True:
+        try:
+            report = await catch_up()
+            if report["reasons"]:
+                logger.info(f"🏷 Темы оттока: проиндексировано причин {report['reasons']}")
+        except Exception as e:
+            logger.error(f"Churn terms indexer error: {e}", exc_info=True)
+        await asyncio.sleep(interval_min * 60)
@@ -29,6 +29,12 @@ STRIPE_WEBHOOK_SECRET: str = os.getenv("STRIPE_WEBHOOK_SECRET", "")
 STRIPE_PRICE_ID: str = os.getenv("STRIPE_PRICE_ID", "")
 STRIPE_SUCCESS_URL: str = os.getenv("STRIPE_SUCCESS_URL", "https://t.me/")
 STRIPE_CANCEL_URL: str = os.getenv("STRIPE_CANCEL_URL", "https://t.me/")
+STRIPE_TIMEOUT: float = float(os.getenv("STRIPE_TIMEOUT", "15"))
+STRIPE_MAX_CONCURRENCY: int = int(os.getenv("STRIPE_MAX_CONCURRENCY", "8"))
+# Срок жизни Checkout Session в Stripe (от 30 минут до 24 часов)
+STRIPE_SESSION_TTL: int = int(os.getenv("STRIPE_SESSION_TTL", str(23 * 3600)))
+# Запас до истечения сессии, после которого ссылка больше не переиспользуется
+STRIPE_SESSION_REUSE_MARGIN: int = int(os.getenv("STRIPE_SESSION_REUSE_MARGIN", "1800"))
 
 # ==================== SUBSCRIPTION ====================
 SUBSCRIPTION_PRICE: float = float(os.getenv("SUBSCRIPTION_PRICE", "19"))
@@ -38,13 +44,57 @@ SUBSCRIPTION_CHECK_HOUR: int = int(os.getenv("SUBSCRIPTION_CHECK_HOUR", "12"))
 SUBSCRIPTION_CHECK_TZ_OFFSET: int = int(
     os.getenv("SUBSCRIPTION_CHECK_TZ_OFFSET", "0")
 )
+# Размер страницы фоновых задач по подпискам (предупреждения, исключения)
+SUBSCRIPTION_BATCH_SIZE: int = int(os.getenv("SUBSCRIPTION_BATCH_SIZE", "200"))
+
+# ==================== BROADCAST ====================
+# Telegram: ~30 сообщений в секунду на бота и ~1 в секунду в один чат
+TELEGRAM_GLOBAL_RATE: float = float(os.getenv("TELEGRAM_GLOBAL_RATE", "25"))
+TELEGRAM_PER_CHAT_INTERVAL: float = float(os.getenv("TELEGRAM_PER_CHAT_INTERVAL", "1"))
+BROADCAST_CONCURRENCY: int = int(os.getenv("BROADCAST_CONCURRENCY", "8"))
+BROADCAST_PROGRESS_INTERVAL: float = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", "5"))
+BROADCAST_BATCH_SIZE: int = int(os.getenv("BROADCAST_BATCH_SIZE", "500"))
 
 # ==================== SUPPORT ====================
 SUPPORT_USERNAME: str = os.getenv("SUPPORT_USERNAME", "@support")
 SUPPORT_USER_ID: int = int(os.getenv("SUPPORT_USER_ID", "0"))
 
 # ==================== DATABASE ====================
+# Хранилище: пусто - SQLite в DATABASE_PATH, postgresql://... - PostgreSQL (asyncpg)
+DATABASE_URL: str = os.getenv("DATABASE_URL", "")
 DATABASE_PATH: str = os.getenv("DATABASE_PATH", "data/bot.db")
+DATABASE_POOL_SIZE: int = int(os.getenv("DATABASE_POOL_SIZE", "4"))
+DATABASE_BUSY_TIMEOUT_MS: int = int(os.getenv("DATABASE_BUSY_TIMEOUT_MS", "5000"))
+SUBSCRIPTION_CACHE_TTL: int = int(os.getenv("SUBSCRIPTION_CACHE_TTL", "300"))
+SUBSCRIPTION_CACHE_SIZE: int = int(os.getenv("SUBSCRIPTION_CACHE_SIZE", "10000"))
+# Групповой коммит: сколько запросов на запись максимум в одной транзакции
+DATABASE_WRITE_BATCH_SIZE: int = int(os.getenv("DATABASE_WRITE_BATCH_SIZE", "256"))
+# Write-behind для пользователей: сброс раз в N мс или при M изменениях
+USER_WRITE_FLUSH_MS: int = int(os.getenv("USER_WRITE_FLUSH_MS", "200"))
+USER_WRITE_BATCH_SIZE: int = int(os.getenv("USER_WRITE_BATCH_SIZE", "500"))
+USER_FINGERPRINT_CACHE_SIZE: int = int(os.getenv("USER_FINGERPRINT_CACHE_SIZE", "50000"))
+# Отчеты и экспорт админки: потоков с read-only соединениями
+ANALYTICS_MAX_WORKERS: int = int(os.getenv("ANALYTICS_MAX_WORKERS", "2"))
+# Темы оттока: как часто индексировать новые причины отмен и сколько за транзакцию
+CHURN_TERMS_INTERVAL_MIN: int = int(os.getenv("CHURN_TERMS_INTERVAL_MIN", "10"))
+CHURN_TERMS_BATCH_SIZE: int = int(os.getenv("CHURN_TERMS_BATCH_SIZE", "500"))
+# PostgreSQL: размер пула соединений и часовой пояс для дневной статистики
+# (пусто - TZ процесса, как localtime в SQLite)
+POSTGRES_POOL_MIN: int = int(os.getenv("POSTGRES_POOL_MIN", "2"))
+POSTGRES_POOL_MAX: int = int(os.getenv("POSTGRES_POOL_MAX", "10"))
+POSTGRES_TIMEZONE: str = os.getenv("POSTGRES_TIMEZONE", "")
+# FSM-диалоги в БД: через сколько часов брошенное состояние удаляется, сколько
+# ключей держать в памяти, сколько секунд верить кэшу (0 - при нескольких
+# процессах бота) и как часто сбрасывать изменения
+FSM_STATE_TTL_HOURS: int = int(os.getenv("FSM_STATE_TTL_HOURS", "24"))
+FSM_CACHE_SIZE: int = int(os.getenv("FSM_CACHE_SIZE", "10000"))
+FSM_CACHE_SECONDS: int = int(os.getenv("FSM_CACHE_SECONDS", "300"))
+FSM_FLUSH_MS: int = int(os.getenv("FSM_FLUSH_MS", "100"))
+# Бекап: страниц за шаг backup API и пауза между шагами
+BACKUP_PAGES_PER_STEP: int = int(os.getenv("BACKUP_PAGES_PER_STEP", "1024"))
+BACKUP_STEP_PAUSE_MS: int = int(os.getenv("BACKUP_STEP_PAUSE_MS", "5"))
+# Сжимать выгрузку пользователей в gzip
+EXPORT_GZIP: bool = os.getenv("EXPORT_GZIP", "false").lower() in ("1", "true", "yes")
 
 # ==================== SSL ====================
 SSL_CERT_PATH: str = os.getenv(
@@ -98,6 +148,56 @@ def validate_config() -> bool:
     if not STRIPE_WEBHOOK_SECRET:
         logger.warning("⚠️ STRIPE_WEBHOOK_SECRET не установлен, подпись webhook не проверяется")
 
+    if STRIPE_TIMEOUT <= 0:
+        raise ValueError("STRIPE_TIMEOUT должен быть больше 0")
+    if STRIPE_MAX_CONCURRENCY < 1:
+        raise ValueError("STRIPE_MAX_CONCURRENCY должен быть не меньше 1")
+
+    if STRIPE_SESSION_TTL < 1800 or STRIPE_SESSION_TTL > 86400:
+        raise ValueError("STRIPE_SESSION_TTL должен быть в диапазоне 1800..86400 секунд")
+    if STRIPE_SESSION_REUSE_MARGIN < 0 or STRIPE_SESSION_REUSE_MARGIN >= STRIPE_SESSION_TTL:
+        raise ValueError("STRIPE_SESSION_REUSE_MARGIN должен быть меньше STRIPE_SESSION_TTL")
+
+    if TELEGRAM_GLOBAL_RATE <= 0:
+        raise ValueError("TELEGRAM_GLOBAL_RATE должен быть больше 0")
+    if BROADCAST_CONCURRENCY < 1:
+        raise ValueError("BROADCAST_CONCURRENCY должен быть не меньше 1")
+    if BROADCAST_BATCH_SIZE < 1:
+        raise ValueError("BROADCAST_BATCH_SIZE должен быть не меньше 1")
+
+    if DATABASE_URL and not DATABASE_URL.startswith(("postgres://", "postgresql://")):
+        raise ValueError("DATABASE_URL должен начинаться с postgresql:// (или быть пустым для SQLite)")
+    if DATABASE_POOL_SIZE < 1:
+        raise ValueError("DATABASE_POOL_SIZE должен быть не меньше 1")
+    if POSTGRES_POOL_MIN < 1 or POSTGRES_POOL_MAX < POSTGRES_POOL_MIN:
+        raise ValueError("Нужно 1 <= POSTGRES_POOL_MIN <= POSTGRES_POOL_MAX")
+    if DATABASE_WRITE_BATCH_SIZE < 1:
+        raise ValueError("DATABASE_WRITE_BATCH_SIZE должен быть не меньше 1")
+    if USER_WRITE_FLUSH_MS < 1:
+        raise ValueError("USER_WRITE_FLUSH_MS должен быть не меньше 1")
+    if USER_WRITE_BATCH_SIZE < 1:
+        raise ValueError("USER_WRITE_BATCH_SIZE должен быть не меньше 1")
+    if ANALYTICS_MAX_WORKERS < 1:
+        raise ValueError("ANALYTICS_MAX_WORKERS должен быть не меньше 1")
+    if CHURN_TERMS_INTERVAL_MIN < 1:
+        raise ValueError("CHURN_TERMS_INTERVAL_MIN должен быть не меньше 1")
+    if CHURN_TERMS_BATCH_SIZE < 1:
+        raise ValueError("CHURN_TERMS_BATCH_SIZE должен быть не меньше 1")
+    if FSM_STATE_TTL_HOURS < 1:
+        raise ValueError("FSM_STATE_TTL_HOURS должен быть не меньше 1")
+    if FSM_CACHE_SIZE < 1:
+        raise ValueError("FSM_CACHE_SIZE должен быть не меньше 1")
+    if FSM_CACHE_SECONDS < 0:
+        raise ValueError("FSM_CACHE_SECONDS не может быть отрицательным")
+    if FSM_FLUSH_MS < 1:
+        raise ValueError("FSM_FLUSH_MS должен быть не меньше 1")
+    if BACKUP_PAGES_PER_STEP < 1:
+        raise ValueError("BACKUP_PAGES_PER_STEP должен быть не меньше 1")
+    if BACKUP_STEP_PAUSE_MS < 0:
+        raise ValueError("BACKUP_STEP_PAUSE_MS не может быть отрицательным")
+
+    if SUBSCRIPTION_BATCH_SIZE < 1:
+        raise ValueError("SUBSCRIPTION_BATCH_SIZE должен быть не меньше 1")
     if SUBSCRIPTION_CHECK_HOUR < 0 or SUBSCRIPTION_CHECK_HOUR > 23:
         raise ValueError("SUBSCRIPTION_CHECK_HOUR должен быть в диапазоне 0-23")
     if SUBSCRIPTION_CHECK_TZ_OFFSET < -23 or SUBSCRIPTION_CHECK_TZ_OFFSET > 23:
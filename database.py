@@ -1,112 +1,725 @@
+import asyncio
 import logging
 import os
+import time
+from array import array
+from collections import OrderedDict
 from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
 
 import aiosqlite
 
-from config import DATABASE_PATH
+from config import (
+    DATABASE_BUSY_TIMEOUT_MS,
+    DATABASE_PATH,
+    DATABASE_POOL_SIZE,
+    DATABASE_WRITE_BATCH_SIZE,
+    SUBSCRIPTION_CACHE_SIZE,
+    SUBSCRIPTION_CACHE_TTL,
+    USER_FINGERPRINT_CACHE_SIZE,
+    USER_WRITE_BATCH_SIZE,
+    USER_WRITE_FLUSH_MS,
+)
+from migrations import COUNTER_SOURCES_SQL, counter_drift, run_migrations
+from records import (
+    SUBSCRIPTION_COLUMNS,
+    USER_COLUMNS,
+    ExpiryColumns,
+    ExpiryRecord,
+    SubscriptionRecord,
+    UserRecord,
+    expiry_factory,
+    subscription_factory,
+    user_factory,
+    users_page_result,
+)
+from rollups import DAILY_STATS_SQL, RECENT_COLUMNS, SERIES_WINDOWS, build_series, series_start
 
 logger = logging.getLogger(__name__)
 
 
+def to_epoch(value: datetime) -> int:
+    """Временные метки в БД - INTEGER, секунды Unix."""
+    return int(value.timestamp())
+
+
+def from_epoch(value: Optional[int]) -> Optional[datetime]:
+    return datetime.fromtimestamp(value) if value is not None else None
+
+
+class ConnectionPool:
+    """
+    Пул долгоживущих соединений: фиксированный набор читателей и один писатель.
+    PRAGMA применяются один раз при открытии каждого соединения.
+    """
+
+    def __init__(self, path: str, readers: int = DATABASE_POOL_SIZE) -> None:
+        self.path = path
+        self.size = readers
+        self._readers: asyncio.Queue = asyncio.Queue()
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._writer_lock = asyncio.Lock()
+        self._connections: List[aiosqlite.Connection] = []
+        self.checkouts = 0
+        self.waits = 0
+        self.in_flight = 0
+
+    async def _connect(self, query_only: bool = False) -> aiosqlite.Connection:
+        db = await aiosqlite.connect(self.path)
+        db.row_factory = aiosqlite.Row
+        await db.execute("PRAGMA journal_mode=WAL")
+        await db.execute("PRAGMA synchronous=NORMAL")
+        await db.execute(f"PRAGMA busy_timeout={int(DATABASE_BUSY_TIMEOUT_MS)}")
+        if query_only:
+            await db.execute("PRAGMA query_only=ON")
+        self._connections.append(db)
+        return db
+
+    async def open(self) -> None:
+        self._writer = await self._connect()
+        for _ in range(self.size):
+            self._readers.put_nowait(await self._connect(query_only=True))
+
+    async def close(self) -> None:
+        for db in self._connections:
+            try:
+                await db.close()
+            except Exception as e:
+                logger.warning(f"Failed to close DB connection: {e}")
+        self._connections.clear()
+        self._writer = None
+
+    @asynccontextmanager
+    async def reader(self):
+        if self._readers.empty():
+            self.waits += 1
+        db = await self._readers.get()
+        self.checkouts += 1
+        self.in_flight += 1
+        try:
+            yield db
+        finally:
+            self.in_flight -= 1
+            self._readers.put_nowait(db)
+
+    @asynccontextmanager
+    async def writer(self):
+        if self._writer_lock.locked():
+            self.waits += 1
+        async with self._writer_lock:
+            self.checkouts += 1
+            self.in_flight += 1
+            try:
+                yield self._writer
+            finally:
+                self.in_flight -= 1
+                # Незакоммиченные изменения не должны достаться следующему вызову
+                if self._writer is not None and self._writer.in_transaction:
+                    await self._writer.rollback()
+
+    def stats(self) -> Dict:
+        return {
+            "readers": self.size,
+            "idle_readers": self._readers.qsize(),
+            "in_flight": self.in_flight,
+            "checkouts": self.checkouts,
+            "waits": self.waits,
+        }
+
+
+class TTLCache:
+    """
+    LRU-кэш с ограничением времени жизни записей.
+    Поколение растет при каждой инвалидации: значение, прочитанное до записи
+    в БД, не попадет в кэш после нее.
+    """
+
+    _MISSING = object()
+
+    def __init__(self, maxsize: int, ttl: float) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=_MISSING):
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        value, expires = item
+        if expires <= time.monotonic():
+            del self._data[key]
+            self.evictions += 1
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value, generation: int) -> None:
+        if generation != self.generation or self.maxsize <= 0:
+            return
+        self._data[key] = (value, time.monotonic() + self.ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key) -> None:
+        self.generation += 1
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self.generation += 1
+        self._data.clear()
+
+    def stats(self) -> Dict:
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+WriteOp = Callable[[aiosqlite.Connection], Awaitable[Any]]
+
+
+class WriteQueue:
+    """
+    Единственный писатель: все изменения БД проходят через очередь.
+
+    Фоновая задача забирает из очереди все накопившиеся запросы (не больше
+    max_batch) и выполняет их в одной транзакции, каждый в своем SAVEPOINT:
+    ошибка одного запроса откатывает только его. Future вызывающего
+    разрешается после COMMIT, в который попал его запрос. Пока идет коммит,
+    в очереди копится следующая пачка, поэтому под нагрузкой транзакций
+    становится меньше, а не больше.
+    """
+
+    def __init__(self, max_batch: int = DATABASE_WRITE_BATCH_SIZE) -> None:
+        self.max_batch = max_batch
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._pool: Optional[ConnectionPool] = None
+        self.reset_stats()
+
+    def reset_stats(self) -> None:
+        self.requests = 0
+        self.failed = 0
+        self.batches = 0
+        self.failed_batches = 0
+        self.max_batch_seen = 0
+        self.last_batch = 0
+        self.max_depth = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def start(self, pool: ConnectionPool) -> None:
+        if self._task is None:
+            self._pool = pool
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Выполняет все, что уже в очереди, и останавливает писателя."""
+        if self._task is None:
+            return
+        task, self._task = self._task, None
+        self._queue.put_nowait(None)
+        await task
+
+    async def submit(self, op: WriteOp) -> Any:
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((op, future))
+        self.max_depth = max(self.max_depth, self._queue.qsize())
+        return await future
+
+    async def _run(self) -> None:
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            stopping = False
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._commit_batch(batch)
+            if stopping:
+                return
+
+    async def _commit_batch(self, batch: List[tuple]) -> None:
+        batch = [(op, future) for op, future in batch if not future.cancelled()]
+        if not batch:
+            return
+        outcomes = []
+        try:
+            async with self._pool.writer() as db:
+                await db.execute("BEGIN IMMEDIATE")
+                for op, future in batch:
+                    await db.execute("SAVEPOINT write_request")
+                    try:
+                        result = await op(db)
+                    except Exception as e:
+                        await db.execute("ROLLBACK TO write_request")
+                        await db.execute("RELEASE write_request")
+                        outcomes.append((future, e, None))
+                    else:
+                        await db.execute("RELEASE write_request")
+                        outcomes.append((future, None, result))
+                await db.commit()
+        except Exception as e:
+            # Транзакция не зафиксирована: ошибка у всех запросов пачки
+            logger.error(f"Write batch of {len(batch)} failed: {e}", exc_info=True)
+            self.failed_batches += 1
+            self.failed += len(batch)
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        self.batches += 1
+        self.requests += len(batch)
+        self.last_batch = len(batch)
+        self.max_batch_seen = max(self.max_batch_seen, len(batch))
+        for future, error, result in outcomes:
+            if error is not None:
+                self.failed += 1
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def stats(self) -> Dict:
+        return {
+            "depth": self.depth,
+            "max_depth": self.max_depth,
+            "requests": self.requests,
+            "failed": self.failed,
+            "batches": self.batches,
+            "failed_batches": self.failed_batches,
+            "last_batch": self.last_batch,
+            "max_batch": self.max_batch_seen,
+            "avg_batch": round(self.requests / self.batches, 2) if self.batches else 0,
+        }
+
+
+class UserWriteBuffer:
+    """
+    Write-behind для users: upsert профиля и отметка о попытке оплаты.
+
+    Отпечаток (username, first_name, has_payment_attempt) последнего
+    известного состояния пользователя позволяет пропускать пустые
+    upsert-ы. Реальные изменения копятся в буфере и записываются одной
+    транзакцией через executemany раз в flush_interval или при
+    накоплении max_rows изменений. Запросы к users (get_db(flush_users=True)),
+    run_write() и get_write_db() сначала сбрасывают буфер, поэтому видят
+    все изменения; остальные чтения буфер не трогают.
+    """
+
+    def __init__(
+        self,
+        flush_interval: float = USER_WRITE_FLUSH_MS / 1000,
+        max_rows: int = USER_WRITE_BATCH_SIZE,
+        fingerprints: int = USER_FINGERPRINT_CACHE_SIZE,
+    ) -> None:
+        self.flush_interval = flush_interval
+        self.max_rows = max_rows
+        self.max_fingerprints = fingerprints
+        self._fingerprints: OrderedDict = OrderedDict()
+        self._users: Dict[int, tuple] = {}
+        self._attempts: set = set()
+        self._task: Optional[asyncio.Task] = None
+        self.clear()
+
+    @property
+    def pending(self) -> int:
+        return len(self._users) + len(self._attempts)
+
+    def fingerprint(self, user_id: int) -> Optional[tuple]:
+        fp = self._fingerprints.get(user_id)
+        if fp is not None:
+            self._fingerprints.move_to_end(user_id)
+        return fp
+
+    def remember(self, user_id: int, username: str, first_name: str, has_attempt: Optional[bool]) -> None:
+        self._fingerprints[user_id] = (username, first_name, has_attempt)
+        self._fingerprints.move_to_end(user_id)
+        while len(self._fingerprints) > self.max_fingerprints:
+            self._fingerprints.popitem(last=False)
+
+    def stage_user(self, user_id: int, username: str, first_name: str) -> bool:
+        """Ставит upsert в буфер. False - профиль не изменился, писать нечего."""
+        fp = self.fingerprint(user_id)
+        if fp is not None and fp[:2] == (username, first_name):
+            self.skipped += 1
+            return False
+        self._users[user_id] = (username, first_name)
+        self.remember(user_id, username, first_name, fp[2] if fp else None)
+        self._staged()
+        return True
+
+    def stage_payment_attempt(self, user_id: int) -> bool:
+        fp = self.fingerprint(user_id)
+        if fp is not None and fp[2]:
+            self.skipped += 1
+            return False
+        self._attempts.add(user_id)
+        if fp is not None:
+            self.remember(user_id, fp[0], fp[1], True)
+        self._staged()
+        return True
+
+    def has_pending_user(self, user_id: int) -> bool:
+        return user_id in self._users
+
+    def has_pending_attempt(self, user_id: int) -> bool:
+        return user_id in self._attempts
+
+    def _staged(self) -> None:
+        self.staged += 1
+        self._wakeup.set()
+        if self.pending >= self.max_rows:
+            self._full.set()
+
+    async def commit_now_if_idle(self) -> None:
+        """Без фоновой задачи (скрипты, тесты без init_db) пишем сразу."""
+        if self._task is None:
+            await self.flush()
+
+    async def flush(self) -> int:
+        """Записывает накопленные изменения одной транзакцией."""
+        async with self._flush_lock:
+            if not self.pending:
+                return 0
+            users, self._users = self._users, {}
+            attempts, self._attempts = self._attempts, set()
+
+            async def write(db):
+                await db.executemany(
+                    """
+                    INSERT INTO users (user_id, username, first_name)
+                    VALUES (?, ?, ?)
+                    ON CONFLICT(user_id) DO UPDATE SET
+                        username = COALESCE(excluded.username, username),
+                        first_name = COALESCE(excluded.first_name, first_name)
+                    """,
+                    [(user_id, *profile) for user_id, profile in users.items()],
+                )
+                await db.executemany(
+                    "UPDATE users SET has_payment_attempt = TRUE WHERE user_id = ?",
+                    [(user_id,) for user_id in attempts],
+                )
+
+            try:
+                await _submit_write(write)
+            except BaseException:
+                # Вернуть в буфер; более новые изменения того же пользователя важнее
+                for user_id, profile in users.items():
+                    self._users.setdefault(user_id, profile)
+                self._attempts |= attempts
+                raise
+            rows = len(users) + len(attempts)
+            self.flushes += 1
+            self.rows_flushed += rows
+            return rows
+
+    async def _run(self) -> None:
+        while True:
+            await self._wakeup.wait()
+            if not self._full.is_set():
+                try:
+                    await asyncio.wait_for(self._full.wait(), timeout=self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            self._wakeup.clear()
+            self._full.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"User write-behind flush failed: {e}", exc_info=True)
+                await asyncio.sleep(self.flush_interval)
+            if self.pending:
+                self._wakeup.set()
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Останавливает фоновый сброс и записывает все, что осталось."""
+        if self._task is not None:
+            task, self._task = self._task, None
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+
+    def clear(self) -> None:
+        """Сбрасывает состояние (при init_db, в т.ч. в новом event loop)."""
+        self._fingerprints.clear()
+        self._users.clear()
+        self._attempts.clear()
+        self._flush_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._full = asyncio.Event()
+        self.skipped = self.staged = self.flushes = self.rows_flushed = 0
+
+    def stats(self) -> Dict:
+        return {
+            "pending": self.pending,
+            "staged": self.staged,
+            "skipped": self.skipped,
+            "flushes": self.flushes,
+            "rows_flushed": self.rows_flushed,
+        }
+
+
+_pool: Optional[ConnectionPool] = None
+_subscription_cache = TTLCache(SUBSCRIPTION_CACHE_SIZE, SUBSCRIPTION_CACHE_TTL)
+_write_queue = WriteQueue()
+_user_writes = UserWriteBuffer()
+# Подписчики на изменения подписок: f(user_id, expires_at или None, если подписка не активна)
+_subscription_listeners: List[Callable[[int, Optional[datetime]], None]] = []
+
+
+def add_subscription_listener(listener: Callable[[int, Optional[datetime]], None]) -> None:
+    _subscription_listeners.append(listener)
+
+
+def remove_subscription_listener(listener: Callable[[int, Optional[datetime]], None]) -> None:
+    if listener in _subscription_listeners:
+        _subscription_listeners.remove(listener)
+
+
+def _subscription_changed(user_id: int, expires_at: Optional[datetime]) -> None:
+    _subscription_cache.invalidate(user_id)
+    notify_subscription_listeners(user_id, expires_at)
+
+
+def notify_subscription_listeners(user_id: int, expires_at: Optional[datetime]) -> None:
+    """Оповещает подписчиков об изменении подписки (вызывают все хранилища)."""
+    for listener in list(_subscription_listeners):
+        try:
+            listener(user_id, expires_at)
+        except Exception as e:
+            logger.warning(f"Subscription listener failed for {user_id}: {e}")
+
+
 @asynccontextmanager
-async def get_db():
+async def _connect_once():
+    """Одноразовое соединение, если пул еще не создан (скрипты, тесты)."""
     async with aiosqlite.connect(DATABASE_PATH) as db:
         db.row_factory = aiosqlite.Row
         yield db
 
 
-async def init_db() -> None:
-    os.makedirs(os.path.dirname(DATABASE_PATH), exist_ok=True)
-    async with get_db() as db:
-        await db.execute("PRAGMA journal_mode=WAL")
-        await db.execute("PRAGMA synchronous=NORMAL")
+@asynccontextmanager
+async def _raw_reader():
+    if _pool is None:
+        async with _connect_once() as db:
+            yield db
+        return
+    async with _pool.reader() as db:
+        yield db
 
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                first_name TEXT,
-                join_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                has_payment_attempt BOOLEAN DEFAULT FALSE
-            )
-        """)
-
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS subscriptions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL UNIQUE,
-                expires_at TIMESTAMP NOT NULL,
-                invite_link TEXT,
-                payment_provider TEXT,
-                stripe_customer_id TEXT,
-                stripe_subscription_id TEXT,
-                status TEXT DEFAULT 'active',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
-            )
-        """)
-
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS cancellations (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                username TEXT,
-                reason TEXT NOT NULL,
-                subscription_id TEXT,
-                cancelled_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
-            )
-        """)
-
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS subscription_notifications (
-                user_id INTEGER NOT NULL,
-                notification_type TEXT NOT NULL,
-                sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                PRIMARY KEY (user_id, notification_type)
-            )
-        """)
 
-        await db.execute(
-            "CREATE INDEX IF NOT EXISTS idx_sub_stripe ON subscriptions(stripe_subscription_id)"
-        )
-        await db.execute(
-            "CREATE INDEX IF NOT EXISTS idx_sub_expires ON subscriptions(expires_at)"
-        )
+@asynccontextmanager
+async def _raw_writer():
+    if _pool is None:
+        async with _connect_once() as db:
+            yield db
+        return
+    async with _pool.writer() as db:
+        yield db
+
+
+async def _submit_write(op: WriteOp) -> Any:
+    if _write_queue.running:
+        return await _write_queue.submit(op)
+    async with _raw_writer() as db:
+        result = await op(db)
         await db.commit()
-        logger.info("✅ База данных инициализирована")
+        return result
+
+
+async def run_write(op: WriteOp) -> Any:
+    """
+    Выполняет op(db) через очередь писателя и возвращает его результат
+    после коммита. op не коммитит сам и не обращается к другим функциям
+    записи (писатель занят его же пачкой).
+    """
+    if _user_writes.pending:
+        await _user_writes.flush()
+    return await _submit_write(op)
+
+
+@asynccontextmanager
+async def get_db(flush_users: bool = False):
+    """
+    Соединение для чтения из пула. flush_users=True - для запросов, читающих
+    users (в том числе счетчики и ряды, которые ведут триггеры на users):
+    сначала сбрасываются отложенные записи пользователей.
+    """
+    if flush_users and _user_writes.pending:
+        await _user_writes.flush()
+    async with _raw_reader() as db:
+        yield db
+
+
+@asynccontextmanager
+async def get_write_db():
+    """
+    Монопольный доступ к соединению-писателю (миграции, обслуживание).
+    Обычные изменения идут через run_write().
+    """
+    if _user_writes.pending:
+        await _user_writes.flush()
+    async with _raw_writer() as db:
+        yield db
+
+
+def get_pool_stats() -> Optional[Dict]:
+    return _pool.stats() if _pool else None
+
+
+def get_cache_stats() -> Dict:
+    return _subscription_cache.stats()
+
+
+def get_write_queue_stats() -> Dict:
+    return _write_queue.stats()
+
+
+def get_user_write_stats() -> Dict:
+    return _user_writes.stats()
+
+
+async def flush_user_writes() -> int:
+    """Сбрасывает отложенные записи users (перед бекапом, экспортом и т.п.)."""
+    return await _user_writes.flush()
+
+
+async def close_db() -> None:
+    global _pool
+    try:
+        await _user_writes.stop()
+    except Exception as e:
+        logger.error(f"Failed to flush pending user writes: {e}", exc_info=True)
+    await _write_queue.stop()
+    if _pool is not None:
+        pool, _pool = _pool, None
+        await pool.close()
+        logger.info("🛑 Пул соединений с БД закрыт")
+
+
+async def init_db() -> None:
+    global _pool
+    os.makedirs(os.path.dirname(DATABASE_PATH), exist_ok=True)
+    await close_db()
+    _subscription_cache.clear()
+    _user_writes.clear()
+    _write_queue.reset_stats()
+    pool = ConnectionPool(DATABASE_PATH)
+    await pool.open()
+    _pool = pool
+    async with get_write_db() as db:
+        await run_migrations(db)
+        await _warn_on_full_scans(db)
+    _write_queue.start(pool)
+    _user_writes.start()
+    logger.info("✅ База данных инициализирована")
 
 
 async def save_user(
     user_id: int, username: Optional[str] = None, first_name: Optional[str] = None
 ) -> None:
-    async with get_db() as db:
-        await db.execute(
-            """
-            INSERT INTO users (user_id, username, first_name)
-            VALUES (?, ?, ?)
-            ON CONFLICT(user_id) DO UPDATE SET
-                username = COALESCE(excluded.username, username),
-                first_name = COALESCE(excluded.first_name, first_name)
-        """,
-            (user_id, username or "", first_name or ""),
-        )
-        await db.commit()
+    """Upsert пользователя через write-behind буфер (неизмененный профиль не пишется)."""
+    if _user_writes.stage_user(user_id, username or "", first_name or ""):
+        await _user_writes.commit_now_if_idle()
+
+
+async def load_user_context(
+    user_id: int, username: Optional[str] = None, first_name: Optional[str] = None
+) -> Dict:
+    """
+    Сохраняет пользователя и возвращает все, что нужно для выбора главного меню.
+    Для вернувшегося пользователя с тем же профилем и подпиской в кэше
+    обращений к БД нет совсем; изменения профиля уходят в write-behind буфер.
+    """
+    cached = _subscription_cache.get(user_id)
+    generation = _subscription_cache.generation
+    fp = _user_writes.fingerprint(user_id)
+
+    if fp is None or fp[2] is None or cached is TTLCache._MISSING:
+        async with _raw_reader() as db:
+            async with db.execute(
+                f"""
+                SELECT u.username AS u_username, u.first_name AS u_first_name,
+                       u.has_payment_attempt, {SUBSCRIPTION_COLUMNS}
+                FROM (SELECT ? AS id) q
+                LEFT JOIN users u ON u.user_id = q.id
+                LEFT JOIN subscriptions s ON s.user_id = q.id
+                """,
+                (user_id,),
+            ) as cursor:
+                row = await cursor.fetchone()
+        if cached is TTLCache._MISSING:
+            cached = SubscriptionRecord._make(tuple(row)[3:]) if row["status"] is not None else None
+            _subscription_cache.put(user_id, cached, generation)
+        if fp is None or fp[2] is None:
+            has_attempt = bool(row["has_payment_attempt"]) or _user_writes.has_pending_attempt(user_id)
+            if fp is not None:
+                _user_writes.remember(user_id, fp[0], fp[1], has_attempt)
+            elif row["has_payment_attempt"] is not None and not _user_writes.has_pending_user(user_id):
+                _user_writes.remember(
+                    user_id, row["u_username"] or "", row["u_first_name"] or "", has_attempt
+                )
+            fp = _user_writes.fingerprint(user_id)
+
+    await save_user(user_id, username, first_name)
+    has_attempt = bool(fp and fp[2]) or _user_writes.has_pending_attempt(user_id)
+
+    sub = cached
+    return {
+        "user_id": user_id,
+        "has_payment_attempt": has_attempt,
+        "status": sub.status if sub else None,
+        "expires_at": sub.expires_at if sub else None,
+        "is_active": sub.is_active() if sub else False,
+    }
 
 
 async def mark_payment_attempt(user_id: int) -> None:
-    async with get_db() as db:
-        await db.execute(
-            "UPDATE users SET has_payment_attempt = TRUE WHERE user_id = ?", (user_id,)
-        )
-        await db.commit()
+    """Отметка о попытке оплаты через write-behind буфер."""
+    if _user_writes.stage_payment_attempt(user_id):
+        await _user_writes.commit_now_if_idle()
 
 
 async def has_payment_attempt(user_id: int) -> bool:
-    async with get_db() as db:
+    async with get_db(flush_users=True) as db:
         async with db.execute(
             "SELECT has_payment_attempt FROM users WHERE user_id = ?", (user_id,)
         ) as cursor:
@@ -114,31 +727,35 @@ async def has_payment_attempt(user_id: int) -> bool:
             return bool(row and row[0]) if row else False
 
 
-async def get_subscription(user_id: int) -> Optional[Dict]:
-    async with get_db() as db:
-        async with db.execute(
-            "SELECT * FROM subscriptions WHERE user_id = ? ORDER BY created_at DESC LIMIT 1",
-            (user_id,),
-        ) as cursor:
-            row = await cursor.fetchone()
-            if row:
-                return {
-                    "user_id": row["user_id"],
-                    "expires_at": datetime.fromisoformat(row["expires_at"]),
-                    "invite_link": row["invite_link"],
-                    "payment_provider": row["payment_provider"],
-                    "stripe_customer_id": row["stripe_customer_id"],
-                    "stripe_subscription_id": row["stripe_subscription_id"],
-                    "status": row["status"],
-                }
-            return None
+async def _fetch_all(sql: str, params, factory, flush_users: bool = False) -> list:
+    """Строки запроса, собранные factory(cursor, row) без aiosqlite.Row (None - кортежи)."""
+    async with get_db(flush_users) as db:
+        async with db.execute(sql, params) as cursor:
+            cursor.row_factory = factory
+            return await cursor.fetchall()
+
+
+async def get_subscription(user_id: int) -> Optional[SubscriptionRecord]:
+    cached = _subscription_cache.get(user_id)
+    if cached is not TTLCache._MISSING:
+        return cached
+
+    generation = _subscription_cache.generation
+    rows = await _fetch_all(
+        f"SELECT {SUBSCRIPTION_COLUMNS} FROM subscriptions s "
+        "WHERE s.user_id = ? ORDER BY s.created_at DESC LIMIT 1",
+        (user_id,),
+        subscription_factory,
+    )
+    sub = rows[0] if rows else None
+    # Записи неизменяемы, поэтому из кэша отдаются без копирования
+    _subscription_cache.put(user_id, sub, generation)
+    return sub
 
 
 async def is_subscription_active(user_id: int) -> bool:
     sub = await get_subscription(user_id)
-    if not sub:
-        return False
-    return sub["status"] == "active" and sub["expires_at"] > datetime.now()
+    return sub.is_active() if sub else False
 
 
 async def create_subscription(
@@ -150,7 +767,8 @@ async def create_subscription(
     stripe_subscription_id: Optional[str] = None,
 ) -> None:
     expires_at = datetime.now() + timedelta(days=days)
-    async with get_db() as db:
+
+    async def write(db):
         await db.execute(
             """
             INSERT INTO subscriptions
@@ -165,7 +783,7 @@ async def create_subscription(
         """,
             (
                 user_id,
-                expires_at.isoformat(),
+                to_epoch(expires_at),
                 invite_link,
                 payment_provider,
                 stripe_customer_id,
@@ -175,34 +793,39 @@ async def create_subscription(
         await db.execute(
             "DELETE FROM subscription_notifications WHERE user_id = ?", (user_id,)
         )
-        await db.commit()
+
+    await run_write(write)
+    _subscription_changed(user_id, expires_at)
 
 
 async def update_subscription_period(user_id: int, new_expires_at: datetime) -> None:
-    async with get_db() as db:
-        await db.execute(
+    await run_write(
+        lambda db: db.execute(
             "UPDATE subscriptions SET expires_at = ?, status = 'active' WHERE user_id = ?",
-            (new_expires_at.isoformat(), user_id),
+            (to_epoch(new_expires_at), user_id),
         )
-        await db.commit()
+    )
+    _subscription_changed(user_id, new_expires_at)
 
 
 async def cancel_subscription(user_id: int) -> None:
-    async with get_db() as db:
-        await db.execute(
+    await run_write(
+        lambda db: db.execute(
             "UPDATE subscriptions SET status = 'cancelled' WHERE user_id = ?",
             (user_id,),
         )
-        await db.commit()
+    )
+    _subscription_changed(user_id, None)
 
 
 async def expire_subscription(user_id: int) -> None:
-    async with get_db() as db:
-        await db.execute(
+    await run_write(
+        lambda db: db.execute(
             "UPDATE subscriptions SET status = 'expired' WHERE user_id = ?",
             (user_id,),
         )
-        await db.commit()
+    )
+    _subscription_changed(user_id, None)
 
 
 async def save_cancellation_reason(
@@ -211,12 +834,62 @@ async def save_cancellation_reason(
     reason: str,
     subscription_id: Optional[str] = None,
 ) -> None:
-    async with get_db() as db:
-        await db.execute(
+    await run_write(
+        lambda db: db.execute(
             "INSERT INTO cancellations (user_id, username, reason, subscription_id) VALUES (?, ?, ?, ?)",
             (user_id, username or "", reason, subscription_id),
         )
-        await db.commit()
+    )
+
+
+async def index_cancellation_terms(batch_size: int, tokenize: Callable[[str], List[str]]) -> int:
+    """
+    Пачка отмен после отметки job_state.cancellation_terms -> частоты
+    терминов по дням (см. churn_terms.py). Счетчики и новая отметка
+    пишутся одной транзакцией. Возвращает число обработанных причин.
+    """
+
+    async def write(db) -> int:
+        async with db.execute(
+            "SELECT value FROM job_state WHERE name = 'cancellation_terms'"
+        ) as cursor:
+            row = await cursor.fetchone()
+        last_id = row[0] if row else 0
+
+        async with db.execute(
+            """
+            SELECT id, date(cancelled_at, 'unixepoch', 'localtime'), reason
+            FROM cancellations
+            WHERE id > ?
+            ORDER BY id
+            LIMIT ?
+            """,
+            (last_id, batch_size),
+        ) as cursor:
+            rows = await cursor.fetchall()
+        if not rows:
+            return 0
+
+        counts: Dict[Tuple[str, str], int] = {}
+        for _, day, reason in rows:
+            for term in tokenize(reason or ""):
+                counts[(day, term)] = counts.get((day, term), 0) + 1
+
+        await db.executemany(
+            """
+            INSERT INTO cancellation_terms (day, term, count) VALUES (?, ?, ?)
+            ON CONFLICT(day, term) DO UPDATE SET count = count + excluded.count
+            """,
+            [(day, term, count) for (day, term), count in counts.items()],
+        )
+        await db.execute(
+            "INSERT INTO job_state (name, value) VALUES ('cancellation_terms', ?) "
+            "ON CONFLICT(name) DO UPDATE SET value = excluded.value",
+            (rows[-1][0],),
+        )
+        return len(rows)
+
+    return await run_write(write)
 
 
 async def get_subscription_by_stripe_id(stripe_subscription_id: str) -> Optional[Dict]:
@@ -231,88 +904,599 @@ async def get_subscription_by_stripe_id(stripe_subscription_id: str) -> Optional
             return None
 
 
+async def get_stats_counters() -> Dict[str, int]:
+    """Все счетчики stats_counters одним запросом (поддерживаются триггерами)."""
+    async with get_db(flush_users=True) as db:
+        async with db.execute("SELECT name, value FROM stats_counters") as cursor:
+            return {row[0]: row[1] for row in await cursor.fetchall()}
+
+
+async def check_counters(fix: bool = False) -> Dict[str, Tuple[int, int]]:
+    """
+    Сверяет stats_counters с таблицами через писателя (на одном состоянии БД):
+    {счетчик: (в счетчике, в таблицах)}. fix=True записывает значения из таблиц.
+    """
+    async def write(db):
+        async with db.execute(COUNTER_SOURCES_SQL) as cursor:
+            actual = {row[0]: row[1] for row in await cursor.fetchall()}
+        async with db.execute("SELECT name, value FROM stats_counters") as cursor:
+            stored = {row[0]: row[1] for row in await cursor.fetchall()}
+        drift = counter_drift(stored, actual)
+        if fix and drift:
+            await db.executemany(
+                "INSERT INTO stats_counters (name, value) VALUES (?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET value = excluded.value",
+                [(name, real) for name, (_, real) in drift.items()],
+            )
+        return drift
+
+    return await run_write(write)
+
+
+async def count_recent(table: str, since: datetime) -> int:
+    """
+    Сколько записей появилось с момента since. Диапазон по индексу
+    временной метки, а не DATE(...) по всей таблице.
+    """
+    column = RECENT_COLUMNS[table]
+    async with get_db(flush_users=table == "users") as db:
+        async with db.execute(
+            f"SELECT COUNT(*) FROM {table} WHERE {column} >= ?", (to_epoch(since),)
+        ) as cursor:
+            return (await cursor.fetchone())[0]
+
+
+async def get_daily_series(days: int = max(SERIES_WINDOWS)) -> Dict[str, List[int]]:
+    """Ряды дневных агрегатов за последние days дней (см. rollups.py)."""
+    async with get_db(flush_users=True) as db:
+        async with db.execute(DAILY_STATS_SQL, (series_start(days).isoformat(),)) as cursor:
+            rows = await cursor.fetchall()
+    return build_series(rows, days)
+
+
 async def get_user_stats() -> str:
+    counters = await get_stats_counters()
+    cancellations = await count_recent("cancellations", datetime.now() - timedelta(days=7))
+    return (
+        f"👥 Всего пользователей: {counters.get('users_total', 0)}\n"
+        f"💎 Активных подписок: {counters.get('subscriptions_active', 0)}\n"
+        f"❌ Отмен за 7 дней: {cancellations}"
+    )
+
+
+async def get_all_users() -> List[UserRecord]:
+    return await _fetch_all(
+        f"SELECT {USER_COLUMNS} FROM users u ORDER BY u.join_date DESC",
+        (),
+        user_factory,
+        flush_users=True,
+    )
+
+
+async def get_user(user_id: int) -> Optional[UserRecord]:
+    rows = await _fetch_all(
+        f"SELECT {USER_COLUMNS} FROM users u WHERE u.user_id = ?",
+        (user_id,),
+        user_factory,
+        flush_users=True,
+    )
+    return rows[0] if rows else None
+
+
+# Триграммы FTS5 ищут подстроки не короче трех символов
+USER_SEARCH_MIN_SUBSTRING = 3
+
+
+def _fts_phrase(text: str) -> str:
+    """Строка как одна фраза FTS5: операторы и кавычки внутри не интерпретируются."""
+    return '"' + text.replace('"', '""') + '"'
+
+
+async def search_users(
+    query: str, after_user_id: int = 0, limit: int = 10
+) -> Tuple[List[UserRecord], bool]:
+    """
+    Поиск пользователей для админки, постранично по user_id
+    (after_user_id - последний user_id предыдущей страницы):
+    - число - точный user_id;
+    - @name или текст короче трех символов - префикс username без учета
+      регистра (диапазон по индексу idx_users_username_lower);
+    - иначе - подстрока в username или first_name (FTS5 trigram).
+    Возвращает (пользователи, есть_ли_еще).
+    """
+    query = query.strip()
+    if query.isdigit():
+        sql = f"SELECT {USER_COLUMNS} FROM users u WHERE u.user_id = ? AND u.user_id > ? LIMIT ?"
+        params = (int(query), after_user_id, limit + 1)
+    elif query.startswith("@") or len(query) < USER_SEARCH_MIN_SUBSTRING:
+        prefix = query.lstrip("@").lower()
+        if not prefix:
+            return [], False
+        # Без INDEXED BY планировщик выбирает проход по user_id ради ORDER BY,
+        # а диапазон префикса обычно намного меньше таблицы
+        sql = f"""
+            SELECT {USER_COLUMNS} FROM users u INDEXED BY idx_users_username_lower
+            WHERE lower(u.username) >= ? AND lower(u.username) < ? AND u.user_id > ?
+            ORDER BY u.user_id
+            LIMIT ?
+        """
+        params = (prefix, prefix + "\U0010ffff", after_user_id, limit + 1)
+    else:
+        sql = f"""
+            SELECT {USER_COLUMNS} FROM users_fts f
+            JOIN users u ON u.user_id = f.rowid
+            WHERE users_fts MATCH ? AND f.rowid > ?
+            ORDER BY f.rowid
+            LIMIT ?
+        """
+        params = (_fts_phrase(query), after_user_id, limit + 1)
+    users = await _fetch_all(sql, params, user_factory, flush_users=True)
+    return users[:limit], len(users) > limit
+
+
+async def find_users_by_usernames(usernames: List[str]) -> Dict[str, int]:
+    """{username в нижнем регистре: user_id} для найденных (индекс по lower(username))."""
+    if not usernames:
+        return {}
+    placeholders = ",".join(["?"] * len(usernames))
+    rows = await _fetch_all(
+        f"SELECT lower(username), user_id FROM users WHERE lower(username) IN ({placeholders})",
+        [username.lower() for username in usernames],
+        None,
+        flush_users=True,
+    )
+    return {username: user_id for username, user_id in rows if username}
+
+
+async def count_user_cancellations(user_id: int) -> int:
     async with get_db() as db:
-        async with db.execute("SELECT COUNT(*) FROM users") as cursor:
-            total_users = (await cursor.fetchone())[0]
         async with db.execute(
-            "SELECT COUNT(*) FROM subscriptions WHERE status = 'active' AND expires_at > ?",
-            (datetime.now().isoformat(),),
+            "SELECT COUNT(*) FROM cancellations WHERE user_id = ?", (user_id,)
         ) as cursor:
-            active_subs = (await cursor.fetchone())[0]
-        week_ago = (datetime.now() - timedelta(days=7)).isoformat()
+            return (await cursor.fetchone())[0]
+
+
+async def count_users() -> int:
+    """Количество пользователей из счетчика stats_counters."""
+    async with get_db(flush_users=True) as db:
         async with db.execute(
-            "SELECT COUNT(*) FROM cancellations WHERE cancelled_at > ?", (week_ago,)
+            "SELECT value FROM stats_counters WHERE name = 'users_total'"
         ) as cursor:
-            cancellations = (await cursor.fetchone())[0]
+            row = await cursor.fetchone()
+        if row:
+            return row[0]
+        async with db.execute("SELECT COUNT(*) FROM users") as cursor:
+            return (await cursor.fetchone())[0]
 
-        return f"👥 Всего пользователей: {total_users}\n💎 Активных подписок: {active_subs}\n❌ Отмен за 7 дней: {cancellations}"
 
+def users_page_query(cursor: Optional[tuple], backwards: bool, limit: int) -> tuple:
+    """(sql, params) keyset-страницы users для get_users_page() и снимков analytics.py."""
+    where = ""
+    params: list = []
+    if cursor is not None:
+        where = "WHERE (u.join_date, u.user_id) > (?, ?)" if backwards else "WHERE (u.join_date, u.user_id) < (?, ?)"
+        params.extend(cursor)
+    order = "ASC" if backwards else "DESC"
+    params.append(limit + 1)
+    sql = f"""
+        SELECT u.user_id, u.username, u.first_name, u.join_date,
+               s.status, s.expires_at
+        FROM users u
+        LEFT JOIN subscriptions s ON u.user_id = s.user_id
+        {where}
+        ORDER BY u.join_date {order}, u.user_id {order}
+        LIMIT ?
+    """
+    return sql, params
 
-async def get_all_users() -> List[Dict]:
-    async with get_db() as db:
+
+async def get_users_page(
+    cursor: Optional[tuple] = None, backwards: bool = False, limit: int = 10
+) -> tuple:
+    """
+    Страница пользователей (новые сверху) с keyset-курсором (join_date, user_id).
+    cursor — ключ последней строки предыдущей страницы (или первой при backwards=True).
+    Возвращает (пользователи, есть_ли_еще_в_этом_направлении).
+    """
+    sql, params = users_page_query(cursor, backwards, limit)
+    async with get_db(flush_users=True) as db:
+        async with db.execute(sql, params) as cur:
+            rows = await cur.fetchall()
+    return users_page_result(rows, backwards, limit)
+
+
+# Запросы планировщика подписок. Их планы проверяет check_query_plans():
+# все они должны идти по частичному индексу idx_sub_active_expires.
+# Без статистики планировщик предпочитает для ORDER BY user_id полный
+# проход по уникальному индексу, поэтому для истекших индекс указан явно
+EXPIRING_SUBSCRIPTIONS_SQL = """
+    SELECT s.user_id, s.expires_at
+    FROM subscriptions s
+    WHERE s.status = 'active'
+      AND s.expires_at > ?
+      AND s.expires_at <= ?
+      AND s.user_id > ?
+      AND NOT EXISTS (
+          SELECT 1 FROM subscription_notifications n
+          WHERE n.user_id = s.user_id
+            AND n.notification_type = ?
+      )
+    ORDER BY s.user_id
+    LIMIT ?
+"""
+
+EXPIRED_ACTIVE_SUBSCRIPTIONS_SQL = """
+    SELECT user_id, expires_at
+    FROM subscriptions INDEXED BY idx_sub_active_expires
+    WHERE status = 'active' AND expires_at <= ? AND user_id > ?
+    ORDER BY user_id
+    LIMIT ?
+"""
+
+UPCOMING_EXPIRIES_SQL = """
+    SELECT user_id, expires_at
+    FROM subscriptions
+    WHERE expires_at > ? AND expires_at <= ? AND status = 'active'
+    ORDER BY expires_at
+"""
+
+
+def _expiring_params(days: int, after_user_id: int, limit: Optional[int]) -> tuple:
+    now = datetime.now()
+    return (
+        to_epoch(now),
+        to_epoch(now + timedelta(days=days)),
+        after_user_id,
+        f"expiry_{days}d",
+        -1 if limit is None else limit,
+    )
+
+
+async def get_expiring_subscriptions(
+    days: int = 3, after_user_id: int = 0, limit: Optional[int] = None
+) -> List[ExpiryRecord]:
+    """
+    Подписки, истекающие в ближайшие N дней, которым еще не отправлено уведомление.
+    Постранично по user_id: after_user_id — последний user_id предыдущей страницы.
+    """
+    return await _fetch_all(
+        EXPIRING_SUBSCRIPTIONS_SQL, _expiring_params(days, after_user_id, limit), expiry_factory
+    )
+
+
+async def get_expiring_columns(
+    days: int = 3, after_user_id: int = 0, limit: Optional[int] = None
+) -> ExpiryColumns:
+    """То же, что get_expiring_subscriptions, колонками array('q')."""
+    return ExpiryColumns(
+        await _fetch_all(EXPIRING_SUBSCRIPTIONS_SQL, _expiring_params(days, after_user_id, limit), None)
+    )
+
+
+async def mark_notification(user_id: int, notification_type: str) -> None:
+    await run_write(
+        lambda db: db.execute(
+            """
+            INSERT OR IGNORE INTO subscription_notifications (user_id, notification_type)
+            VALUES (?, ?)
+            """,
+            (user_id, notification_type),
+        )
+    )
+
+
+async def mark_notifications(user_ids: List[int], notification_type: str) -> None:
+    """Отмечает уведомление для пачки пользователей одной транзакцией."""
+    if not user_ids:
+        return
+    await run_write(
+        lambda db: db.executemany(
+            """
+            INSERT OR IGNORE INTO subscription_notifications (user_id, notification_type)
+            VALUES (?, ?)
+            """,
+            [(user_id, notification_type) for user_id in user_ids],
+        )
+    )
+
+
+async def get_expired_active_subscriptions(
+    after_user_id: int = 0, limit: Optional[int] = None
+) -> List[ExpiryRecord]:
+    """Активные подписки, у которых истек срок (постранично по user_id)."""
+    params = (to_epoch(datetime.now()), after_user_id, -1 if limit is None else limit)
+    return await _fetch_all(EXPIRED_ACTIVE_SUBSCRIPTIONS_SQL, params, expiry_factory)
+
+
+async def get_expired_active_columns(
+    after_user_id: int = 0, limit: Optional[int] = None
+) -> ExpiryColumns:
+    """То же, что get_expired_active_subscriptions, колонками array('q')."""
+    params = (to_epoch(datetime.now()), after_user_id, -1 if limit is None else limit)
+    return ExpiryColumns(await _fetch_all(EXPIRED_ACTIVE_SUBSCRIPTIONS_SQL, params, None))
+
+
+async def get_upcoming_expiries(after: datetime, until: datetime) -> ExpiryColumns:
+    """Активные подписки с expires_at в (after, until] по возрастанию (индекс idx_sub_active_expires)."""
+    return ExpiryColumns(
+        await _fetch_all(UPCOMING_EXPIRIES_SQL, (to_epoch(after), to_epoch(until)), None)
+    )
+
+
+async def check_query_plans(db: Optional[aiosqlite.Connection] = None) -> Dict[str, List[str]]:
+    """
+    EXPLAIN QUERY PLAN для запросов планировщика подписок.
+    Возвращает {имя запроса: строки плана}.
+    """
+    queries = {
+        "expiring": (EXPIRING_SUBSCRIPTIONS_SQL, (0, 0, 0, "expiry_3d", -1)),
+        "expired_active": (EXPIRED_ACTIVE_SUBSCRIPTIONS_SQL, (0, 0, -1)),
+        "upcoming": (UPCOMING_EXPIRIES_SQL, (0, 0)),
+    }
+    plans = {}
+
+    async def explain(conn):
+        for name, (sql, params) in queries.items():
+            async with conn.execute(f"EXPLAIN QUERY PLAN {sql}", params) as cursor:
+                plans[name] = [row[3] for row in await cursor.fetchall()]
+
+    if db is not None:
+        await explain(db)
+    else:
+        async with get_db() as conn:
+            await explain(conn)
+    return plans
+
+
+def find_full_scans(
+    plans: Dict[str, List[str]], tables: tuple = ("subscriptions", "s")
+) -> List[str]:
+    """Запросы, план которых читает таблицу (или индекс) целиком, а не диапазон."""
+    scans = []
+    for name, steps in plans.items():
+        for step in steps:
+            words = step.split()
+            if len(words) > 1 and words[0] == "SCAN" and words[1] in tables:
+                scans.append(name)
+                break
+    return scans
+
+
+async def _warn_on_full_scans(db: aiosqlite.Connection) -> None:
+    scans = find_full_scans(await check_query_plans(db))
+    if scans:
+        logger.warning(f"⚠️ Запросы планировщика читают subscriptions целиком: {', '.join(scans)}")
+
+
+async def expire_subscriptions(user_ids: Sequence[int]) -> List[int]:
+    """
+    Переводит пачку активных подписок в expired одной транзакцией и
+    возвращает user_id переведенных. Подписки, продленные после выборки
+    (expires_at уже в будущем), не трогаются.
+    """
+    if not user_ids:
+        return []
+    placeholders = ",".join(["?"] * len(user_ids))
+
+    async def write(db):
         async with db.execute(
-            "SELECT user_id, username, first_name FROM users ORDER BY join_date DESC"
+            f"UPDATE subscriptions SET status = 'expired' "
+            f"WHERE status = 'active' AND expires_at <= ? AND user_id IN ({placeholders}) "
+            f"RETURNING user_id",
+            [to_epoch(datetime.now()), *user_ids],
         ) as cursor:
-            return [
-                {"user_id": row[0], "username": row[1] or "", "first_name": row[2] or ""}
-                for row in await cursor.fetchall()
-            ]
+            return [row[0] for row in await cursor.fetchall()]
 
+    expired = await run_write(write)
+    for user_id in expired:
+        _subscription_changed(user_id, None)
+    return expired
 
-async def get_expiring_subscriptions(days: int = 3) -> List[Dict]:
-    """Подписки, истекающие в ближайшие N дней, которым еще не отправлено уведомление."""
-    now = datetime.now()
-    limit = now + timedelta(days=days)
+
+async def get_checkout_session(user_id: int, price_id: str) -> Optional[Dict]:
+    """Открытая Checkout Session пользователя, если она еще пригодна для повторного показа."""
     async with get_db() as db:
         async with db.execute(
+            "SELECT url, expires_at FROM checkout_sessions WHERE user_id = ? AND price_id = ? AND expires_at > ?",
+            (user_id, price_id, to_epoch(datetime.now())),
+        ) as cursor:
+            row = await cursor.fetchone()
+            if row:
+                return {"url": row[0], "expires_at": from_epoch(row[1])}
+            return None
+
+
+async def save_checkout_session(
+    user_id: int, price_id: str, url: str, expires_at: datetime
+) -> None:
+    await run_write(
+        lambda db: db.execute(
             """
-            SELECT s.user_id, s.expires_at
-            FROM subscriptions s
-            WHERE s.status = 'active'
-              AND s.expires_at > ?
-              AND s.expires_at <= ?
-              AND NOT EXISTS (
-                  SELECT 1 FROM subscription_notifications n
-                  WHERE n.user_id = s.user_id
-                    AND n.notification_type = ?
-              )
+            INSERT INTO checkout_sessions (user_id, price_id, url, expires_at)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(user_id, price_id) DO UPDATE SET
+                url = excluded.url,
+                expires_at = excluded.expires_at
             """,
-            (now.isoformat(), limit.isoformat(), f"expiry_{days}d"),
-        ) as cursor:
-            rows = await cursor.fetchall()
-            return [
-                {"user_id": row[0], "expires_at": datetime.fromisoformat(row[1])}
-                for row in rows
-            ]
+            (user_id, price_id, url, to_epoch(expires_at)),
+        )
+    )
 
 
-async def mark_notification(user_id: int, notification_type: str) -> None:
+async def delete_checkout_sessions(user_id: int) -> None:
+    await run_write(
+        lambda db: db.execute("DELETE FROM checkout_sessions WHERE user_id = ?", (user_id,))
+    )
+
+
+async def purge_expired_checkout_sessions() -> int:
+    async def write(db):
+        cursor = await db.execute(
+            "DELETE FROM checkout_sessions WHERE expires_at <= ?",
+            (to_epoch(datetime.now()),),
+        )
+        return cursor.rowcount
+
+    return await run_write(write)
+
+
+# ==================== FSM ====================
+
+# Пустое состояние FSM: строка не хранится
+FSM_EMPTY_DATA = "{}"
+
+
+async def load_fsm_state(key: str, since: datetime) -> Optional[Tuple[Optional[str], str, int]]:
+    """(state, data JSON, updated_at) состояния, измененного не раньше since."""
     async with get_db() as db:
-        await db.execute(
+        async with db.execute(
+            "SELECT state, data, updated_at FROM fsm_states WHERE key = ? AND updated_at >= ?",
+            (key, to_epoch(since)),
+        ) as cursor:
+            row = await cursor.fetchone()
+            return tuple(row) if row else None
+
+
+async def save_fsm_states(rows: List[tuple]) -> None:
+    """
+    Пачка (key, state, data JSON, updated_at) одной транзакцией. Пустое
+    состояние удаляет строку. Запись старше сохраненной (другим процессом)
+    пропускается.
+    """
+    upserts = [row for row in rows if row[1] is not None or row[2] != FSM_EMPTY_DATA]
+    deletes = [(row[0], row[3]) for row in rows if row[1] is None and row[2] == FSM_EMPTY_DATA]
+
+    async def write(db):
+        if upserts:
+            await db.executemany(
+                """
+                INSERT INTO fsm_states (key, state, data, updated_at)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET
+                    state = excluded.state,
+                    data = excluded.data,
+                    updated_at = excluded.updated_at
+                WHERE excluded.updated_at >= fsm_states.updated_at
+                """,
+                upserts,
+            )
+        if deletes:
+            await db.executemany(
+                "DELETE FROM fsm_states WHERE key = ? AND updated_at <= ?", deletes
+            )
+
+    await run_write(write)
+
+
+async def purge_fsm_states(before: datetime) -> int:
+    """Удаляет брошенные состояния, не менявшиеся с before."""
+
+    async def write(db):
+        cursor = await db.execute(
+            "DELETE FROM fsm_states WHERE updated_at < ?", (to_epoch(before),)
+        )
+        return cursor.rowcount
+
+    return await run_write(write)
+
+
+# ==================== РАССЫЛКИ ====================
+
+
+async def create_broadcast_job(
+    text: str, status_chat_id: int, status_message_id: int, total: int
+) -> int:
+    async def write(db):
+        cursor = await db.execute(
             """
-            INSERT OR IGNORE INTO subscription_notifications (user_id, notification_type)
-            VALUES (?, ?)
+            INSERT INTO broadcast_jobs (text, status_chat_id, status_message_id, total)
+            VALUES (?, ?, ?, ?)
             """,
-            (user_id, notification_type),
+            (text, status_chat_id, status_message_id, total),
         )
-        await db.commit()
+        return cursor.lastrowid
 
+    return await run_write(write)
 
-async def get_expired_active_subscriptions() -> List[Dict]:
-    """Активные подписки, у которых истек срок."""
-    now = datetime.now()
+
+async def get_unfinished_broadcast_jobs() -> List[Dict]:
     async with get_db() as db:
         async with db.execute(
             """
-            SELECT user_id, expires_at
-            FROM subscriptions
-            WHERE status = 'active' AND expires_at <= ?
+            SELECT id, text, status_chat_id, status_message_id, total, last_user_id, sent, failed
+            FROM broadcast_jobs WHERE status = 'running' ORDER BY id
+            """
+        ) as cursor:
+            return [dict(row) for row in await cursor.fetchall()]
+
+
+async def reserve_broadcast_recipients(job_id: int, limit: int) -> array:
+    """
+    Следующая порция получателей рассылки (keyset по user_id).
+    Получатели сразу записываются как pending, а курсор задачи сдвигается
+    в той же транзакции: после перезапуска эти пользователи не получат
+    сообщение повторно.
+    """
+    async def write(db):
+        async with db.execute(
+            """
+            SELECT u.user_id FROM users u
+            WHERE u.user_id > (SELECT last_user_id FROM broadcast_jobs WHERE id = ?)
+            ORDER BY u.user_id
+            LIMIT ?
             """,
-            (now.isoformat(),),
+            (job_id, limit),
         ) as cursor:
-            rows = await cursor.fetchall()
-            return [
-                {"user_id": row[0], "expires_at": datetime.fromisoformat(row[1])}
-                for row in rows
-            ]
+            cursor.row_factory = None
+            user_ids = array("q", (row[0] for row in await cursor.fetchall()))
+        if user_ids:
+            await db.executemany(
+                "INSERT OR IGNORE INTO broadcast_deliveries (job_id, user_id) VALUES (?, ?)",
+                [(job_id, user_id) for user_id in user_ids],
+            )
+            await db.execute(
+                "UPDATE broadcast_jobs SET last_user_id = ? WHERE id = ?",
+                (user_ids[-1], job_id),
+            )
+        return user_ids
+
+    return await run_write(write)
+
+
+async def record_broadcast_results(job_id: int, results: List[tuple]) -> None:
+    """Фиксирует результаты отправки пачкой: [(user_id, 'sent' | 'failed'), ...]."""
+    if not results:
+        return
+    sent = sum(1 for _, status in results if status == "sent")
+
+    async def write(db):
+        await db.executemany(
+            "UPDATE broadcast_deliveries SET status = ? WHERE job_id = ? AND user_id = ?",
+            [(status, job_id, user_id) for user_id, status in results],
+        )
+        await db.execute(
+            "UPDATE broadcast_jobs SET sent = sent + ?, failed = failed + ? WHERE id = ?",
+            (sent, len(results) - sent, job_id),
+        )
+
+    await run_write(write)
+
+
+async def finish_broadcast_job(job_id: int) -> Dict:
+    async def write(db):
+        await db.execute(
+            "UPDATE broadcast_jobs SET status = 'done', finished_at = ? WHERE id = ?",
+            (to_epoch(datetime.now()), job_id),
+        )
+        async with db.execute(
+            "SELECT status, COUNT(*) FROM broadcast_deliveries WHERE job_id = ? GROUP BY status",
+            (job_id,),
+        ) as cursor:
+            return {row[0]: row[1] for row in await cursor.fetchall()}
+
+    counts = await run_write(write)
+    return {
+        "sent": counts.get("sent", 0),
+        "failed": counts.get("failed", 0),
+        "unknown": counts.get("pending", 0),
+    }
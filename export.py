@@ -0,0 +1,191 @@
+"""
+Потоковый экспорт пользователей в CSV.
+
+Строки читаются из БД пачками и сразу пишутся через csv.writer во временные
+файлы на диске (при желании в gzip): в SQLite - в пуле аналитики на
+read-only снимке БД (см. analytics.py), в PostgreSQL - серверным курсором
+в read-only транзакции (см. storage/postgres.py). Если файл
+приближается к лимиту Telegram на документ, экспорт продолжается в
+следующей части, у каждой части своя строка заголовков.
+"""
+
+import csv
+import gzip
+import io
+import shutil
+import sqlite3
+import tempfile
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from analytics import run_snapshot
+from config import EXPORT_GZIP
+from database import from_epoch
+
+EXPORT_BATCH_SIZE = 1000
+# Лимит Bot API на отправку документа - 50 МБ, оставляем запас на последнюю пачку
+TELEGRAM_DOCUMENT_LIMIT = 50 * 1024 * 1024
+PART_SIZE_LIMIT = TELEGRAM_DOCUMENT_LIMIT - 2 * 1024 * 1024
+
+EXPORT_HEADER = [
+    "user_id",
+    "username",
+    "first_name",
+    "join_date",
+    "has_payment_attempt",
+    "subscription_status",
+    "expires_at",
+    "payment_provider",
+]
+
+EXPORT_QUERY = """
+    SELECT
+        u.user_id,
+        u.username,
+        u.first_name,
+        u.join_date,
+        u.has_payment_attempt,
+        COALESCE(s.status, 'none') AS sub_status,
+        s.expires_at,
+        s.payment_provider
+    FROM users u
+    LEFT JOIN subscriptions s ON u.user_id = s.user_id
+    ORDER BY u.join_date DESC, u.user_id DESC
+"""
+
+
+class _PartWriter:
+    """CSV-файл одной части экспорта с учетом размера на диске."""
+
+    def __init__(self, path: Path, compress: bool) -> None:
+        self.path = path
+        self._raw = open(path, "wb")
+        self._stream = gzip.GzipFile(fileobj=self._raw, mode="wb") if compress else None
+        # utf-8-sig для корректного открытия в Excel
+        self._text = io.TextIOWrapper(
+            self._stream or self._raw, encoding="utf-8-sig", newline=""
+        )
+        self._writer = csv.writer(self._text)
+        self._writer.writerow(EXPORT_HEADER)
+        self.rows = 0
+
+    def write(self, rows) -> None:
+        self._writer.writerows(_export_row(row) for row in rows)
+        self.rows += len(rows)
+
+    def size(self) -> int:
+        self._text.flush()
+        return self._raw.tell()
+
+    def close(self) -> None:
+        self._text.close()  # закрывает gzip-поток, но не исходный файл
+        if not self._raw.closed:
+            self._raw.close()
+
+
+def _format_timestamp(value) -> str:
+    return from_epoch(value).strftime("%Y-%m-%d %H:%M:%S") if value is not None else ""
+
+
+def _export_row(row) -> list:
+    user_id, username, first_name, join_date, has_attempt, sub_status, expires_at, provider = row
+    return [
+        user_id,
+        username or "",
+        first_name or "",
+        _format_timestamp(join_date),
+        "yes" if has_attempt else "no",
+        sub_status,
+        _format_timestamp(expires_at),
+        provider or "",
+    ]
+
+
+class ExportWriter:
+    """
+    Части экспорта в каталоге out_dir: пачки строк EXPORT_QUERY пишутся в
+    текущую часть, новая начинается, когда текущая подходит к part_limit.
+    """
+
+    def __init__(self, out_dir: Path, compress: bool, part_limit: int = PART_SIZE_LIMIT) -> None:
+        self.out_dir = out_dir
+        self.compress = compress
+        self.part_limit = part_limit
+        self.stamp = datetime.now().strftime("%Y%m%d_%H%M")
+        self.suffix = ".csv.gz" if compress else ".csv"
+        self.parts: List[Path] = []
+        self.rows_total = 0
+        self._part = self._new_part()
+
+    def _new_part(self) -> _PartWriter:
+        path = self.out_dir / f"users_{self.stamp}_part{len(self.parts) + 1}{self.suffix}"
+        self.parts.append(path)
+        return _PartWriter(path, self.compress)
+
+    def write(self, batch) -> None:
+        if self._part.rows and self._part.size() >= self.part_limit:
+            self._part.close()
+            self._part = self._new_part()
+        self._part.write(batch)
+        self.rows_total += len(batch)
+
+    def close(self) -> None:
+        self._part.close()
+
+    def result(self) -> Tuple[List[Path], int]:
+        """(файлы частей, число строк) после close(); единственная часть - без _part1."""
+        if len(self.parts) == 1:
+            single = self.out_dir / f"users_{self.stamp}{self.suffix}"
+            self.parts[0].rename(single)
+            self.parts = [single]
+        return self.parts, self.rows_total
+
+
+@contextmanager
+def export_dir():
+    """Временный каталог экспорта; при ошибке удаляется, иначе - cleanup_export()."""
+    out_dir = Path(tempfile.mkdtemp(prefix="export_"))
+    try:
+        yield out_dir
+    except BaseException:
+        shutil.rmtree(out_dir, ignore_errors=True)
+        raise
+
+
+def _export_users_sync(
+    conn: sqlite3.Connection, out_dir: Path, compress: bool, part_limit: int
+) -> Tuple[List[Path], int]:
+    writer = ExportWriter(out_dir, compress, part_limit)
+    try:
+        cursor = conn.execute(EXPORT_QUERY)
+        while True:
+            batch = cursor.fetchmany(EXPORT_BATCH_SIZE)
+            if not batch:
+                break
+            writer.write(batch)
+    finally:
+        writer.close()
+    return writer.result()
+
+
+async def export_users_csv(
+    compress: bool = EXPORT_GZIP,
+    part_limit: int = PART_SIZE_LIMIT,
+    db_path: Optional[str] = None,
+) -> Tuple[List[Path], int]:
+    """
+    Экспортирует пользователей SQLite во временный каталог на снимке БД
+    (хранилища экспортируют через Storage.export_users_csv).
+    Возвращает (файлы частей, число строк); каталог удаляет cleanup_export().
+    """
+    with export_dir() as out_dir:
+        return await run_snapshot(
+            _export_users_sync, out_dir, compress, part_limit, db_path=db_path
+        )
+
+
+def cleanup_export(parts: List[Path]) -> None:
+    if parts:
+        shutil.rmtree(parts[0].parent, ignore_errors=True)
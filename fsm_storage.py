@@ -0,0 +1,267 @@
+"""
+FSM-хранилище aiogram поверх хранилища бота (таблица fsm_states).
+
+Диалоги (причина отмены, шаги админки, текст рассылки) переживают
+перезапуск и общие для всех процессов бота с одной БД. Поверх таблицы -
+LRU-кэш в памяти на FSM_CACHE_SIZE ключей:
+- чтение берется из кэша, пока запись моложе FSM_CACHE_SECONDS
+  (FSMContextMiddleware читает состояние на каждый апдейт, большинство -
+  пустые, поэтому кэшируется и их отсутствие);
+- изменения копятся и пишутся одной транзакцией раз в FSM_FLUSH_MS,
+  несброшенные записи из кэша не вытесняются;
+- состояния, не менявшиеся FSM_STATE_TTL_HOURS, считаются брошенными:
+  не читаются и удаляются из памяти и БД.
+
+При нескольких процессах FSM_CACHE_SECONDS=0: чтение всегда идет в БД,
+кроме ключей со своими несброшенными изменениями. Из-за отложенной записи
+другой процесс видит изменение с задержкой до FSM_FLUSH_MS.
+"""
+
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Dict, Mapping, Optional, Tuple
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+
+import storage
+from config import FSM_CACHE_SECONDS, FSM_CACHE_SIZE, FSM_FLUSH_MS, FSM_STATE_TTL_HOURS
+from database import FSM_EMPTY_DATA
+
+logger = logging.getLogger(__name__)
+
+# Чаще раза в час чистить брошенные состояния незачем
+PURGE_INTERVAL = 3600
+
+
+class _Entry:
+    """Состояние ключа в памяти. version растет с каждым изменением."""
+
+    __slots__ = ("state", "data", "updated_at", "checked", "version", "dirty")
+
+    def __init__(self, state: Optional[str], data: str, updated_at: int, checked: float) -> None:
+        self.state = state
+        self.data = data
+        self.updated_at = updated_at
+        self.checked = checked
+        self.version = 0
+        self.dirty = False
+
+    @property
+    def empty(self) -> bool:
+        return self.state is None and self.data == FSM_EMPTY_DATA
+
+
+class PersistentFSMStorage(BaseStorage):
+    def __init__(
+        self,
+        ttl: float = FSM_STATE_TTL_HOURS * 3600,
+        cache_size: int = FSM_CACHE_SIZE,
+        cache_seconds: float = FSM_CACHE_SECONDS,
+        flush_interval: float = FSM_FLUSH_MS / 1000,
+        key_builder: Optional[KeyBuilder] = None,
+    ) -> None:
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self.cache_seconds = cache_seconds
+        self.flush_interval = flush_interval
+        self.key_builder = key_builder or DefaultKeyBuilder(
+            with_bot_id=True, with_business_connection_id=True, with_destiny=True
+        )
+        self._entries: OrderedDict = OrderedDict()
+        self._pending: Dict[str, _Entry] = {}
+        self._tasks: list = []
+        self._flush_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self.hits = self.misses = self.evictions = self.expired = 0
+        self.flushes = self.rows_flushed = 0
+
+    # ---------- BaseStorage ----------
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        name, entry = await self._entry(key)
+        entry.state = state.state if isinstance(state, State) else state
+        await self._changed(name, entry)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        _, entry = await self._entry(key)
+        return entry.state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        # Сериализуем сразу: ошибка в данных всплывет в хендлере, а не при сбросе
+        payload = json.dumps(dict(data), ensure_ascii=False, separators=(",", ":"))
+        name, entry = await self._entry(key)
+        entry.data = payload
+        await self._changed(name, entry)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, entry = await self._entry(key)
+        return json.loads(entry.data)
+
+    async def close(self) -> None:
+        """Останавливает фоновые задачи и записывает все, что осталось."""
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+
+    # ---------- кэш ----------
+
+    async def _entry(self, key: StorageKey) -> Tuple[str, _Entry]:
+        name = self.key_builder.build(key)
+        now = time.monotonic()
+        entry = self._entries.get(name)
+        if entry is not None and (entry.dirty or now - entry.checked < self.cache_seconds):
+            self._entries.move_to_end(name)
+            self.hits += 1
+        else:
+            self.misses += 1
+            entry = await self._load(name, now)
+        if not entry.empty and entry.updated_at < time.time() - self.ttl:
+            # Брошенное состояние: в БД его удалит purge(), здесь просто забываем
+            entry.state, entry.data = None, FSM_EMPTY_DATA
+            self.expired += 1
+        return name, entry
+
+    async def _load(self, name: str, started: float) -> _Entry:
+        row = await storage.load_fsm_state(name, datetime.now() - timedelta(seconds=self.ttl))
+        current = self._entries.get(name)
+        if current is not None and (current.dirty or current.checked >= started):
+            # Пока ждали БД, ключ изменили или перечитали - их версия новее
+            return current
+        if row is None:
+            entry = _Entry(None, FSM_EMPTY_DATA, 0, started)
+        else:
+            entry = _Entry(row[0], row[1], row[2], started)
+        self._entries[name] = entry
+        self._entries.move_to_end(name)
+        self._evict()
+        return entry
+
+    def _evict(self) -> None:
+        """Вытесняет самые старые сброшенные записи сверх cache_size."""
+        excess = len(self._entries) - self.cache_size
+        if excess <= 0:
+            return
+        victims = []
+        for name, entry in self._entries.items():
+            if not entry.dirty:
+                victims.append(name)
+                if len(victims) == excess:
+                    break
+        for name in victims:
+            del self._entries[name]
+        self.evictions += len(victims)
+
+    async def _changed(self, name: str, entry: _Entry) -> None:
+        entry.updated_at = int(time.time())
+        entry.checked = time.monotonic()
+        entry.version += 1
+        entry.dirty = True
+        self._pending[name] = entry
+        if self._tasks:
+            self._wakeup.set()
+        else:
+            # Без фоновой задачи (скрипты, тесты без start()) пишем сразу
+            await self.flush()
+
+    # ---------- запись ----------
+
+    async def flush(self) -> int:
+        """Записывает накопленные изменения одной транзакцией."""
+        async with self._flush_lock:
+            if not self._pending:
+                return 0
+            pending, self._pending = self._pending, {}
+            versions = {name: entry.version for name, entry in pending.items()}
+            rows = [
+                (name, entry.state, entry.data, entry.updated_at) for name, entry in pending.items()
+            ]
+            try:
+                await storage.save_fsm_states(rows)
+            except BaseException:
+                for name, entry in pending.items():
+                    self._pending.setdefault(name, entry)
+                raise
+            for name, entry in pending.items():
+                # Изменение во время записи уже снова в _pending
+                if entry.version == versions[name]:
+                    entry.dirty = False
+            self._evict()
+            self.flushes += 1
+            self.rows_flushed += len(rows)
+            return len(rows)
+
+    def sweep(self) -> int:
+        """Убирает из памяти брошенные и устаревшие сброшенные записи."""
+        expired_before = time.time() - self.ttl
+        stale_before = time.monotonic() - self.cache_seconds
+        victims = [
+            name
+            for name, entry in self._entries.items()
+            if not entry.dirty
+            and (entry.checked < stale_before or (not entry.empty and entry.updated_at < expired_before))
+        ]
+        for name in victims:
+            del self._entries[name]
+        return len(victims)
+
+    async def purge(self) -> int:
+        """Удаляет брошенные состояния из памяти и БД."""
+        self.sweep()
+        return await storage.purge_fsm_states(datetime.now() - timedelta(seconds=self.ttl))
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await self._wakeup.wait()
+            await asyncio.sleep(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"FSM flush failed: {e}", exc_info=True)
+            if self._pending:
+                self._wakeup.set()
+
+    async def _purge_loop(self) -> None:
+        while True:
+            try:
+                purged = await self.purge()
+                if purged:
+                    logger.info(f"🧹 Удалено брошенных FSM-состояний: {purged}")
+            except Exception as e:
+                logger.error(f"FSM purge failed: {e}", exc_info=True)
+            await asyncio.sleep(min(self.ttl, PURGE_INTERVAL))
+
+    def start(self) -> None:
+        """Запускает отложенную запись и чистку (после init_storage)."""
+        if not self._tasks:
+            self._flush_lock = asyncio.Lock()
+            self._wakeup = asyncio.Event()
+            if self._pending:
+                self._wakeup.set()
+            self._tasks = [
+                asyncio.create_task(self._flush_loop()),
+                asyncio.create_task(self._purge_loop()),
+            ]
+
+    def stats(self) -> Dict:
+        return {
+            "size": len(self._entries),
+            "pending": len(self._pending),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expired": self.expired,
+            "flushes": self.flushes,
+            "rows_flushed": self.rows_flushed,
+        }
@@ -0,0 +1,657 @@
+"""
+Версионированные миграции схемы БД.
+
+Номер последней примененной миграции хранится в PRAGMA user_version.
+Каждая миграция выполняется в своей транзакции вместе с обновлением
+user_version, поэтому прерванная миграция не оставляет схему наполовину
+измененной.
+"""
+
+import logging
+from typing import Awaitable, Callable, Dict, List, Tuple
+
+import aiosqlite
+
+logger = logging.getLogger(__name__)
+
+# Текущее время в секундах Unix для DEFAULT (работает и на старых SQLite без unixepoch())
+_NOW_EPOCH = "(CAST(strftime('%s', 'now') AS INTEGER))"
+
+
+def _utc_text_to_epoch(column: str) -> str:
+    """CURRENT_TIMESTAMP хранился как UTC-текст."""
+    return f"CAST(strftime('%s', {column}) AS INTEGER)"
+
+
+def _local_text_to_epoch(column: str) -> str:
+    """datetime.now().isoformat() хранился как локальное время без зоны."""
+    return f"CAST(strftime('%s', {column}, 'utc') AS INTEGER)"
+
+
+async def _migration_base_schema(db: aiosqlite.Connection) -> None:
+    """Исходная схема (та, что раньше создавалась CREATE TABLE IF NOT EXISTS)."""
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            join_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            has_payment_attempt BOOLEAN DEFAULT FALSE
+        )
+    """)
+
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL UNIQUE,
+            expires_at TIMESTAMP NOT NULL,
+            invite_link TEXT,
+            payment_provider TEXT,
+            stripe_customer_id TEXT,
+            stripe_subscription_id TEXT,
+            status TEXT DEFAULT 'active',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+    """)
+
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS cancellations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            username TEXT,
+            reason TEXT NOT NULL,
+            subscription_id TEXT,
+            cancelled_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+    """)
+
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS subscription_notifications (
+            user_id INTEGER NOT NULL,
+            notification_type TEXT NOT NULL,
+            sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, notification_type)
+        )
+    """)
+
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS checkout_sessions (
+            user_id INTEGER NOT NULL,
+            price_id TEXT NOT NULL,
+            url TEXT NOT NULL,
+            expires_at TIMESTAMP NOT NULL,
+            PRIMARY KEY (user_id, price_id)
+        )
+    """)
+
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            status_chat_id INTEGER,
+            status_message_id INTEGER,
+            total INTEGER NOT NULL DEFAULT 0,
+            last_user_id INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+    """)
+
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+            job_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            PRIMARY KEY (job_id, user_id)
+        ) WITHOUT ROWID
+    """)
+
+    # Счетчики, которые поддерживаются триггерами вместо COUNT(*) по таблицам
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS stats_counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    await db.execute(
+        "INSERT OR IGNORE INTO stats_counters (name, value) "
+        "SELECT 'users_total', COUNT(*) FROM users"
+    )
+    await _create_users_count_triggers(db)
+
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_sub_stripe ON subscriptions(stripe_subscription_id)"
+    )
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_users_join ON users(join_date, user_id)"
+    )
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_sub_expires ON subscriptions(expires_at)"
+    )
+
+
+async def _create_users_count_triggers(db: aiosqlite.Connection) -> None:
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_users_count_insert AFTER INSERT ON users
+        BEGIN
+            UPDATE stats_counters SET value = value + 1 WHERE name = 'users_total';
+        END
+    """)
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_users_count_delete AFTER DELETE ON users
+        BEGIN
+            UPDATE stats_counters SET value = value - 1 WHERE name = 'users_total';
+        END
+    """)
+
+
+async def _rebuild_table(
+    db: aiosqlite.Connection, table: str, create_sql: str, columns: List[str], select: List[str]
+) -> None:
+    """
+    Пересоздает таблицу с новой схемой (SQLite не умеет менять тип колонки):
+    new_<table> -> копирование -> DROP -> RENAME. Индексы и триггеры
+    старой таблицы удаляются вместе с ней.
+    """
+    await db.execute(create_sql.format(table=f"new_{table}"))
+    await db.execute(
+        f"INSERT INTO new_{table} ({', '.join(columns)}) "
+        f"SELECT {', '.join(select)} FROM {table}"
+    )
+    await db.execute(f"DROP TABLE {table}")
+    await db.execute(f"ALTER TABLE new_{table} RENAME TO {table}")
+
+
+async def _migration_epoch_timestamps(db: aiosqlite.Connection) -> None:
+    """Все временные метки - INTEGER, секунды Unix (UTC)."""
+    await _rebuild_table(
+        db,
+        "users",
+        f"""
+        CREATE TABLE {{table}} (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            join_date INTEGER NOT NULL DEFAULT {_NOW_EPOCH},
+            has_payment_attempt BOOLEAN DEFAULT FALSE
+        )
+        """,
+        ["user_id", "username", "first_name", "join_date", "has_payment_attempt"],
+        [
+            "user_id",
+            "username",
+            "first_name",
+            f"COALESCE({_utc_text_to_epoch('join_date')}, {_NOW_EPOCH})",
+            "has_payment_attempt",
+        ],
+    )
+    await _create_users_count_triggers(db)
+
+    await _rebuild_table(
+        db,
+        "subscriptions",
+        f"""
+        CREATE TABLE {{table}} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL UNIQUE,
+            expires_at INTEGER NOT NULL,
+            invite_link TEXT,
+            payment_provider TEXT,
+            stripe_customer_id TEXT,
+            stripe_subscription_id TEXT,
+            status TEXT DEFAULT 'active',
+            created_at INTEGER NOT NULL DEFAULT {_NOW_EPOCH},
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+        """,
+        [
+            "id", "user_id", "expires_at", "invite_link", "payment_provider",
+            "stripe_customer_id", "stripe_subscription_id", "status", "created_at",
+        ],
+        [
+            "id", "user_id", f"COALESCE({_local_text_to_epoch('expires_at')}, 0)",
+            "invite_link", "payment_provider", "stripe_customer_id",
+            "stripe_subscription_id", "status",
+            f"COALESCE({_utc_text_to_epoch('created_at')}, {_NOW_EPOCH})",
+        ],
+    )
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_sub_stripe ON subscriptions(stripe_subscription_id)"
+    )
+
+    await _rebuild_table(
+        db,
+        "cancellations",
+        f"""
+        CREATE TABLE {{table}} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            username TEXT,
+            reason TEXT NOT NULL,
+            subscription_id TEXT,
+            cancelled_at INTEGER NOT NULL DEFAULT {_NOW_EPOCH},
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+        """,
+        ["id", "user_id", "username", "reason", "subscription_id", "cancelled_at"],
+        [
+            "id", "user_id", "username", "reason", "subscription_id",
+            f"COALESCE({_utc_text_to_epoch('cancelled_at')}, {_NOW_EPOCH})",
+        ],
+    )
+
+    await _rebuild_table(
+        db,
+        "subscription_notifications",
+        f"""
+        CREATE TABLE {{table}} (
+            user_id INTEGER NOT NULL,
+            notification_type TEXT NOT NULL,
+            sent_at INTEGER NOT NULL DEFAULT {_NOW_EPOCH},
+            PRIMARY KEY (user_id, notification_type)
+        )
+        """,
+        ["user_id", "notification_type", "sent_at"],
+        [
+            "user_id", "notification_type",
+            f"COALESCE({_utc_text_to_epoch('sent_at')}, {_NOW_EPOCH})",
+        ],
+    )
+
+    await _rebuild_table(
+        db,
+        "checkout_sessions",
+        """
+        CREATE TABLE {table} (
+            user_id INTEGER NOT NULL,
+            price_id TEXT NOT NULL,
+            url TEXT NOT NULL,
+            expires_at INTEGER NOT NULL,
+            PRIMARY KEY (user_id, price_id)
+        )
+        """,
+        ["user_id", "price_id", "url", "expires_at"],
+        ["user_id", "price_id", "url", f"COALESCE({_local_text_to_epoch('expires_at')}, 0)"],
+    )
+
+    await _rebuild_table(
+        db,
+        "broadcast_jobs",
+        f"""
+        CREATE TABLE {{table}} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            status_chat_id INTEGER,
+            status_message_id INTEGER,
+            total INTEGER NOT NULL DEFAULT 0,
+            last_user_id INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            created_at INTEGER NOT NULL DEFAULT {_NOW_EPOCH},
+            finished_at INTEGER
+        )
+        """,
+        [
+            "id", "text", "status", "status_chat_id", "status_message_id",
+            "total", "last_user_id", "sent", "failed", "created_at", "finished_at",
+        ],
+        [
+            "id", "text", "status", "status_chat_id", "status_message_id",
+            "total", "last_user_id", "sent", "failed",
+            f"COALESCE({_utc_text_to_epoch('created_at')}, {_NOW_EPOCH})",
+            _local_text_to_epoch("finished_at"),
+        ],
+    )
+
+
+async def _migration_targeted_indexes(db: aiosqlite.Connection) -> None:
+    """
+    Частичный индекс по срокам только активных подписок (их читает
+    планировщик) и покрывающий индекс для списка пользователей в админке:
+    страница читается из индекса, подписка - по уникальному user_id.
+    """
+    await db.execute("DROP INDEX IF EXISTS idx_sub_expires")
+    await db.execute("DROP INDEX IF EXISTS idx_users_join")
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_sub_active_expires "
+        "ON subscriptions(expires_at) WHERE status = 'active'"
+    )
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_users_list "
+        "ON users(join_date, user_id, username, first_name)"
+    )
+
+
+# Точные значения всех счетчиков stats_counters (для заполнения и сверки)
+COUNTER_SOURCES_SQL = """
+    SELECT 'users_total', COUNT(*) FROM users
+    UNION ALL
+    SELECT 'subscriptions_total', COUNT(*) FROM subscriptions
+    UNION ALL
+    SELECT 'cancellations_total', COUNT(*) FROM cancellations
+    UNION ALL
+    SELECT 'subscriptions_' || COALESCE(status, 'none'), COUNT(*)
+    FROM subscriptions GROUP BY status
+"""
+
+
+def counter_drift(stored: Dict[str, int], actual: Dict[str, int]) -> Dict[str, Tuple[int, int]]:
+    """{счетчик: (в stats_counters, в таблицах)} для расходящихся значений."""
+    return {
+        name: (stored.get(name, 0), actual.get(name, 0))
+        for name in sorted(set(actual) | set(stored))
+        if stored.get(name, 0) != actual.get(name, 0)
+    }
+
+
+async def _migration_stats_counters(db: aiosqlite.Connection) -> None:
+    """
+    Счетчики подписок (всего и по статусам) и отмен на триггерах, плюс
+    индексы для подсчета за последние дни диапазоном вместо DATE(...).
+    """
+    await db.execute("DELETE FROM stats_counters")
+    await db.execute(f"INSERT INTO stats_counters (name, value) {COUNTER_SOURCES_SQL}")
+
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_subs_count_insert AFTER INSERT ON subscriptions
+        BEGIN
+            UPDATE stats_counters SET value = value + 1 WHERE name = 'subscriptions_total';
+            INSERT INTO stats_counters (name, value)
+            VALUES ('subscriptions_' || COALESCE(NEW.status, 'none'), 1)
+            ON CONFLICT(name) DO UPDATE SET value = value + 1;
+        END
+    """)
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_subs_count_status AFTER UPDATE OF status ON subscriptions
+        WHEN OLD.status IS NOT NEW.status
+        BEGIN
+            UPDATE stats_counters SET value = value - 1
+            WHERE name = 'subscriptions_' || COALESCE(OLD.status, 'none');
+            INSERT INTO stats_counters (name, value)
+            VALUES ('subscriptions_' || COALESCE(NEW.status, 'none'), 1)
+            ON CONFLICT(name) DO UPDATE SET value = value + 1;
+        END
+    """)
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_subs_count_delete AFTER DELETE ON subscriptions
+        BEGIN
+            UPDATE stats_counters SET value = value - 1 WHERE name = 'subscriptions_total';
+            UPDATE stats_counters SET value = value - 1
+            WHERE name = 'subscriptions_' || COALESCE(OLD.status, 'none');
+        END
+    """)
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_cancellations_count_insert AFTER INSERT ON cancellations
+        BEGIN
+            UPDATE stats_counters SET value = value + 1 WHERE name = 'cancellations_total';
+        END
+    """)
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_cancellations_count_delete AFTER DELETE ON cancellations
+        BEGIN
+            UPDATE stats_counters SET value = value - 1 WHERE name = 'cancellations_total';
+        END
+    """)
+
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_sub_created ON subscriptions(created_at)"
+    )
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_cancellations_date ON cancellations(cancelled_at)"
+    )
+
+
+# День события в локальной зоне сервера, как и datetime.now() в коде бота
+_LOCAL_DAY = "date({}, 'unixepoch', 'localtime')"
+_TODAY = "date('now', 'localtime')"
+
+
+def _bump_daily(day_sql: str, metric: str) -> str:
+    return (
+        f"INSERT INTO daily_stats (day, {metric}) VALUES ({day_sql}, 1) "
+        f"ON CONFLICT(day) DO UPDATE SET {metric} = {metric} + 1;"
+    )
+
+
+async def backfill_daily_stats(db: aiosqlite.Connection) -> None:
+    """
+    Пересчитывает daily_stats из истории. Продления по старым данным
+    восстановить нельзя, отмены берутся по сохраненным причинам отмен,
+    истечения - по дате окончания истекших подписок.
+    """
+    await db.execute("DELETE FROM daily_stats")
+    sources = [
+        ("signups", "users", _LOCAL_DAY.format("join_date"), "1"),
+        ("new_subscriptions", "subscriptions", _LOCAL_DAY.format("created_at"), "1"),
+        ("cancellations", "cancellations", _LOCAL_DAY.format("cancelled_at"), "1"),
+        ("expirations", "subscriptions", _LOCAL_DAY.format("expires_at"), "status = 'expired'"),
+    ]
+    for metric, table, day_sql, where in sources:
+        await db.execute(
+            f"""
+            INSERT INTO daily_stats (day, {metric})
+            SELECT {day_sql} AS d, COUNT(*) FROM {table} WHERE {where} GROUP BY d
+            ON CONFLICT(day) DO UPDATE SET {metric} = excluded.{metric}
+            """
+        )
+
+
+async def _migration_daily_stats(db: aiosqlite.Connection) -> None:
+    """Дневные агрегаты на триггерах (см. rollups.py) и их заполнение из истории."""
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS daily_stats (
+            day TEXT PRIMARY KEY,
+            signups INTEGER NOT NULL DEFAULT 0,
+            new_subscriptions INTEGER NOT NULL DEFAULT 0,
+            renewals INTEGER NOT NULL DEFAULT 0,
+            cancellations INTEGER NOT NULL DEFAULT 0,
+            expirations INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    """)
+    await db.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_daily_signups AFTER INSERT ON users
+        BEGIN
+            {_bump_daily(_LOCAL_DAY.format("NEW.join_date"), "signups")}
+        END
+    """)
+    await db.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_daily_new_subscriptions AFTER INSERT ON subscriptions
+        BEGIN
+            {_bump_daily(_LOCAL_DAY.format("NEW.created_at"), "new_subscriptions")}
+        END
+    """)
+    # Продление - срок активной подписки сдвинут вперед (оплата очередного
+    # периода или повторное оформление после отмены/истечения)
+    await db.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_daily_renewals AFTER UPDATE OF expires_at ON subscriptions
+        WHEN NEW.status = 'active' AND NEW.expires_at > OLD.expires_at
+        BEGIN
+            {_bump_daily(_TODAY, "renewals")}
+        END
+    """)
+    await db.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_daily_cancellations AFTER UPDATE OF status ON subscriptions
+        WHEN NEW.status = 'cancelled' AND OLD.status IS NOT 'cancelled'
+        BEGIN
+            {_bump_daily(_TODAY, "cancellations")}
+        END
+    """)
+    await db.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_daily_expirations AFTER UPDATE OF status ON subscriptions
+        WHEN NEW.status = 'expired' AND OLD.status IS NOT 'expired'
+        BEGIN
+            {_bump_daily(_TODAY, "expirations")}
+        END
+    """)
+    await backfill_daily_stats(db)
+
+
+async def _migration_user_search(db: aiosqlite.Connection) -> None:
+    """
+    Поиск пользователей: индекс по lower(username) для точного и префиксного
+    поиска без учета регистра и FTS5 (trigram) по username и first_name для
+    поиска подстроки. users_fts - external content: текст хранится только в
+    users, индекс синхронизируют триггеры.
+    """
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_users_username_lower ON users(lower(username))"
+    )
+    await db.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+            username, first_name,
+            content='users', content_rowid='user_id',
+            tokenize='trigram'
+        )
+    """)
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_users_fts_insert AFTER INSERT ON users
+        BEGIN
+            INSERT INTO users_fts(rowid, username, first_name)
+            VALUES (NEW.user_id, NEW.username, NEW.first_name);
+        END
+    """)
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_users_fts_delete AFTER DELETE ON users
+        BEGIN
+            INSERT INTO users_fts(users_fts, rowid, username, first_name)
+            VALUES ('delete', OLD.user_id, OLD.username, OLD.first_name);
+        END
+    """)
+    # upsert из save_user обновляет колонки и без изменений - такие пропускаем
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_users_fts_update AFTER UPDATE OF username, first_name ON users
+        WHEN OLD.username IS NOT NEW.username OR OLD.first_name IS NOT NEW.first_name
+        BEGIN
+            INSERT INTO users_fts(users_fts, rowid, username, first_name)
+            VALUES ('delete', OLD.user_id, OLD.username, OLD.first_name);
+            INSERT INTO users_fts(rowid, username, first_name)
+            VALUES (NEW.user_id, NEW.username, NEW.first_name);
+        END
+    """)
+    await db.execute("INSERT INTO users_fts(users_fts) VALUES ('rebuild')")
+
+
+async def _migration_cancellation_search(db: aiosqlite.Connection) -> None:
+    """
+    Поиск по причинам отмен и темы оттока.
+    cancellations_fts - external content FTS5 по reason (unicode61, префиксный
+    индекс для поиска по началу слова вместо морфологии).
+    cancellation_terms - сколько причин за день содержат термин; таблицу
+    пополняет фоновая задача (churn_terms.py) с отметки job_state, поэтому
+    темы за любое окно считаются по первичному ключу без чтения текстов.
+    """
+    await db.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS cancellations_fts USING fts5(
+            reason,
+            content='cancellations', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        )
+    """)
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_cancellations_fts_insert AFTER INSERT ON cancellations
+        BEGIN
+            INSERT INTO cancellations_fts(rowid, reason) VALUES (NEW.id, NEW.reason);
+        END
+    """)
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_cancellations_fts_delete AFTER DELETE ON cancellations
+        BEGIN
+            INSERT INTO cancellations_fts(cancellations_fts, rowid, reason)
+            VALUES ('delete', OLD.id, OLD.reason);
+        END
+    """)
+    await db.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_cancellations_fts_update AFTER UPDATE OF reason ON cancellations
+        WHEN OLD.reason IS NOT NEW.reason
+        BEGIN
+            INSERT INTO cancellations_fts(cancellations_fts, rowid, reason)
+            VALUES ('delete', OLD.id, OLD.reason);
+            INSERT INTO cancellations_fts(rowid, reason) VALUES (NEW.id, NEW.reason);
+        END
+    """)
+    await db.execute("INSERT INTO cancellations_fts(cancellations_fts) VALUES ('rebuild')")
+
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS cancellation_terms (
+            day TEXT NOT NULL,
+            term TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, term)
+        ) WITHOUT ROWID
+    """)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS job_state (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    await db.execute(
+        "INSERT OR IGNORE INTO job_state (name, value) VALUES ('cancellation_terms', 0)"
+    )
+
+
+async def _migration_fsm_states(db: aiosqlite.Connection) -> None:
+    """
+    Состояния FSM-диалогов (fsm_storage.py): ключ aiogram, состояние, данные
+    в JSON и время изменения - по нему более старая запись другого процесса
+    не затирает новую, а брошенные диалоги удаляются по TTL.
+    """
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS fsm_states (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT NOT NULL DEFAULT '{}',
+            updated_at INTEGER NOT NULL
+        ) WITHOUT ROWID
+    """)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_fsm_states_updated ON fsm_states(updated_at)")
+
+
+# Порядок менять нельзя: номер миграции = ее позиция в списке (с 1)
+MIGRATIONS: List[Callable[[aiosqlite.Connection], Awaitable[None]]] = [
+    _migration_base_schema,
+    _migration_epoch_timestamps,
+    _migration_targeted_indexes,
+    _migration_stats_counters,
+    _migration_daily_stats,
+    _migration_user_search,
+    _migration_cancellation_search,
+    _migration_fsm_states,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+async def get_schema_version(db: aiosqlite.Connection) -> int:
+    async with db.execute("PRAGMA user_version") as cursor:
+        return (await cursor.fetchone())[0]
+
+
+async def run_migrations(db: aiosqlite.Connection) -> int:
+    """Применяет недостающие миграции. Возвращает число примененных."""
+    if db.in_transaction:
+        await db.commit()
+    applied = 0
+    while True:
+        await db.execute("BEGIN IMMEDIATE")
+        try:
+            version = await get_schema_version(db)
+            if version >= SCHEMA_VERSION:
+                await db.rollback()
+                break
+            migration = MIGRATIONS[version]
+            await migration(db)
+            await db.execute(f"PRAGMA user_version = {version + 1}")
+            await db.commit()
+        except BaseException:
+            await db.rollback()
+            raise
+        applied += 1
+        logger.info(f"🧱 Миграция {version + 1} применена: {migration.__name__}")
+    return applied
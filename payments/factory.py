@@ -3,7 +3,15 @@
 """
 
 import logging
-from typing import Optional
+from datetime import datetime, timedelta
+from typing import Dict, Optional, Tuple
+
+from config import STRIPE_PRICE_ID, STRIPE_SESSION_REUSE_MARGIN, STRIPE_SESSION_TTL
+from storage import (
+    delete_checkout_sessions,
+    get_checkout_session,
+    save_checkout_session,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -11,12 +19,17 @@ logger = logging.getLogger(__name__)
 class PaymentFactory:
     """Фабрика для выбора платежного провайдера"""
 
+    # (user_id, price_id) -> (url, время, до которого ссылку можно переиспользовать)
+    _sessions: Dict[Tuple[int, str], Tuple[str, datetime]] = {}
+
     @staticmethod
     async def create_payment(
         user_id: int, username: Optional[str] = None
     ) -> Optional[str]:
         """
         Создает платеж и возвращает URL для оплаты.
+        Открытая Checkout Session пользователя переиспользуется, пока не
+        подходит к концу срок ее жизни в Stripe.
 
         Args:
             user_id: ID пользователя Telegram
@@ -25,10 +38,65 @@ class PaymentFactory:
         Returns:
             URL для оплаты или None в случае ошибки
         """
+        key = (user_id, STRIPE_PRICE_ID)
+        cached_url = await PaymentFactory._get_cached_session(key)
+        if cached_url:
+            logger.info(f"♻️ Reusing Stripe checkout session for user {user_id}")
+            return cached_url
+
         logger.info(f"💳 Using Stripe payment for user {user_id}")
         from .stripe_pay import StripePaymentHandler
 
-        return await StripePaymentHandler.create_payment(user_id, username)
+        url = await StripePaymentHandler.create_payment(user_id, username)
+        if url:
+            reusable_until = datetime.now() + timedelta(
+                seconds=STRIPE_SESSION_TTL - STRIPE_SESSION_REUSE_MARGIN
+            )
+            await PaymentFactory._remember_session(key, url, reusable_until)
+        return url
+
+    @staticmethod
+    async def _get_cached_session(key: Tuple[int, str]) -> Optional[str]:
+        cached = PaymentFactory._sessions.get(key)
+        if cached:
+            url, reusable_until = cached
+            if reusable_until > datetime.now():
+                return url
+            del PaymentFactory._sessions[key]
+
+        try:
+            stored = await get_checkout_session(*key)
+        except Exception as e:
+            logger.warning(f"Failed to load cached checkout session for {key[0]}: {e}")
+            return None
+        if not stored:
+            return None
+        PaymentFactory._sessions[key] = (stored["url"], stored["expires_at"])
+        return stored["url"]
+
+    @staticmethod
+    async def _remember_session(
+        key: Tuple[int, str], url: str, reusable_until: datetime
+    ) -> None:
+        PaymentFactory._sessions[key] = (url, reusable_until)
+        try:
+            await save_checkout_session(key[0], key[1], url, reusable_until)
+        except Exception as e:
+            logger.warning(f"Failed to persist checkout session for {key[0]}: {e}")
+
+    @staticmethod
+    async def invalidate(user_id: int) -> None:
+        """Забыть открытые сессии пользователя (например, после успешной оплаты)."""
+        for key in [k for k in PaymentFactory._sessions if k[0] == user_id]:
+            del PaymentFactory._sessions[key]
+        try:
+            await delete_checkout_sessions(user_id)
+        except Exception as e:
+            logger.warning(f"Failed to drop checkout sessions for {user_id}: {e}")
+
+    @staticmethod
+    def clear_cache() -> None:
+        PaymentFactory._sessions.clear()
 
     @staticmethod
     def get_provider_name() -> str:
@@ -2,7 +2,11 @@
 Stripe Checkout payment handler
 """
 
+import asyncio
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from typing import Dict, Optional
 
 import stripe
@@ -13,6 +17,9 @@ from config import (
     STRIPE_PRICE_ID,
     STRIPE_SUCCESS_URL,
     STRIPE_CANCEL_URL,
+    STRIPE_MAX_CONCURRENCY,
+    STRIPE_SESSION_TTL,
+    STRIPE_TIMEOUT,
     SUBSCRIPTION_PRICE,
     SUBSCRIPTION_CURRENCY,
 )
@@ -20,6 +27,24 @@ from config import (
 logger = logging.getLogger(__name__)
 
 stripe.api_key = STRIPE_SECRET_KEY
+# Сетевой таймаут самого SDK, чтобы зависший запрос освобождал поток пула
+stripe.default_http_client = stripe.new_default_http_client(timeout=STRIPE_TIMEOUT)
+
+# Синхронный SDK выполняется в ограниченном пуле потоков, а не в event loop
+_executor = ThreadPoolExecutor(
+    max_workers=STRIPE_MAX_CONCURRENCY, thread_name_prefix="stripe"
+)
+_semaphore = asyncio.Semaphore(STRIPE_MAX_CONCURRENCY)
+
+
+async def _call_stripe(func, *args, **kwargs):
+    """Выполняет блокирующий вызов Stripe SDK в пуле потоков с таймаутом."""
+    async with _semaphore:
+        loop = asyncio.get_running_loop()
+        return await asyncio.wait_for(
+            loop.run_in_executor(_executor, partial(func, *args, **kwargs)),
+            timeout=STRIPE_TIMEOUT,
+        )
 
 
 class StripePaymentHandler:
@@ -32,13 +57,15 @@ class StripePaymentHandler:
             return None
 
         try:
-            session = stripe.checkout.Session.create(
+            session = await _call_stripe(
+                stripe.checkout.Session.create,
                 mode="subscription",
                 line_items=[{"price": STRIPE_PRICE_ID, "quantity": 1}],
                 metadata={"telegram_user_id": str(user_id)},
                 subscription_data={"metadata": {"telegram_user_id": str(user_id)}},
                 success_url=STRIPE_SUCCESS_URL,
                 cancel_url=STRIPE_CANCEL_URL,
+                expires_at=int(time.time()) + STRIPE_SESSION_TTL,
             )
             logger.info(f"✅ Stripe Checkout Session создан для user {user_id}: {session.id}")
             return session.url
@@ -46,6 +73,14 @@ class StripePaymentHandler:
         except stripe.StripeError as e:
             logger.error(f"❌ Stripe error for user {user_id}: {e}", exc_info=True)
             return None
+        except asyncio.TimeoutError:
+            logger.error(f"❌ Stripe timeout ({STRIPE_TIMEOUT}s) for user {user_id}")
+            return None
+
+    @staticmethod
+    async def retrieve_price(price_id: str):
+        """Загружает Stripe Price (для диагностики)."""
+        return await _call_stripe(stripe.Price.retrieve, price_id)
 
     @staticmethod
     def verify_webhook_signature(payload: bytes, signature: str) -> bool:
@@ -61,7 +96,7 @@ class StripePaymentHandler:
             return False
 
     @staticmethod
-    def parse_webhook(payload: bytes, signature: str) -> Optional[Dict]:
+    async def parse_webhook(payload: bytes, signature: str) -> Optional[Dict]:
         """
         Парсит Stripe webhook и возвращает данные платежа при успешной оплате.
         Обрабатывает событие checkout.session.completed.
@@ -107,7 +142,7 @@ class StripePaymentHandler:
                 if not subscription_id:
                     return None
 
-                stripe_sub = stripe.Subscription.retrieve(subscription_id)
+                stripe_sub = await _call_stripe(stripe.Subscription.retrieve, subscription_id)
                 user_id_str = stripe_sub.metadata.get("telegram_user_id")
 
                 if not user_id_str:
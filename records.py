@@ -0,0 +1,147 @@
+"""
+Компактные записи для строк users / subscriptions / cancellations.
+
+Записи - NamedTuple (без __dict__ на экземпляр), собираются фабрикой строк
+курсора прямо из кортежа sqlite3, без промежуточных aiosqlite.Row и dict.
+Временные метки хранятся как есть (INTEGER, секунды Unix) и переводятся в
+datetime только при обращении к свойству.
+
+Для массовых выборок планировщика и рассылок есть колоночные варианты:
+параллельные array('q') с user_id и временными метками вместо объекта на
+каждую строку.
+"""
+
+from array import array
+from datetime import datetime
+from typing import Iterable, Iterator, NamedTuple, Optional
+
+# Колонки в порядке полей записей - запросы выбирают их именно так
+SUBSCRIPTION_COLUMNS = (
+    "s.user_id, s.expires_at, s.invite_link, s.payment_provider, "
+    "s.stripe_customer_id, s.stripe_subscription_id, s.status"
+)
+USER_COLUMNS = "u.user_id, u.username, u.first_name, u.join_date, u.has_payment_attempt"
+CANCELLATION_COLUMNS = "c.id, c.user_id, c.username, c.reason, c.cancelled_at"
+
+
+def _from_epoch(value: Optional[int]) -> Optional[datetime]:
+    return datetime.fromtimestamp(value) if value is not None else None
+
+
+class SubscriptionRecord(NamedTuple):
+    user_id: int
+    expires_epoch: Optional[int]
+    invite_link: Optional[str]
+    payment_provider: Optional[str]
+    stripe_customer_id: Optional[str]
+    stripe_subscription_id: Optional[str]
+    status: str
+
+    @property
+    def expires_at(self) -> Optional[datetime]:
+        return _from_epoch(self.expires_epoch)
+
+    def is_active(self, now: Optional[datetime] = None) -> bool:
+        now = now or datetime.now()
+        return (
+            self.status == "active"
+            and self.expires_epoch is not None
+            and self.expires_epoch > now.timestamp()
+        )
+
+
+class UserRecord(NamedTuple):
+    user_id: int
+    username: str = ""
+    first_name: str = ""
+    join_epoch: Optional[int] = None
+    has_payment_attempt: bool = False
+
+    @property
+    def join_date(self) -> Optional[datetime]:
+        return _from_epoch(self.join_epoch)
+
+
+class ExpiryRecord(NamedTuple):
+    user_id: int
+    expires_epoch: int
+
+    @property
+    def expires_at(self) -> datetime:
+        return datetime.fromtimestamp(self.expires_epoch)
+
+
+class CancellationRecord(NamedTuple):
+    id: int
+    user_id: int
+    username: str
+    reason: str
+    cancelled_epoch: int
+
+    @property
+    def cancelled_at(self) -> datetime:
+        return datetime.fromtimestamp(self.cancelled_epoch)
+
+
+def subscription_factory(cursor, row) -> SubscriptionRecord:
+    return SubscriptionRecord._make(row)
+
+
+def user_factory(cursor, row) -> UserRecord:
+    user_id, username, first_name, join_epoch, has_attempt = row
+    return UserRecord(user_id, username or "", first_name or "", join_epoch, bool(has_attempt))
+
+
+def expiry_factory(cursor, row) -> ExpiryRecord:
+    return ExpiryRecord._make(row)
+
+
+def cancellation_factory(cursor, row) -> CancellationRecord:
+    record_id, user_id, username, reason, cancelled_epoch = row
+    return CancellationRecord(record_id, user_id, username or "", reason, cancelled_epoch)
+
+
+class ExpiryColumns:
+    """Пары (user_id, expires_at) в двух array('q'): 16 байт на строку."""
+
+    __slots__ = ("user_ids", "expires")
+
+    def __init__(self, rows: Iterable = ()) -> None:
+        self.user_ids = array("q")
+        self.expires = array("q")
+        for user_id, expires in rows:
+            self.user_ids.append(user_id)
+            self.expires.append(expires)
+
+    def __len__(self) -> int:
+        return len(self.user_ids)
+
+    def __iter__(self) -> Iterator[ExpiryRecord]:
+        return map(ExpiryRecord, self.user_ids, self.expires)
+
+    @property
+    def last_user_id(self) -> int:
+        return self.user_ids[-1]
+
+
+def users_page_result(rows: list, backwards: bool, limit: int) -> tuple:
+    """
+    Строки (user_id, username, first_name, join_date, status, expires_at)
+    keyset-страницы, выбранные с limit + 1: (пользователи-словари, has_more).
+    """
+    has_more = len(rows) > limit
+    rows = list(rows[:limit])
+    if backwards:
+        rows.reverse()
+    users = [
+        {
+            "user_id": row[0],
+            "username": row[1],
+            "first_name": row[2],
+            "join_date": row[3],
+            "sub_status": row[4],
+            "expires_at": row[5],
+        }
+        for row in rows
+    ]
+    return users, has_more
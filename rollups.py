@@ -0,0 +1,86 @@
+"""
+Дневные агрегаты (таблица daily_stats) и их отображение.
+
+Строки daily_stats обновляют триггеры SQLite на тех же записях, что и
+stats_counters, поэтому история за год читается одним запросом по
+первичному ключу, без сканирования users / subscriptions.
+"""
+
+from datetime import date, timedelta
+from typing import Dict, Iterable, List, Optional
+
+METRICS = ("signups", "new_subscriptions", "renewals", "cancellations", "expirations")
+
+METRIC_TITLES = {
+    "signups": "👥 Новые пользователи",
+    "new_subscriptions": "💎 Новые подписки",
+    "renewals": "🔁 Продления",
+    "cancellations": "❌ Отмены",
+    "expirations": "⌛ Истекли",
+}
+
+SERIES_WINDOWS = (30, 90, 365)
+
+# Таблица -> индексированная колонка времени создания записи (count_recent)
+RECENT_COLUMNS = {
+    "users": "join_date",
+    "subscriptions": "created_at",
+    "cancellations": "cancelled_at",
+}
+
+DAILY_STATS_SQL = f"""
+    SELECT day, {", ".join(METRICS)}
+    FROM daily_stats
+    WHERE day >= ?
+    ORDER BY day
+"""
+
+_SPARK_CHARS = "▁▂▃▄▅▆▇█"
+
+
+def series_start(days: int, today: Optional[date] = None) -> date:
+    """Первый день окна из days дней, заканчивающегося сегодня."""
+    return (today or date.today()) - timedelta(days=days - 1)
+
+
+def build_series(rows: Iterable, days: int, today: Optional[date] = None) -> Dict[str, List[int]]:
+    """
+    Плотные ряды по дням (дни без событий - нули) из строк DAILY_STATS_SQL.
+    Строка: (day 'YYYY-MM-DD', значения METRICS...).
+    """
+    start = series_start(days, today)
+    series = {metric: [0] * days for metric in METRICS}
+    for row in rows:
+        index = (date.fromisoformat(row[0]) - start).days
+        if 0 <= index < days:
+            for metric, value in zip(METRICS, row[1:]):
+                series[metric][index] = value or 0
+    return series
+
+
+def sparkline(values: List[int], width: int = 30) -> str:
+    """Мини-график: длинный ряд сворачивается в width столбцов суммированием."""
+    if not values:
+        return ""
+    step = max(1, -(-len(values) // width))
+    buckets = [sum(values[i:i + step]) for i in range(0, len(values), step)]
+    peak = max(buckets)
+    if peak == 0:
+        return _SPARK_CHARS[0] * len(buckets)
+    top = len(_SPARK_CHARS) - 1
+    return "".join(_SPARK_CHARS[round(value / peak * top)] for value in buckets)
+
+
+def render_report(series: Dict[str, List[int]], windows=SERIES_WINDOWS) -> List[str]:
+    """
+    Строки отчета: итоги за каждое окно и график за самое длинное.
+    series - ряды за max(windows) дней.
+    """
+    longest = max(windows)
+    lines = []
+    for metric in METRICS:
+        values = series[metric][-longest:]
+        totals = " / ".join(str(sum(values[-days:])) for days in windows)
+        lines.append(f"{METRIC_TITLES[metric]}: {totals}")
+        lines.append(f"  {sparkline(values)}")
+    return lines
@@ -1,60 +1,32 @@
 #!/usr/bin/env python3
-import sqlite3
-from datetime import datetime, timedelta
+"""
+Статистика бота из консоли. Читает текущее хранилище (DATABASE_URL или
+SQLite в DATABASE_PATH), как и сам бот.
 
-DB_PATH = "/root/subscription-bot-v2/data/bot.db"
+    python stats.py                 # сводка
+    python stats.py --check         # сверить счетчики stats_counters с таблицами
+    python stats.py --check --fix   # и исправить расхождения
+"""
 
+import argparse
+import asyncio
+import sys
 
-def get_stats():
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+import database
+import storage
+from config import DATABASE_URL
+from rollups import SERIES_WINDOWS, render_report
 
-    # Общая статистика
-    total_users = cursor.execute("SELECT COUNT(*) FROM users").fetchone()[0]
-    active_subs = cursor.execute(
-        "SELECT COUNT(*) FROM subscriptions WHERE status = 'active' AND expires_at > datetime('now')"
-    ).fetchone()[0]
-    cancelled_subs = cursor.execute(
-        "SELECT COUNT(*) FROM subscriptions WHERE status = 'cancelled'"
-    ).fetchone()[0]
 
-    # Периоды
-    now = datetime.now()
-    day_ago = now - timedelta(days=1)
-    week_ago = now - timedelta(days=7)
-    month_ago = now - timedelta(days=30)
+async def get_stats() -> None:
+    # Общая статистика - счетчики, которые ведут триггеры
+    counters = await storage.get_stats_counters()
+    total_users = counters.get("users_total", 0)
+    active_subs = counters.get("subscriptions_active", 0)
+    cancelled_subs = counters.get("subscriptions_cancelled", 0)
 
-    day_users = cursor.execute(
-        "SELECT COUNT(*) FROM users WHERE join_date > ?", (day_ago,)
-    ).fetchone()[0]
-
-    week_users = cursor.execute(
-        "SELECT COUNT(*) FROM users WHERE join_date > ?", (week_ago,)
-    ).fetchone()[0]
-
-    month_users = cursor.execute(
-        "SELECT COUNT(*) FROM users WHERE join_date > ?", (month_ago,)
-    ).fetchone()[0]
-
-    # Платежи (проверим есть ли created_at в subscriptions)
-    try:
-        day_pay = cursor.execute(
-            "SELECT COUNT(*) FROM subscriptions WHERE created_at > ?", (day_ago,)
-        ).fetchone()[0]
-
-        week_pay = cursor.execute(
-            "SELECT COUNT(*) FROM subscriptions WHERE created_at > ?", (week_ago,)
-        ).fetchone()[0]
-
-        month_pay = cursor.execute(
-            "SELECT COUNT(*) FROM subscriptions WHERE created_at > ?", (month_ago,)
-        ).fetchone()[0]
-
-        show_payments = True
-    except:
-        show_payments = False
-
-    conn.close()
+    # Динамика - из дневных агрегатов, одним запросом по первичному ключу
+    series = await storage.get_daily_series(max(SERIES_WINDOWS))
 
     print("=" * 50)
     print("📊 СТАТИСТИКА БОТА")
@@ -63,20 +35,46 @@ def get_stats():
     print(f"✅ Активных подписок: {active_subs}")
     print(f"❌ Отменённых подписок: {cancelled_subs}")
     print()
-    print("📈 НОВЫЕ ПОЛЬЗОВАТЕЛИ:")
-    print(f"  • За день:   {day_users}")
-    print(f"  • За неделю: {week_users}")
-    print(f"  • За месяц:  {month_users}")
+    print(f"📈 ДИНАМИКА ЗА {' / '.join(str(d) for d in SERIES_WINDOWS)} ДНЕЙ:")
+    for line in render_report(series):
+        print(f"  {line}")
+    print("=" * 50)
 
-    if show_payments:
-        print()
-        print("💰 НОВЫЕ ПОДПИСКИ:")
-        print(f"  • За день:   {day_pay}")
-        print(f"  • За неделю: {week_pay}")
-        print(f"  • За месяц:  {month_pay}")
 
-    print("=" * 50)
+async def check_counters(fix: bool = False) -> int:
+    """Пересчитывает счетчики по таблицам и печатает расхождения. Код выхода 1 - есть дрейф."""
+    drift = await storage.check_counters(fix)
+    if not drift:
+        print("✅ Счетчики совпадают с таблицами")
+        return 0
+    for name, (value, real) in drift.items():
+        print(f"⚠️ {name}: в счетчике {value}, в таблицах {real} ({real - value:+d})")
+    if fix:
+        print("🔧 Расхождения исправлены")
+        return 0
+    return 1
+
+
+async def main(args: argparse.Namespace) -> int:
+    await storage.init_storage()
+    try:
+        if args.check:
+            return await check_counters(fix=args.fix)
+        await get_stats()
+        return 0
+    finally:
+        await storage.close_storage()
 
 
 if __name__ == "__main__":
-    get_stats()
+    parser = argparse.ArgumentParser(description="Статистика бота")
+    parser.add_argument("--db", help="Путь к файлу SQLite вместо DATABASE_PATH")
+    parser.add_argument("--check", action="store_true", help="Сверить счетчики с таблицами")
+    parser.add_argument("--fix", action="store_true", help="Исправить расхождения (с --check)")
+    args = parser.parse_args()
+
+    if args.db:
+        if DATABASE_URL:
+            parser.error("--db задает файл SQLite, а DATABASE_URL указывает на PostgreSQL")
+        database.DATABASE_PATH = args.db
+    sys.exit(asyncio.run(main(args)))
@@ -0,0 +1,121 @@
+"""
+Хранилище бота: выбор реализации по DATABASE_URL.
+
+Пустой DATABASE_URL - SQLite (database.py), postgresql://... - PostgreSQL
+через asyncpg. Модули бота импортируют функции отсюда
+(from storage import get_subscription), каждая вызывает одноименный метод
+текущего хранилища.
+"""
+
+from typing import Optional
+
+from config import DATABASE_URL
+from storage.base import Storage
+from storage.sqlite import SqliteStorage
+
+_storage: Optional[Storage] = None
+
+
+def create_storage(url: str = DATABASE_URL) -> Storage:
+    if not url:
+        return SqliteStorage()
+    if url.startswith(("postgres://", "postgresql://")):
+        from storage.postgres import PostgresStorage
+
+        return PostgresStorage(url)
+    raise ValueError(f"Неизвестное хранилище: {url.split(':', 1)[0]}")
+
+
+def get_storage() -> Storage:
+    global _storage
+    if _storage is None:
+        _storage = create_storage()
+    return _storage
+
+
+def set_storage(storage: Optional[Storage]) -> None:
+    """Подменяет текущее хранилище (тесты, бенчмарк); None - снова по DATABASE_URL."""
+    global _storage
+    _storage = storage
+
+
+async def init_storage() -> Storage:
+    storage = get_storage()
+    await storage.init()
+    return storage
+
+
+async def close_storage() -> None:
+    if _storage is not None:
+        await _storage.close()
+
+
+def _forward(name: str):
+    async def call(*args, **kwargs):
+        return await getattr(get_storage(), name)(*args, **kwargs)
+
+    call.__name__ = call.__qualname__ = name
+    call.__doc__ = getattr(Storage, name).__doc__
+    return call
+
+
+flush_user_writes = _forward("flush_user_writes")
+
+save_user = _forward("save_user")
+load_user_context = _forward("load_user_context")
+mark_payment_attempt = _forward("mark_payment_attempt")
+has_payment_attempt = _forward("has_payment_attempt")
+get_user = _forward("get_user")
+get_all_users = _forward("get_all_users")
+count_users = _forward("count_users")
+search_users = _forward("search_users")
+find_users_by_usernames = _forward("find_users_by_usernames")
+get_users_page = _forward("get_users_page")
+
+get_subscription = _forward("get_subscription")
+is_subscription_active = _forward("is_subscription_active")
+create_subscription = _forward("create_subscription")
+update_subscription_period = _forward("update_subscription_period")
+cancel_subscription = _forward("cancel_subscription")
+expire_subscription = _forward("expire_subscription")
+expire_subscriptions = _forward("expire_subscriptions")
+get_subscription_by_stripe_id = _forward("get_subscription_by_stripe_id")
+
+get_expiring_subscriptions = _forward("get_expiring_subscriptions")
+get_expiring_columns = _forward("get_expiring_columns")
+get_expired_active_subscriptions = _forward("get_expired_active_subscriptions")
+get_expired_active_columns = _forward("get_expired_active_columns")
+get_upcoming_expiries = _forward("get_upcoming_expiries")
+mark_notification = _forward("mark_notification")
+mark_notifications = _forward("mark_notifications")
+
+get_checkout_session = _forward("get_checkout_session")
+save_checkout_session = _forward("save_checkout_session")
+delete_checkout_sessions = _forward("delete_checkout_sessions")
+purge_expired_checkout_sessions = _forward("purge_expired_checkout_sessions")
+
+load_fsm_state = _forward("load_fsm_state")
+save_fsm_states = _forward("save_fsm_states")
+purge_fsm_states = _forward("purge_fsm_states")
+
+save_cancellation_reason = _forward("save_cancellation_reason")
+count_user_cancellations = _forward("count_user_cancellations")
+recent_cancellations = _forward("recent_cancellations")
+search_cancellations = _forward("search_cancellations")
+index_cancellation_terms = _forward("index_cancellation_terms")
+churn_themes = _forward("churn_themes")
+
+get_stats_counters = _forward("get_stats_counters")
+check_counters = _forward("check_counters")
+count_recent = _forward("count_recent")
+get_daily_series = _forward("get_daily_series")
+get_user_stats = _forward("get_user_stats")
+stats_report = _forward("stats_report")
+users_page = _forward("users_page")
+export_users_csv = _forward("export_users_csv")
+
+create_broadcast_job = _forward("create_broadcast_job")
+get_unfinished_broadcast_jobs = _forward("get_unfinished_broadcast_jobs")
+reserve_broadcast_recipients = _forward("reserve_broadcast_recipients")
+record_broadcast_results = _forward("record_broadcast_results")
+finish_broadcast_job = _forward("finish_broadcast_job")
@@ -0,0 +1,290 @@
+"""
+Интерфейс хранилища: все запросы бота к БД.
+
+Реализации: SqliteStorage (database.py, один писатель на файл) и
+PostgresStorage (asyncpg, пул соединений, конкурентная запись).
+Обе возвращают одни и те же типы - записи из records.py, словари и
+array('q') - и проходят общий набор тестов tests/test_storage.py.
+"""
+
+from abc import ABC, abstractmethod
+from array import array
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from config import EXPORT_GZIP
+from export import PART_SIZE_LIMIT
+from records import CancellationRecord, ExpiryColumns, ExpiryRecord, SubscriptionRecord, UserRecord
+from rollups import SERIES_WINDOWS
+
+Tokenizer = Callable[[str], List[str]]
+
+
+class Storage(ABC):
+    name: str = ""
+
+    # ---------- жизненный цикл ----------
+
+    @abstractmethod
+    async def init(self) -> None:
+        """Открывает соединения и приводит схему к текущей версии."""
+
+    @abstractmethod
+    async def close(self) -> None:
+        """Сбрасывает отложенные записи и закрывает соединения."""
+
+    @abstractmethod
+    def stats(self) -> Dict:
+        """Диагностика: {"backend", "cache", ...} плюс метрики пула конкретной БД."""
+
+    async def flush_user_writes(self) -> int:
+        """Сбрасывает отложенные записи users, если хранилище их копит."""
+        return 0
+
+    # ---------- пользователи ----------
+
+    @abstractmethod
+    async def save_user(
+        self, user_id: int, username: Optional[str] = None, first_name: Optional[str] = None
+    ) -> None: ...
+
+    @abstractmethod
+    async def load_user_context(
+        self, user_id: int, username: Optional[str] = None, first_name: Optional[str] = None
+    ) -> Dict:
+        """
+        Сохраняет пользователя и возвращает данные для главного меню:
+        {user_id, has_payment_attempt, status, expires_at, is_active}.
+        """
+
+    @abstractmethod
+    async def mark_payment_attempt(self, user_id: int) -> None: ...
+
+    @abstractmethod
+    async def has_payment_attempt(self, user_id: int) -> bool: ...
+
+    @abstractmethod
+    async def get_user(self, user_id: int) -> Optional[UserRecord]: ...
+
+    @abstractmethod
+    async def get_all_users(self) -> List[UserRecord]: ...
+
+    @abstractmethod
+    async def count_users(self) -> int: ...
+
+    @abstractmethod
+    async def search_users(
+        self, query: str, after_user_id: int = 0, limit: int = 10
+    ) -> Tuple[List[UserRecord], bool]:
+        """Число - user_id, @name или короткий текст - префикс username, иначе подстрока."""
+
+    @abstractmethod
+    async def find_users_by_usernames(self, usernames: List[str]) -> Dict[str, int]: ...
+
+    @abstractmethod
+    async def get_users_page(
+        self, cursor: Optional[tuple] = None, backwards: bool = False, limit: int = 10
+    ) -> tuple:
+        """Keyset-страница по (join_date, user_id), новые сверху: (пользователи, has_more)."""
+
+    # ---------- подписки ----------
+
+    @abstractmethod
+    async def get_subscription(self, user_id: int) -> Optional[SubscriptionRecord]: ...
+
+    async def is_subscription_active(self, user_id: int) -> bool:
+        sub = await self.get_subscription(user_id)
+        return sub.is_active() if sub else False
+
+    @abstractmethod
+    async def create_subscription(
+        self,
+        user_id: int,
+        payment_provider: str,
+        invite_link: str,
+        days: int = 30,
+        stripe_customer_id: Optional[str] = None,
+        stripe_subscription_id: Optional[str] = None,
+    ) -> None: ...
+
+    @abstractmethod
+    async def update_subscription_period(self, user_id: int, new_expires_at: datetime) -> None: ...
+
+    @abstractmethod
+    async def cancel_subscription(self, user_id: int) -> None: ...
+
+    @abstractmethod
+    async def expire_subscription(self, user_id: int) -> None: ...
+
+    @abstractmethod
+    async def expire_subscriptions(self, user_ids: Sequence[int]) -> List[int]:
+        """Активные и уже истекшие из user_ids - в expired; возвращает переведенные user_id."""
+
+    @abstractmethod
+    async def get_subscription_by_stripe_id(self, stripe_subscription_id: str) -> Optional[Dict]: ...
+
+    # ---------- планировщик подписок ----------
+
+    @abstractmethod
+    async def get_expiring_subscriptions(
+        self, days: int = 3, after_user_id: int = 0, limit: Optional[int] = None
+    ) -> List[ExpiryRecord]: ...
+
+    @abstractmethod
+    async def get_expiring_columns(
+        self, days: int = 3, after_user_id: int = 0, limit: Optional[int] = None
+    ) -> ExpiryColumns: ...
+
+    @abstractmethod
+    async def get_expired_active_subscriptions(
+        self, after_user_id: int = 0, limit: Optional[int] = None
+    ) -> List[ExpiryRecord]: ...
+
+    @abstractmethod
+    async def get_expired_active_columns(
+        self, after_user_id: int = 0, limit: Optional[int] = None
+    ) -> ExpiryColumns: ...
+
+    @abstractmethod
+    async def get_upcoming_expiries(self, after: datetime, until: datetime) -> ExpiryColumns: ...
+
+    @abstractmethod
+    async def mark_notification(self, user_id: int, notification_type: str) -> None: ...
+
+    @abstractmethod
+    async def mark_notifications(self, user_ids: List[int], notification_type: str) -> None: ...
+
+    # ---------- Checkout Sessions ----------
+
+    @abstractmethod
+    async def get_checkout_session(self, user_id: int, price_id: str) -> Optional[Dict]: ...
+
+    @abstractmethod
+    async def save_checkout_session(
+        self, user_id: int, price_id: str, url: str, expires_at: datetime
+    ) -> None: ...
+
+    @abstractmethod
+    async def delete_checkout_sessions(self, user_id: int) -> None: ...
+
+    @abstractmethod
+    async def purge_expired_checkout_sessions(self) -> int: ...
+
+    # ---------- FSM ----------
+
+    @abstractmethod
+    async def load_fsm_state(
+        self, key: str, since: datetime
+    ) -> Optional[Tuple[Optional[str], str, int]]:
+        """(state, data JSON, updated_at) состояния, измененного не раньше since."""
+
+    @abstractmethod
+    async def save_fsm_states(self, rows: List[tuple]) -> None:
+        """
+        Пачка (key, state, data JSON, updated_at): пустое состояние (None, "{}")
+        удаляет строку, запись старше сохраненной пропускается.
+        """
+
+    @abstractmethod
+    async def purge_fsm_states(self, before: datetime) -> int: ...
+
+    # ---------- отмены ----------
+
+    @abstractmethod
+    async def save_cancellation_reason(
+        self,
+        user_id: int,
+        username: Optional[str],
+        reason: str,
+        subscription_id: Optional[str] = None,
+    ) -> None: ...
+
+    @abstractmethod
+    async def count_user_cancellations(self, user_id: int) -> int: ...
+
+    @abstractmethod
+    async def recent_cancellations(self, limit: int = 20) -> list:
+        """Строки (username, reason, cancelled_at), новые сверху."""
+
+    @abstractmethod
+    async def search_cancellations(
+        self, query: str, before_id: Optional[int] = None, limit: int = 10
+    ) -> Tuple[List[CancellationRecord], List[str], bool]:
+        """(записи, фрагменты с маркерами analytics.MATCH_START/MATCH_END, has_more)."""
+
+    @abstractmethod
+    async def index_cancellation_terms(self, batch_size: int, tokenize: Tokenizer) -> int:
+        """Пачка новых причин в cancellation_terms. Возвращает число обработанных."""
+
+    @abstractmethod
+    async def churn_themes(
+        self, days: int = 30, limit: int = 10, today: Optional[date] = None
+    ) -> Dict:
+        """{"themes": [(термин, число причин)], "pending": не проиндексировано отмен}."""
+
+    # ---------- статистика ----------
+
+    @abstractmethod
+    async def get_stats_counters(self) -> Dict[str, int]: ...
+
+    @abstractmethod
+    async def check_counters(self, fix: bool = False) -> Dict[str, Tuple[int, int]]:
+        """
+        Сверка stats_counters с migrations.COUNTER_SOURCES_SQL: {счетчик: (в
+        счетчике, в таблицах)} для расходящихся; fix=True записывает значения из таблиц.
+        """
+
+    @abstractmethod
+    async def count_recent(self, table: str, since: datetime) -> int: ...
+
+    @abstractmethod
+    async def get_daily_series(self, days: int) -> Dict[str, List[int]]: ...
+
+    @abstractmethod
+    async def stats_report(self, since: datetime, days: int = max(SERIES_WINDOWS)) -> Dict:
+        """{"counters", "recent": {users, subscriptions, cancellations}, "series"} из одного снимка."""
+
+    @abstractmethod
+    async def users_page(
+        self, cursor: Optional[tuple] = None, backwards: bool = False, limit: int = 10
+    ) -> tuple:
+        """Как get_users_page() плюс общее число из того же снимка: (users, has_more, total)."""
+
+    @abstractmethod
+    async def export_users_csv(
+        self, compress: bool = EXPORT_GZIP, part_limit: int = PART_SIZE_LIMIT
+    ) -> Tuple[List[Path], int]:
+        """
+        Потоковый экспорт export.EXPORT_QUERY с одного снимка во временный
+        каталог: (файлы частей, число строк), каталог удаляет export.cleanup_export().
+        """
+
+    async def get_user_stats(self) -> str:
+        counters = await self.get_stats_counters()
+        cancellations = await self.count_recent("cancellations", datetime.now() - timedelta(days=7))
+        return (
+            f"👥 Всего пользователей: {counters.get('users_total', 0)}\n"
+            f"💎 Активных подписок: {counters.get('subscriptions_active', 0)}\n"
+            f"❌ Отмен за 7 дней: {cancellations}"
+        )
+
+    # ---------- рассылки ----------
+
+    @abstractmethod
+    async def create_broadcast_job(
+        self, text: str, status_chat_id: int, status_message_id: int, total: int
+    ) -> int: ...
+
+    @abstractmethod
+    async def get_unfinished_broadcast_jobs(self) -> List[Dict]: ...
+
+    @abstractmethod
+    async def reserve_broadcast_recipients(self, job_id: int, limit: int) -> array:
+        """Следующие получатели (keyset по user_id), сразу записанные как pending."""
+
+    @abstractmethod
+    async def record_broadcast_results(self, job_id: int, results: List[tuple]) -> None: ...
+
+    @abstractmethod
+    async def finish_broadcast_job(self, job_id: int) -> Dict: ...
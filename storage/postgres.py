@@ -0,0 +1,1161 @@
+"""
+PostgreSQL-хранилище на asyncpg.
+
+Пул соединений POSTGRES_POOL_MIN..POSTGRES_POOL_MAX, каждая запись - своя
+короткая транзакция, поэтому записи разных пользователей идут параллельно
+(в SQLite они выстраиваются в очередь единственного писателя). Схема та же,
+что в SQLite: время - BIGINT секунды Unix, счетчики stats_counters и дневные
+агрегаты daily_stats ведут триггеры на plpgsql (построчно по шардам, см.
+COUNTER_SHARDS). Дни считаются в часовом поясе
+сессии (POSTGRES_TIMEZONE или TZ процесса), как localtime в SQLite.
+
+Поиск по причинам отмен - GIN-индекс по to_tsvector('simple', reason),
+поиск подстроки в users использует pg_trgm, если расширение доступно.
+Кэш подписок локален для процесса: при нескольких экземплярах бота
+чужие изменения видны не позже чем через SUBSCRIPTION_CACHE_TTL.
+"""
+
+import asyncio
+import logging
+import os
+import re
+from array import array
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+try:
+    import asyncpg
+except ImportError:  # asyncpg нужен только для PostgreSQL
+    asyncpg = None
+
+from analytics import MATCH_END, MATCH_START
+from config import (
+    EXPORT_GZIP,
+    POSTGRES_POOL_MAX,
+    POSTGRES_POOL_MIN,
+    POSTGRES_TIMEZONE,
+    SUBSCRIPTION_CACHE_SIZE,
+    SUBSCRIPTION_CACHE_TTL,
+)
+from database import (
+    FSM_EMPTY_DATA,
+    TTLCache,
+    from_epoch,
+    notify_subscription_listeners,
+    to_epoch,
+)
+from export import EXPORT_BATCH_SIZE, EXPORT_QUERY, PART_SIZE_LIMIT, ExportWriter, export_dir
+from migrations import COUNTER_SOURCES_SQL, counter_drift
+from records import (
+    CANCELLATION_COLUMNS,
+    SUBSCRIPTION_COLUMNS,
+    USER_COLUMNS,
+    CancellationRecord,
+    ExpiryColumns,
+    ExpiryRecord,
+    SubscriptionRecord,
+    UserRecord,
+    cancellation_factory,
+    expiry_factory,
+    user_factory,
+    users_page_result,
+)
+from rollups import METRICS, RECENT_COLUMNS, SERIES_WINDOWS, build_series, series_start
+from storage.base import Storage, Tokenizer
+
+logger = logging.getLogger(__name__)
+
+_NOW_EPOCH = "(extract(epoch FROM now())::bigint)"
+# Ключ pg_advisory_xact_lock: схему обновляет один экземпляр бота
+_SCHEMA_LOCK = 7_340_021
+_NO_UPPER_BOUND = 2**63 - 1
+# Счетчики и дневные агрегаты разложены по строкам-шардам (по pid соединения),
+# чтобы параллельные транзакции не ждали блокировку одной строки; читаются SUM
+COUNTER_SHARDS = 16
+
+TABLES = (
+    "users",
+    "subscriptions",
+    "cancellations",
+    "subscription_notifications",
+    "checkout_sessions",
+    "broadcast_jobs",
+    "broadcast_deliveries",
+    "stats_counters",
+    "daily_stats",
+    "cancellation_terms",
+    "job_state",
+    "fsm_states",
+)
+
+SCHEMA = [
+    f"""
+    CREATE TABLE IF NOT EXISTS users (
+        user_id BIGINT PRIMARY KEY,
+        username TEXT,
+        first_name TEXT,
+        join_date BIGINT NOT NULL DEFAULT {_NOW_EPOCH},
+        has_payment_attempt BOOLEAN NOT NULL DEFAULT FALSE
+    )
+    """,
+    f"""
+    CREATE TABLE IF NOT EXISTS subscriptions (
+        id BIGSERIAL PRIMARY KEY,
+        user_id BIGINT NOT NULL UNIQUE,
+        expires_at BIGINT NOT NULL,
+        invite_link TEXT,
+        payment_provider TEXT,
+        stripe_customer_id TEXT,
+        stripe_subscription_id TEXT,
+        status TEXT DEFAULT 'active',
+        created_at BIGINT NOT NULL DEFAULT {_NOW_EPOCH}
+    )
+    """,
+    f"""
+    CREATE TABLE IF NOT EXISTS cancellations (
+        id BIGSERIAL PRIMARY KEY,
+        user_id BIGINT NOT NULL,
+        username TEXT,
+        reason TEXT NOT NULL,
+        subscription_id TEXT,
+        cancelled_at BIGINT NOT NULL DEFAULT {_NOW_EPOCH}
+    )
+    """,
+    f"""
+    CREATE TABLE IF NOT EXISTS subscription_notifications (
+        user_id BIGINT NOT NULL,
+        notification_type TEXT NOT NULL,
+        sent_at BIGINT NOT NULL DEFAULT {_NOW_EPOCH},
+        PRIMARY KEY (user_id, notification_type)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS checkout_sessions (
+        user_id BIGINT NOT NULL,
+        price_id TEXT NOT NULL,
+        url TEXT NOT NULL,
+        expires_at BIGINT NOT NULL,
+        PRIMARY KEY (user_id, price_id)
+    )
+    """,
+    f"""
+    CREATE TABLE IF NOT EXISTS broadcast_jobs (
+        id BIGSERIAL PRIMARY KEY,
+        text TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'running',
+        status_chat_id BIGINT,
+        status_message_id BIGINT,
+        total INTEGER NOT NULL DEFAULT 0,
+        last_user_id BIGINT NOT NULL DEFAULT 0,
+        sent INTEGER NOT NULL DEFAULT 0,
+        failed INTEGER NOT NULL DEFAULT 0,
+        created_at BIGINT NOT NULL DEFAULT {_NOW_EPOCH},
+        finished_at BIGINT
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+        job_id BIGINT NOT NULL,
+        user_id BIGINT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        PRIMARY KEY (job_id, user_id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS stats_counters (
+        name TEXT NOT NULL,
+        shard SMALLINT NOT NULL DEFAULT 0,
+        value BIGINT NOT NULL DEFAULT 0,
+        PRIMARY KEY (name, shard)
+    )
+    """,
+    f"""
+    CREATE TABLE IF NOT EXISTS daily_stats (
+        day DATE NOT NULL,
+        shard SMALLINT NOT NULL DEFAULT 0,
+        {", ".join(f"{metric} INTEGER NOT NULL DEFAULT 0" for metric in METRICS)},
+        PRIMARY KEY (day, shard)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS cancellation_terms (
+        day DATE NOT NULL,
+        term TEXT NOT NULL,
+        count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, term)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS job_state (
+        name TEXT PRIMARY KEY,
+        value BIGINT NOT NULL DEFAULT 0
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS fsm_states (
+        key TEXT PRIMARY KEY,
+        state TEXT,
+        data TEXT NOT NULL DEFAULT '{}',
+        updated_at BIGINT NOT NULL
+    )
+    """,
+    "INSERT INTO job_state (name, value) VALUES ('cancellation_terms', 0) ON CONFLICT DO NOTHING",
+    # Счетчики заполняются по таблицам только при первом создании
+    f"""
+    INSERT INTO stats_counters (name, value)
+    SELECT name, value FROM ({COUNTER_SOURCES_SQL}) AS sources (name, value)
+    WHERE NOT EXISTS (SELECT 1 FROM stats_counters)
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_sub_active_expires ON subscriptions(expires_at) WHERE status = 'active'",
+    "CREATE INDEX IF NOT EXISTS idx_sub_stripe ON subscriptions(stripe_subscription_id)",
+    "CREATE INDEX IF NOT EXISTS idx_sub_created ON subscriptions(created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_users_list ON users(join_date, user_id)",
+    "CREATE INDEX IF NOT EXISTS idx_users_username_lower ON users(lower(username) text_pattern_ops)",
+    "CREATE INDEX IF NOT EXISTS idx_cancellations_date ON cancellations(cancelled_at)",
+    "CREATE INDEX IF NOT EXISTS idx_cancellations_user ON cancellations(user_id)",
+    """
+    CREATE INDEX IF NOT EXISTS idx_cancellations_fts
+    ON cancellations USING gin (to_tsvector('simple', reason))
+    """,
+    f"""
+    CREATE OR REPLACE FUNCTION bump_counter(counter TEXT, delta BIGINT) RETURNS void AS $$
+        INSERT INTO stats_counters (name, shard, value)
+        VALUES (counter, pg_backend_pid() % {COUNTER_SHARDS}, delta)
+        ON CONFLICT (name, shard) DO UPDATE SET value = stats_counters.value + EXCLUDED.value;
+    $$ LANGUAGE sql
+    """,
+    f"""
+    CREATE OR REPLACE FUNCTION bump_daily(stat_day DATE, metric TEXT) RETURNS void AS $$
+    BEGIN
+        EXECUTE format(
+            'INSERT INTO daily_stats (day, shard, %1$I) VALUES ($1, $2, 1) '
+            'ON CONFLICT (day, shard) DO UPDATE SET %1$I = daily_stats.%1$I + 1',
+            metric
+        ) USING stat_day, pg_backend_pid() % {COUNTER_SHARDS};
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE OR REPLACE FUNCTION users_stats() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            PERFORM bump_counter('users_total', 1);
+            PERFORM bump_daily(to_timestamp(NEW.join_date)::date, 'signups');
+        ELSE
+            PERFORM bump_counter('users_total', -1);
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE OR REPLACE TRIGGER trg_users_stats AFTER INSERT OR DELETE ON users
+    FOR EACH ROW EXECUTE FUNCTION users_stats()
+    """,
+    # Те же правила, что у триггеров SQLite (migrations.py): продление -
+    # срок активной подписки сдвинут вперед, отмена и истечение - смена статуса
+    """
+    CREATE OR REPLACE FUNCTION subscriptions_stats() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            PERFORM bump_counter('subscriptions_total', 1);
+            PERFORM bump_counter('subscriptions_' || COALESCE(NEW.status, 'none'), 1);
+            PERFORM bump_daily(to_timestamp(NEW.created_at)::date, 'new_subscriptions');
+        ELSIF TG_OP = 'UPDATE' THEN
+            IF OLD.status IS DISTINCT FROM NEW.status THEN
+                PERFORM bump_counter('subscriptions_' || COALESCE(OLD.status, 'none'), -1);
+                PERFORM bump_counter('subscriptions_' || COALESCE(NEW.status, 'none'), 1);
+            END IF;
+            IF NEW.status = 'active' AND NEW.expires_at > OLD.expires_at THEN
+                PERFORM bump_daily(current_date, 'renewals');
+            END IF;
+            IF NEW.status = 'cancelled' AND OLD.status IS DISTINCT FROM 'cancelled' THEN
+                PERFORM bump_daily(current_date, 'cancellations');
+            END IF;
+            IF NEW.status = 'expired' AND OLD.status IS DISTINCT FROM 'expired' THEN
+                PERFORM bump_daily(current_date, 'expirations');
+            END IF;
+        ELSE
+            PERFORM bump_counter('subscriptions_total', -1);
+            PERFORM bump_counter('subscriptions_' || COALESCE(OLD.status, 'none'), -1);
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE OR REPLACE TRIGGER trg_subscriptions_stats
+    AFTER INSERT OR UPDATE OF status, expires_at OR DELETE ON subscriptions
+    FOR EACH ROW EXECUTE FUNCTION subscriptions_stats()
+    """,
+    """
+    CREATE OR REPLACE FUNCTION cancellations_stats() RETURNS trigger AS $$
+    BEGIN
+        PERFORM bump_counter('cancellations_total', CASE WHEN TG_OP = 'INSERT' THEN 1 ELSE -1 END);
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE OR REPLACE TRIGGER trg_cancellations_stats AFTER INSERT OR DELETE ON cancellations
+    FOR EACH ROW EXECUTE FUNCTION cancellations_stats()
+    """,
+]
+
+# Поиск подстроки в users без полного прохода; без pg_trgm работает медленнее
+TRIGRAM_SCHEMA = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    """
+    CREATE INDEX IF NOT EXISTS idx_users_name_trgm
+    ON users USING gin (username gin_trgm_ops, first_name gin_trgm_ops)
+    """,
+]
+
+USER_SEARCH_MIN_SUBSTRING = 3
+
+_HEADLINE_OPTIONS = f"StartSel={MATCH_START}, StopSel={MATCH_END}, MaxWords=16, MinWords=6"
+
+EXPIRING_SUBSCRIPTIONS_SQL = """
+    SELECT s.user_id, s.expires_at
+    FROM subscriptions s
+    WHERE s.status = 'active'
+      AND s.expires_at > $1
+      AND s.expires_at <= $2
+      AND s.user_id > $3
+      AND NOT EXISTS (
+          SELECT 1 FROM subscription_notifications n
+          WHERE n.user_id = s.user_id
+            AND n.notification_type = $4
+      )
+    ORDER BY s.user_id
+    LIMIT $5
+"""
+
+EXPIRED_ACTIVE_SUBSCRIPTIONS_SQL = """
+    SELECT user_id, expires_at
+    FROM subscriptions
+    WHERE status = 'active' AND expires_at <= $1 AND user_id > $2
+    ORDER BY user_id
+    LIMIT $3
+"""
+
+DAILY_STATS_SQL = f"""
+    SELECT day::text, {", ".join(f"SUM({metric})::int" for metric in METRICS)}
+    FROM daily_stats
+    WHERE day >= $1
+    GROUP BY day
+    ORDER BY day
+"""
+
+STATS_COUNTERS_SQL = "SELECT name, SUM(value)::bigint FROM stats_counters GROUP BY name"
+USERS_TOTAL_SQL = "SELECT SUM(value)::bigint FROM stats_counters WHERE name = 'users_total'"
+
+
+def local_timezone() -> str:
+    """Часовой пояс сессий: POSTGRES_TIMEZONE, TZ или /etc/localtime процесса."""
+    if POSTGRES_TIMEZONE:
+        return POSTGRES_TIMEZONE
+    if os.environ.get("TZ"):
+        return os.environ["TZ"].lstrip(":")
+    target = os.path.realpath("/etc/localtime")
+    if "zoneinfo/" in target:
+        return target.split("zoneinfo/", 1)[1]
+    return "UTC"
+
+
+def _rowcount(status: str) -> int:
+    """Число строк из статуса команды asyncpg ('UPDATE 3', 'DELETE 0')."""
+    return int(status.split()[-1])
+
+
+def _like_prefix(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _expiring_params(days: int, after_user_id: int, limit: Optional[int]) -> tuple:
+    now = datetime.now()
+    return (
+        to_epoch(now),
+        to_epoch(now + timedelta(days=days)),
+        after_user_id,
+        f"expiry_{days}d",
+        limit,
+    )
+
+
+def _users_page_sql(cursor: Optional[tuple], backwards: bool, limit: int) -> tuple:
+    where = ""
+    params: list = []
+    if cursor is not None:
+        where = "WHERE (u.join_date, u.user_id) > ($1, $2)" if backwards else "WHERE (u.join_date, u.user_id) < ($1, $2)"
+        params.extend(cursor)
+    order = "ASC" if backwards else "DESC"
+    params.append(limit + 1)
+    sql = f"""
+        SELECT u.user_id, u.username, u.first_name, u.join_date,
+               s.status, s.expires_at
+        FROM users u
+        LEFT JOIN subscriptions s ON u.user_id = s.user_id
+        {where}
+        ORDER BY u.join_date {order}, u.user_id {order}
+        LIMIT ${len(params)}
+    """
+    return sql, params
+
+
+class PostgresStorage(Storage):
+    name = "postgres"
+
+    def __init__(
+        self,
+        dsn: str,
+        min_size: int = POSTGRES_POOL_MIN,
+        max_size: int = POSTGRES_POOL_MAX,
+        timezone: Optional[str] = None,
+    ) -> None:
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timezone = timezone or local_timezone()
+        self.trigram = False
+        self._pool = None
+        self._cache = TTLCache(SUBSCRIPTION_CACHE_SIZE, SUBSCRIPTION_CACHE_TTL)
+
+    # ---------- жизненный цикл ----------
+
+    async def init(self) -> None:
+        if asyncpg is None:
+            raise RuntimeError("Для PostgreSQL нужен пакет asyncpg (pip install asyncpg)")
+        await self.close()
+        self._cache.clear()
+        self._pool = await asyncpg.create_pool(
+            self.dsn,
+            min_size=self.min_size,
+            max_size=self.max_size,
+            server_settings={"timezone": self.timezone, "application_name": "subscription-bot"},
+        )
+        async with self._pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("SELECT pg_advisory_xact_lock($1)", _SCHEMA_LOCK)
+                for statement in SCHEMA:
+                    await conn.execute(statement)
+                try:
+                    async with conn.transaction():
+                        for statement in TRIGRAM_SCHEMA:
+                            await conn.execute(statement)
+                    self.trigram = True
+                except asyncpg.PostgresError as e:
+                    logger.warning(f"⚠️ pg_trgm недоступен, поиск подстроки без индекса: {e}")
+        logger.info(
+            f"✅ PostgreSQL: пул {self.min_size}..{self.max_size} соединений, "
+            f"часовой пояс {self.timezone}"
+        )
+
+    async def close(self) -> None:
+        if self._pool is not None:
+            pool, self._pool = self._pool, None
+            await pool.close()
+            logger.info("🛑 Пул соединений PostgreSQL закрыт")
+
+    def stats(self) -> Dict:
+        pool = None
+        if self._pool is not None:
+            pool = {
+                "size": self._pool.get_size(),
+                "idle": self._pool.get_idle_size(),
+                "min": self.min_size,
+                "max": self.max_size,
+            }
+        return {"backend": self.name, "cache": self._cache.stats(), "pool": pool}
+
+    def _subscription_changed(self, user_id: int, expires_at: Optional[datetime]) -> None:
+        self._cache.invalidate(user_id)
+        notify_subscription_listeners(user_id, expires_at)
+
+    async def _fetch(self, sql: str, *params) -> list:
+        async with self._pool.acquire() as conn:
+            return await conn.fetch(sql, *params)
+
+    async def _fetchrow(self, sql: str, *params):
+        async with self._pool.acquire() as conn:
+            return await conn.fetchrow(sql, *params)
+
+    async def _fetchval(self, sql: str, *params):
+        async with self._pool.acquire() as conn:
+            return await conn.fetchval(sql, *params)
+
+    async def _execute(self, sql: str, *params) -> str:
+        async with self._pool.acquire() as conn:
+            return await conn.execute(sql, *params)
+
+    # ---------- пользователи ----------
+
+    async def save_user(
+        self, user_id: int, username: Optional[str] = None, first_name: Optional[str] = None
+    ) -> None:
+        await self._execute(
+            """
+            INSERT INTO users (user_id, username, first_name) VALUES ($1, $2, $3)
+            ON CONFLICT (user_id) DO UPDATE SET
+                username = EXCLUDED.username,
+                first_name = EXCLUDED.first_name
+            WHERE users.username IS DISTINCT FROM EXCLUDED.username
+               OR users.first_name IS DISTINCT FROM EXCLUDED.first_name
+            """,
+            user_id,
+            username or "",
+            first_name or "",
+        )
+
+    async def load_user_context(
+        self, user_id: int, username: Optional[str] = None, first_name: Optional[str] = None
+    ) -> Dict:
+        """Upsert профиля (без записи, если он не изменился) и чтение подписки - один запрос."""
+        generation = self._cache.generation
+        row = await self._fetchrow(
+            f"""
+            WITH saved AS (
+                INSERT INTO users (user_id, username, first_name) VALUES ($1, $2, $3)
+                ON CONFLICT (user_id) DO UPDATE SET
+                    username = EXCLUDED.username,
+                    first_name = EXCLUDED.first_name
+                WHERE users.username IS DISTINCT FROM EXCLUDED.username
+                   OR users.first_name IS DISTINCT FROM EXCLUDED.first_name
+            )
+            SELECT u.has_payment_attempt, {SUBSCRIPTION_COLUMNS}
+            FROM (SELECT $1::bigint AS id) q
+            LEFT JOIN users u ON u.user_id = q.id
+            LEFT JOIN subscriptions s ON s.user_id = q.id
+            """,
+            user_id,
+            username or "",
+            first_name or "",
+        )
+        sub = SubscriptionRecord._make(tuple(row)[1:]) if row["status"] is not None else None
+        self._cache.put(user_id, sub, generation)
+        return {
+            "user_id": user_id,
+            "has_payment_attempt": bool(row["has_payment_attempt"]),
+            "status": sub.status if sub else None,
+            "expires_at": sub.expires_at if sub else None,
+            "is_active": sub.is_active() if sub else False,
+        }
+
+    async def mark_payment_attempt(self, user_id: int) -> None:
+        await self._execute(
+            "UPDATE users SET has_payment_attempt = TRUE WHERE user_id = $1 AND NOT has_payment_attempt",
+            user_id,
+        )
+
+    async def has_payment_attempt(self, user_id: int) -> bool:
+        return bool(
+            await self._fetchval("SELECT has_payment_attempt FROM users WHERE user_id = $1", user_id)
+        )
+
+    async def get_user(self, user_id: int) -> Optional[UserRecord]:
+        rows = await self._fetch(f"SELECT {USER_COLUMNS} FROM users u WHERE u.user_id = $1", user_id)
+        return user_factory(None, rows[0]) if rows else None
+
+    async def get_all_users(self) -> List[UserRecord]:
+        rows = await self._fetch(f"SELECT {USER_COLUMNS} FROM users u ORDER BY u.join_date DESC")
+        return [user_factory(None, row) for row in rows]
+
+    async def count_users(self) -> int:
+        value = await self._fetchval(USERS_TOTAL_SQL)
+        if value is not None:
+            return value
+        return await self._fetchval("SELECT COUNT(*) FROM users")
+
+    async def search_users(
+        self, query: str, after_user_id: int = 0, limit: int = 10
+    ) -> Tuple[List[UserRecord], bool]:
+        query = query.strip()
+        if query.isdigit():
+            sql = f"SELECT {USER_COLUMNS} FROM users u WHERE u.user_id = $1 AND u.user_id > $2 LIMIT $3"
+            params = (int(query), after_user_id, limit + 1)
+        elif query.startswith("@") or len(query) < USER_SEARCH_MIN_SUBSTRING:
+            prefix = query.lstrip("@").lower()
+            if not prefix:
+                return [], False
+            sql = f"""
+                SELECT {USER_COLUMNS} FROM users u
+                WHERE lower(u.username) LIKE $1 AND u.user_id > $2
+                ORDER BY u.user_id
+                LIMIT $3
+            """
+            params = (_like_prefix(prefix) + "%", after_user_id, limit + 1)
+        else:
+            sql = f"""
+                SELECT {USER_COLUMNS} FROM users u
+                WHERE (u.username ILIKE $1 OR u.first_name ILIKE $1) AND u.user_id > $2
+                ORDER BY u.user_id
+                LIMIT $3
+            """
+            params = ("%" + _like_prefix(query) + "%", after_user_id, limit + 1)
+        users = [user_factory(None, row) for row in await self._fetch(sql, *params)]
+        return users[:limit], len(users) > limit
+
+    async def find_users_by_usernames(self, usernames: List[str]) -> Dict[str, int]:
+        if not usernames:
+            return {}
+        rows = await self._fetch(
+            "SELECT lower(username), user_id FROM users WHERE lower(username) = ANY($1::text[])",
+            [username.lower() for username in usernames],
+        )
+        return {username: user_id for username, user_id in rows if username}
+
+    async def get_users_page(
+        self, cursor: Optional[tuple] = None, backwards: bool = False, limit: int = 10
+    ) -> tuple:
+        sql, params = _users_page_sql(cursor, backwards, limit)
+        return users_page_result(await self._fetch(sql, *params), backwards, limit)
+
+    # ---------- подписки ----------
+
+    async def get_subscription(self, user_id: int) -> Optional[SubscriptionRecord]:
+        cached = self._cache.get(user_id)
+        if cached is not TTLCache._MISSING:
+            return cached
+        generation = self._cache.generation
+        rows = await self._fetch(
+            f"SELECT {SUBSCRIPTION_COLUMNS} FROM subscriptions s WHERE s.user_id = $1", user_id
+        )
+        sub = SubscriptionRecord._make(rows[0]) if rows else None
+        self._cache.put(user_id, sub, generation)
+        return sub
+
+    async def create_subscription(
+        self,
+        user_id: int,
+        payment_provider: str,
+        invite_link: str,
+        days: int = 30,
+        stripe_customer_id: Optional[str] = None,
+        stripe_subscription_id: Optional[str] = None,
+    ) -> None:
+        expires_at = datetime.now() + timedelta(days=days)
+        async with self._pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute(
+                    """
+                    INSERT INTO subscriptions
+                    (user_id, expires_at, invite_link, payment_provider,
+                     stripe_customer_id, stripe_subscription_id, status)
+                    VALUES ($1, $2, $3, $4, $5, $6, 'active')
+                    ON CONFLICT (user_id) DO UPDATE SET
+                        expires_at = EXCLUDED.expires_at,
+                        invite_link = EXCLUDED.invite_link,
+                        stripe_customer_id = EXCLUDED.stripe_customer_id,
+                        stripe_subscription_id = EXCLUDED.stripe_subscription_id,
+                        status = 'active'
+                    """,
+                    user_id,
+                    to_epoch(expires_at),
+                    invite_link,
+                    payment_provider,
+                    stripe_customer_id,
+                    stripe_subscription_id,
+                )
+                await conn.execute(
+                    "DELETE FROM subscription_notifications WHERE user_id = $1", user_id
+                )
+        self._subscription_changed(user_id, expires_at)
+
+    async def update_subscription_period(self, user_id: int, new_expires_at: datetime) -> None:
+        await self._execute(
+            "UPDATE subscriptions SET expires_at = $1, status = 'active' WHERE user_id = $2",
+            to_epoch(new_expires_at),
+            user_id,
+        )
+        self._subscription_changed(user_id, new_expires_at)
+
+    async def _set_status(self, user_id: int, status: str) -> None:
+        await self._execute("UPDATE subscriptions SET status = $1 WHERE user_id = $2", status, user_id)
+        self._subscription_changed(user_id, None)
+
+    async def cancel_subscription(self, user_id: int) -> None:
+        await self._set_status(user_id, "cancelled")
+
+    async def expire_subscription(self, user_id: int) -> None:
+        await self._set_status(user_id, "expired")
+
+    async def expire_subscriptions(self, user_ids: Sequence[int]) -> List[int]:
+        if not user_ids:
+            return []
+        rows = await self._fetch(
+            "UPDATE subscriptions SET status = 'expired' "
+            "WHERE status = 'active' AND expires_at <= $1 AND user_id = ANY($2::bigint[]) "
+            "RETURNING user_id",
+            to_epoch(datetime.now()),
+            list(user_ids),
+        )
+        expired = [row[0] for row in rows]
+        for user_id in expired:
+            self._subscription_changed(user_id, None)
+        return expired
+
+    async def get_subscription_by_stripe_id(self, stripe_subscription_id: str) -> Optional[Dict]:
+        rows = await self._fetch(
+            "SELECT user_id, status FROM subscriptions WHERE stripe_subscription_id = $1",
+            stripe_subscription_id,
+        )
+        return {"user_id": rows[0]["user_id"], "status": rows[0]["status"]} if rows else None
+
+    # ---------- планировщик подписок ----------
+
+    async def get_expiring_subscriptions(
+        self, days: int = 3, after_user_id: int = 0, limit: Optional[int] = None
+    ) -> List[ExpiryRecord]:
+        rows = await self._fetch(
+            EXPIRING_SUBSCRIPTIONS_SQL, *_expiring_params(days, after_user_id, limit)
+        )
+        return [expiry_factory(None, row) for row in rows]
+
+    async def get_expiring_columns(
+        self, days: int = 3, after_user_id: int = 0, limit: Optional[int] = None
+    ) -> ExpiryColumns:
+        return ExpiryColumns(
+            await self._fetch(EXPIRING_SUBSCRIPTIONS_SQL, *_expiring_params(days, after_user_id, limit))
+        )
+
+    async def get_expired_active_subscriptions(
+        self, after_user_id: int = 0, limit: Optional[int] = None
+    ) -> List[ExpiryRecord]:
+        rows = await self._fetch(
+            EXPIRED_ACTIVE_SUBSCRIPTIONS_SQL, to_epoch(datetime.now()), after_user_id, limit
+        )
+        return [expiry_factory(None, row) for row in rows]
+
+    async def get_expired_active_columns(
+        self, after_user_id: int = 0, limit: Optional[int] = None
+    ) -> ExpiryColumns:
+        return ExpiryColumns(
+            await self._fetch(
+                EXPIRED_ACTIVE_SUBSCRIPTIONS_SQL, to_epoch(datetime.now()), after_user_id, limit
+            )
+        )
+
+    async def get_upcoming_expiries(self, after: datetime, until: datetime) -> ExpiryColumns:
+        return ExpiryColumns(
+            await self._fetch(
+                """
+                SELECT user_id, expires_at FROM subscriptions
+                WHERE expires_at > $1 AND expires_at <= $2 AND status = 'active'
+                ORDER BY expires_at
+                """,
+                to_epoch(after),
+                to_epoch(until),
+            )
+        )
+
+    async def mark_notification(self, user_id: int, notification_type: str) -> None:
+        await self.mark_notifications([user_id], notification_type)
+
+    async def mark_notifications(self, user_ids: List[int], notification_type: str) -> None:
+        if not user_ids:
+            return
+        await self._execute(
+            """
+            INSERT INTO subscription_notifications (user_id, notification_type)
+            SELECT unnest($1::bigint[]), $2
+            ON CONFLICT DO NOTHING
+            """,
+            list(user_ids),
+            notification_type,
+        )
+
+    # ---------- Checkout Sessions ----------
+
+    async def get_checkout_session(self, user_id: int, price_id: str) -> Optional[Dict]:
+        rows = await self._fetch(
+            "SELECT url, expires_at FROM checkout_sessions "
+            "WHERE user_id = $1 AND price_id = $2 AND expires_at > $3",
+            user_id,
+            price_id,
+            to_epoch(datetime.now()),
+        )
+        return {"url": rows[0][0], "expires_at": from_epoch(rows[0][1])} if rows else None
+
+    async def save_checkout_session(
+        self, user_id: int, price_id: str, url: str, expires_at: datetime
+    ) -> None:
+        await self._execute(
+            """
+            INSERT INTO checkout_sessions (user_id, price_id, url, expires_at)
+            VALUES ($1, $2, $3, $4)
+            ON CONFLICT (user_id, price_id) DO UPDATE SET
+                url = EXCLUDED.url,
+                expires_at = EXCLUDED.expires_at
+            """,
+            user_id,
+            price_id,
+            url,
+            to_epoch(expires_at),
+        )
+
+    async def delete_checkout_sessions(self, user_id: int) -> None:
+        await self._execute("DELETE FROM checkout_sessions WHERE user_id = $1", user_id)
+
+    async def purge_expired_checkout_sessions(self) -> int:
+        return _rowcount(
+            await self._execute(
+                "DELETE FROM checkout_sessions WHERE expires_at <= $1", to_epoch(datetime.now())
+            )
+        )
+
+    # ---------- FSM ----------
+
+    async def load_fsm_state(
+        self, key: str, since: datetime
+    ) -> Optional[Tuple[Optional[str], str, int]]:
+        row = await self._fetchrow(
+            "SELECT state, data, updated_at FROM fsm_states WHERE key = $1 AND updated_at >= $2",
+            key,
+            to_epoch(since),
+        )
+        return tuple(row) if row else None
+
+    async def save_fsm_states(self, rows: List[tuple]) -> None:
+        upserts = [row for row in rows if row[1] is not None or row[2] != FSM_EMPTY_DATA]
+        deletes = [row for row in rows if row[1] is None and row[2] == FSM_EMPTY_DATA]
+        async with self._pool.acquire() as conn:
+            async with conn.transaction():
+                if upserts:
+                    await conn.execute(
+                        """
+                        INSERT INTO fsm_states AS f (key, state, data, updated_at)
+                        SELECT * FROM unnest($1::text[], $2::text[], $3::text[], $4::bigint[])
+                        ON CONFLICT (key) DO UPDATE SET
+                            state = EXCLUDED.state,
+                            data = EXCLUDED.data,
+                            updated_at = EXCLUDED.updated_at
+                        WHERE EXCLUDED.updated_at >= f.updated_at
+                        """,
+                        *(list(column) for column in zip(*upserts)),
+                    )
+                if deletes:
+                    await conn.execute(
+                        """
+                        DELETE FROM fsm_states f
+                        USING unnest($1::text[], $2::bigint[]) AS d (key, updated_at)
+                        WHERE f.key = d.key AND f.updated_at <= d.updated_at
+                        """,
+                        [row[0] for row in deletes],
+                        [row[3] for row in deletes],
+                    )
+
+    async def purge_fsm_states(self, before: datetime) -> int:
+        return _rowcount(
+            await self._execute("DELETE FROM fsm_states WHERE updated_at < $1", to_epoch(before))
+        )
+
+    # ---------- отмены ----------
+
+    async def save_cancellation_reason(
+        self,
+        user_id: int,
+        username: Optional[str],
+        reason: str,
+        subscription_id: Optional[str] = None,
+    ) -> None:
+        await self._execute(
+            "INSERT INTO cancellations (user_id, username, reason, subscription_id) VALUES ($1, $2, $3, $4)",
+            user_id,
+            username or "",
+            reason,
+            subscription_id,
+        )
+
+    async def count_user_cancellations(self, user_id: int) -> int:
+        return await self._fetchval("SELECT COUNT(*) FROM cancellations WHERE user_id = $1", user_id)
+
+    async def recent_cancellations(self, limit: int = 20) -> list:
+        return await self._fetch(
+            "SELECT username, reason, cancelled_at FROM cancellations ORDER BY cancelled_at DESC LIMIT $1",
+            limit,
+        )
+
+    async def search_cancellations(
+        self, query: str, before_id: Optional[int] = None, limit: int = 10
+    ) -> Tuple[List[CancellationRecord], List[str], bool]:
+        """Все слова запроса как префиксы лексем ('дорог':* & ...), новые сверху."""
+        words = re.findall(r"\w+", query.lower())
+        if not words:
+            return [], [], False
+        tsquery = " & ".join(f"'{word}':*" for word in words)
+        rows = await self._fetch(
+            f"""
+            SELECT {CANCELLATION_COLUMNS}, ts_headline('simple', c.reason, q, $2)
+            FROM cancellations c, to_tsquery('simple', $1) q
+            WHERE to_tsvector('simple', c.reason) @@ q AND c.id < $3
+            ORDER BY c.id DESC
+            LIMIT $4
+            """,
+            tsquery,
+            _HEADLINE_OPTIONS,
+            before_id or _NO_UPPER_BOUND,
+            limit + 1,
+        )
+        page = rows[:limit]
+        records = [cancellation_factory(None, tuple(row)[:5]) for row in page]
+        return records, [row[5] for row in page], len(rows) > limit
+
+    async def index_cancellation_terms(self, batch_size: int, tokenize: Tokenizer) -> int:
+        """
+        Как в SQLite, но id из BIGSERIAL могут фиксироваться не по порядку:
+        SHARE-блокировка cancellations дожидается незавершенных вставок, и
+        отметка не перепрыгнет строку, которая станет видна позже.
+        """
+        async with self._pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("LOCK TABLE cancellations IN SHARE MODE")
+                last_id = await conn.fetchval(
+                    "SELECT value FROM job_state WHERE name = 'cancellation_terms' FOR UPDATE"
+                )
+                rows = await conn.fetch(
+                    """
+                    SELECT id, to_timestamp(cancelled_at)::date, reason
+                    FROM cancellations
+                    WHERE id > $1
+                    ORDER BY id
+                    LIMIT $2
+                    """,
+                    last_id or 0,
+                    batch_size,
+                )
+                if not rows:
+                    return 0
+
+                counts: Dict[Tuple[date, str], int] = {}
+                for _, day, reason in rows:
+                    for term in tokenize(reason or ""):
+                        counts[(day, term)] = counts.get((day, term), 0) + 1
+                if counts:
+                    days, terms = zip(*counts)
+                    await conn.execute(
+                        """
+                        INSERT INTO cancellation_terms (day, term, count)
+                        SELECT * FROM unnest($1::date[], $2::text[], $3::int[])
+                        ON CONFLICT (day, term) DO UPDATE
+                        SET count = cancellation_terms.count + EXCLUDED.count
+                        """,
+                        list(days),
+                        list(terms),
+                        list(counts.values()),
+                    )
+                await conn.execute(
+                    "INSERT INTO job_state (name, value) VALUES ('cancellation_terms', $1) "
+                    "ON CONFLICT (name) DO UPDATE SET value = EXCLUDED.value",
+                    rows[-1][0],
+                )
+                return len(rows)
+
+    async def churn_themes(
+        self, days: int = 30, limit: int = 10, today: Optional[date] = None
+    ) -> Dict:
+        today = today or date.today()
+        async with self._pool.acquire() as conn:
+            async with conn.transaction(isolation="repeatable_read", readonly=True):
+                themes = await conn.fetch(
+                    """
+                    SELECT term, SUM(count) AS total
+                    FROM cancellation_terms
+                    WHERE day BETWEEN $1 AND $2
+                    GROUP BY term
+                    ORDER BY total DESC, term
+                    LIMIT $3
+                    """,
+                    series_start(days, today),
+                    today,
+                    limit,
+                )
+                pending = await conn.fetchval(
+                    """
+                    SELECT COUNT(*) FROM cancellations
+                    WHERE id > COALESCE(
+                        (SELECT value FROM job_state WHERE name = 'cancellation_terms'), 0
+                    )
+                    """
+                )
+        return {"themes": [(row[0], row[1]) for row in themes], "pending": pending}
+
+    # ---------- статистика ----------
+
+    async def get_stats_counters(self) -> Dict[str, int]:
+        return {row[0]: row[1] for row in await self._fetch(STATS_COUNTERS_SQL)}
+
+    async def check_counters(self, fix: bool = False) -> Dict[str, Tuple[int, int]]:
+        async with self._pool.acquire() as conn:
+            if not fix:
+                async with conn.transaction(isolation="repeatable_read", readonly=True):
+                    actual = dict(await conn.fetch(COUNTER_SOURCES_SQL))
+                    stored = dict(await conn.fetch(STATS_COUNTERS_SQL))
+                return counter_drift(stored, actual)
+            async with conn.transaction():
+                # Триггеры ждут блокировку, пока шарды не заменены точными значениями
+                await conn.execute("LOCK TABLE stats_counters IN EXCLUSIVE MODE")
+                actual = dict(await conn.fetch(COUNTER_SOURCES_SQL))
+                stored = dict(await conn.fetch(STATS_COUNTERS_SQL))
+                drift = counter_drift(stored, actual)
+                if drift:
+                    await conn.execute(
+                        "DELETE FROM stats_counters WHERE name = ANY($1::text[])", list(drift)
+                    )
+                    await conn.executemany(
+                        "INSERT INTO stats_counters (name, value) VALUES ($1, $2)",
+                        [(name, real) for name, (_, real) in drift.items()],
+                    )
+                return drift
+
+    async def count_recent(self, table: str, since: datetime) -> int:
+        column = RECENT_COLUMNS[table]
+        return await self._fetchval(
+            f"SELECT COUNT(*) FROM {table} WHERE {column} >= $1", to_epoch(since)
+        )
+
+    async def get_daily_series(self, days: int) -> Dict[str, List[int]]:
+        return build_series(await self._fetch(DAILY_STATS_SQL, series_start(days)), days)
+
+    async def stats_report(self, since: datetime, days: int = max(SERIES_WINDOWS)) -> Dict:
+        async with self._pool.acquire() as conn:
+            async with conn.transaction(isolation="repeatable_read", readonly=True):
+                counters = {row[0]: row[1] for row in await conn.fetch(STATS_COUNTERS_SQL)}
+                recent = {}
+                for table, column in RECENT_COLUMNS.items():
+                    recent[table] = await conn.fetchval(
+                        f"SELECT COUNT(*) FROM {table} WHERE {column} >= $1", to_epoch(since)
+                    )
+                rows = await conn.fetch(DAILY_STATS_SQL, series_start(days))
+        return {"counters": counters, "recent": recent, "series": build_series(rows, days)}
+
+    async def users_page(
+        self, cursor: Optional[tuple] = None, backwards: bool = False, limit: int = 10
+    ) -> tuple:
+        sql, params = _users_page_sql(cursor, backwards, limit)
+        async with self._pool.acquire() as conn:
+            async with conn.transaction(isolation="repeatable_read", readonly=True):
+                rows = await conn.fetch(sql, *params)
+                total = await conn.fetchval(USERS_TOTAL_SQL)
+        users, has_more = users_page_result(rows, backwards, limit)
+        return users, has_more, total or 0
+
+    async def export_users_csv(
+        self, compress: bool = EXPORT_GZIP, part_limit: int = PART_SIZE_LIMIT
+    ) -> Tuple[List[Path], int]:
+        with export_dir() as out_dir:
+            writer = ExportWriter(out_dir, compress, part_limit)
+            try:
+                async with self._pool.acquire() as conn:
+                    async with conn.transaction(isolation="repeatable_read", readonly=True):
+                        cursor = await conn.cursor(EXPORT_QUERY)
+                        while True:
+                            batch = await cursor.fetch(EXPORT_BATCH_SIZE)
+                            if not batch:
+                                break
+                            # CSV и gzip - в потоке, цикл событий не ждет диск
+                            await asyncio.to_thread(writer.write, batch)
+            finally:
+                writer.close()
+            return writer.result()
+
+    # ---------- рассылки ----------
+
+    async def create_broadcast_job(
+        self, text: str, status_chat_id: int, status_message_id: int, total: int
+    ) -> int:
+        return await self._fetchval(
+            """
+            INSERT INTO broadcast_jobs (text, status_chat_id, status_message_id, total)
+            VALUES ($1, $2, $3, $4)
+            RETURNING id
+            """,
+            text,
+            status_chat_id,
+            status_message_id,
+            total,
+        )
+
+    async def get_unfinished_broadcast_jobs(self) -> List[Dict]:
+        rows = await self._fetch(
+            """
+            SELECT id, text, status_chat_id, status_message_id, total, last_user_id, sent, failed
+            FROM broadcast_jobs WHERE status = 'running' ORDER BY id
+            """
+        )
+        return [dict(row) for row in rows]
+
+    async def reserve_broadcast_recipients(self, job_id: int, limit: int) -> array:
+        """Курсор задачи блокируется FOR UPDATE: экземпляры бота не выдадут одну порцию дважды."""
+        async with self._pool.acquire() as conn:
+            async with conn.transaction():
+                last_user_id = await conn.fetchval(
+                    "SELECT last_user_id FROM broadcast_jobs WHERE id = $1 FOR UPDATE", job_id
+                )
+                if last_user_id is None:
+                    return array("q")
+                rows = await conn.fetch(
+                    "SELECT user_id FROM users WHERE user_id > $1 ORDER BY user_id LIMIT $2",
+                    last_user_id,
+                    limit,
+                )
+                user_ids = array("q", (row[0] for row in rows))
+                if user_ids:
+                    await conn.execute(
+                        """
+                        INSERT INTO broadcast_deliveries (job_id, user_id)
+                        SELECT $1, unnest($2::bigint[])
+                        ON CONFLICT DO NOTHING
+                        """,
+                        job_id,
+                        list(user_ids),
+                    )
+                    await conn.execute(
+                        "UPDATE broadcast_jobs SET last_user_id = $1 WHERE id = $2",
+                        user_ids[-1],
+                        job_id,
+                    )
+                return user_ids
+
+    async def record_broadcast_results(self, job_id: int, results: List[tuple]) -> None:
+        if not results:
+            return
+        sent = sum(1 for _, status in results if status == "sent")
+        user_ids, statuses = zip(*results)
+        async with self._pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute(
+                    """
+                    UPDATE broadcast_deliveries d SET status = r.status
+                    FROM unnest($2::bigint[], $3::text[]) AS r(user_id, status)
+                    WHERE d.job_id = $1 AND d.user_id = r.user_id
+                    """,
+                    job_id,
+                    list(user_ids),
+                    list(statuses),
+                )
+                await conn.execute(
+                    "UPDATE broadcast_jobs SET sent = sent + $1, failed = failed + $2 WHERE id = $3",
+                    sent,
+                    len(results) - sent,
+                    job_id,
+                )
+
+    async def finish_broadcast_job(self, job_id: int) -> Dict:
+        async with self._pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute(
+                    "UPDATE broadcast_jobs SET status = 'done', finished_at = $1 WHERE id = $2",
+                    to_epoch(datetime.now()),
+                    job_id,
+                )
+                rows = await conn.fetch(
+                    "SELECT status, COUNT(*) FROM broadcast_deliveries WHERE job_id = $1 GROUP BY status",
+                    job_id,
+                )
+        counts = {row[0]: row[1] for row in rows}
+        return {
+            "sent": counts.get("sent", 0),
+            "failed": counts.get("failed", 0),
+            "unknown": counts.get("pending", 0),
+        }
@@ -0,0 +1,250 @@
+"""
+SQLite-хранилище: адаптер над database.py (пул читателей, очередь писателя,
+write-behind буфер users, кэш подписок) и analytics.py (отчеты админки на
+read-only снимках в отдельном пуле потоков).
+"""
+
+from array import array
+from datetime import date, datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import analytics
+import database
+import export
+from config import EXPORT_GZIP
+from records import CancellationRecord, ExpiryColumns, ExpiryRecord, SubscriptionRecord, UserRecord
+from rollups import SERIES_WINDOWS
+from storage.base import Storage, Tokenizer
+
+
+class SqliteStorage(Storage):
+    name = "sqlite"
+
+    async def init(self) -> None:
+        await database.init_db()
+
+    async def close(self) -> None:
+        await database.close_db()
+
+    def stats(self) -> Dict:
+        return {
+            "backend": self.name,
+            "cache": database.get_cache_stats(),
+            "pool": database.get_pool_stats(),
+            "write_queue": database.get_write_queue_stats(),
+            "user_writes": database.get_user_write_stats(),
+            "analytics": analytics.get_analytics_stats(),
+        }
+
+    async def flush_user_writes(self) -> int:
+        return await database.flush_user_writes()
+
+    # ---------- пользователи ----------
+
+    async def save_user(
+        self, user_id: int, username: Optional[str] = None, first_name: Optional[str] = None
+    ) -> None:
+        await database.save_user(user_id, username, first_name)
+
+    async def load_user_context(
+        self, user_id: int, username: Optional[str] = None, first_name: Optional[str] = None
+    ) -> Dict:
+        return await database.load_user_context(user_id, username, first_name)
+
+    async def mark_payment_attempt(self, user_id: int) -> None:
+        await database.mark_payment_attempt(user_id)
+
+    async def has_payment_attempt(self, user_id: int) -> bool:
+        return await database.has_payment_attempt(user_id)
+
+    async def get_user(self, user_id: int) -> Optional[UserRecord]:
+        return await database.get_user(user_id)
+
+    async def get_all_users(self) -> List[UserRecord]:
+        return await database.get_all_users()
+
+    async def count_users(self) -> int:
+        return await database.count_users()
+
+    async def search_users(
+        self, query: str, after_user_id: int = 0, limit: int = 10
+    ) -> Tuple[List[UserRecord], bool]:
+        return await database.search_users(query, after_user_id, limit)
+
+    async def find_users_by_usernames(self, usernames: List[str]) -> Dict[str, int]:
+        return await database.find_users_by_usernames(usernames)
+
+    async def get_users_page(
+        self, cursor: Optional[tuple] = None, backwards: bool = False, limit: int = 10
+    ) -> tuple:
+        return await database.get_users_page(cursor, backwards, limit)
+
+    # ---------- подписки ----------
+
+    async def get_subscription(self, user_id: int) -> Optional[SubscriptionRecord]:
+        return await database.get_subscription(user_id)
+
+    async def create_subscription(
+        self,
+        user_id: int,
+        payment_provider: str,
+        invite_link: str,
+        days: int = 30,
+        stripe_customer_id: Optional[str] = None,
+        stripe_subscription_id: Optional[str] = None,
+    ) -> None:
+        await database.create_subscription(
+            user_id, payment_provider, invite_link, days, stripe_customer_id, stripe_subscription_id
+        )
+
+    async def update_subscription_period(self, user_id: int, new_expires_at: datetime) -> None:
+        await database.update_subscription_period(user_id, new_expires_at)
+
+    async def cancel_subscription(self, user_id: int) -> None:
+        await database.cancel_subscription(user_id)
+
+    async def expire_subscription(self, user_id: int) -> None:
+        await database.expire_subscription(user_id)
+
+    async def expire_subscriptions(self, user_ids: Sequence[int]) -> List[int]:
+        return await database.expire_subscriptions(user_ids)
+
+    async def get_subscription_by_stripe_id(self, stripe_subscription_id: str) -> Optional[Dict]:
+        return await database.get_subscription_by_stripe_id(stripe_subscription_id)
+
+    # ---------- планировщик подписок ----------
+
+    async def get_expiring_subscriptions(
+        self, days: int = 3, after_user_id: int = 0, limit: Optional[int] = None
+    ) -> List[ExpiryRecord]:
+        return await database.get_expiring_subscriptions(days, after_user_id, limit)
+
+    async def get_expiring_columns(
+        self, days: int = 3, after_user_id: int = 0, limit: Optional[int] = None
+    ) -> ExpiryColumns:
+        return await database.get_expiring_columns(days, after_user_id, limit)
+
+    async def get_expired_active_subscriptions(
+        self, after_user_id: int = 0, limit: Optional[int] = None
+    ) -> List[ExpiryRecord]:
+        return await database.get_expired_active_subscriptions(after_user_id, limit)
+
+    async def get_expired_active_columns(
+        self, after_user_id: int = 0, limit: Optional[int] = None
+    ) -> ExpiryColumns:
+        return await database.get_expired_active_columns(after_user_id, limit)
+
+    async def get_upcoming_expiries(self, after: datetime, until: datetime) -> ExpiryColumns:
+        return await database.get_upcoming_expiries(after, until)
+
+    async def mark_notification(self, user_id: int, notification_type: str) -> None:
+        await database.mark_notification(user_id, notification_type)
+
+    async def mark_notifications(self, user_ids: List[int], notification_type: str) -> None:
+        await database.mark_notifications(user_ids, notification_type)
+
+    # ---------- Checkout Sessions ----------
+
+    async def get_checkout_session(self, user_id: int, price_id: str) -> Optional[Dict]:
+        return await database.get_checkout_session(user_id, price_id)
+
+    async def save_checkout_session(
+        self, user_id: int, price_id: str, url: str, expires_at: datetime
+    ) -> None:
+        await database.save_checkout_session(user_id, price_id, url, expires_at)
+
+    async def delete_checkout_sessions(self, user_id: int) -> None:
+        await database.delete_checkout_sessions(user_id)
+
+    async def purge_expired_checkout_sessions(self) -> int:
+        return await database.purge_expired_checkout_sessions()
+
+    # ---------- FSM ----------
+
+    async def load_fsm_state(
+        self, key: str, since: datetime
+    ) -> Optional[Tuple[Optional[str], str, int]]:
+        return await database.load_fsm_state(key, since)
+
+    async def save_fsm_states(self, rows: List[tuple]) -> None:
+        await database.save_fsm_states(rows)
+
+    async def purge_fsm_states(self, before: datetime) -> int:
+        return await database.purge_fsm_states(before)
+
+    # ---------- отмены ----------
+
+    async def save_cancellation_reason(
+        self,
+        user_id: int,
+        username: Optional[str],
+        reason: str,
+        subscription_id: Optional[str] = None,
+    ) -> None:
+        await database.save_cancellation_reason(user_id, username, reason, subscription_id)
+
+    async def count_user_cancellations(self, user_id: int) -> int:
+        return await database.count_user_cancellations(user_id)
+
+    async def recent_cancellations(self, limit: int = 20) -> list:
+        return await analytics.recent_cancellations(limit)
+
+    async def search_cancellations(
+        self, query: str, before_id: Optional[int] = None, limit: int = 10
+    ) -> Tuple[List[CancellationRecord], List[str], bool]:
+        return await analytics.search_cancellations(query, before_id, limit)
+
+    async def index_cancellation_terms(self, batch_size: int, tokenize: Tokenizer) -> int:
+        return await database.index_cancellation_terms(batch_size, tokenize)
+
+    async def churn_themes(
+        self, days: int = 30, limit: int = 10, today: Optional[date] = None
+    ) -> Dict:
+        return await analytics.churn_themes(days, limit, today)
+
+    # ---------- статистика ----------
+
+    async def get_stats_counters(self) -> Dict[str, int]:
+        return await database.get_stats_counters()
+
+    async def check_counters(self, fix: bool = False) -> Dict[str, Tuple[int, int]]:
+        return await database.check_counters(fix)
+
+    async def count_recent(self, table: str, since: datetime) -> int:
+        return await database.count_recent(table, since)
+
+    async def get_daily_series(self, days: int) -> Dict[str, List[int]]:
+        return await database.get_daily_series(days)
+
+    async def stats_report(self, since: datetime, days: int = max(SERIES_WINDOWS)) -> Dict:
+        return await analytics.stats_report(since, days)
+
+    async def users_page(
+        self, cursor: Optional[tuple] = None, backwards: bool = False, limit: int = 10
+    ) -> tuple:
+        return await analytics.users_page(cursor, backwards, limit)
+
+    async def export_users_csv(
+        self, compress: bool = EXPORT_GZIP, part_limit: int = export.PART_SIZE_LIMIT
+    ) -> Tuple[List[Path], int]:
+        return await export.export_users_csv(compress, part_limit)
+
+    # ---------- рассылки ----------
+
+    async def create_broadcast_job(
+        self, text: str, status_chat_id: int, status_message_id: int, total: int
+    ) -> int:
+        return await database.create_broadcast_job(text, status_chat_id, status_message_id, total)
+
+    async def get_unfinished_broadcast_jobs(self) -> List[Dict]:
+        return await database.get_unfinished_broadcast_jobs()
+
+    async def reserve_broadcast_recipients(self, job_id: int, limit: int) -> array:
+        return await database.reserve_broadcast_recipients(job_id, limit)
+
+    async def record_broadcast_results(self, job_id: int, results: List[tuple]) -> None:
+        await database.record_broadcast_results(job_id, results)
+
+    async def finish_broadcast_job(self, job_id: int) -> Dict:
+        return await database.finish_broadcast_job(job_id)
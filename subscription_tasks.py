@@ -1,140 +1,235 @@
 """
 Фоновые задачи по подпискам: предупреждение за 3 дня и исключение после окончания.
-Ежедневный бекап базы данных.
+Ежедневный бекап базы данных, индексация тем оттока.
 """
 
 import asyncio
+import heapq
 import logging
-import shutil
+import time
+from array import array
 from datetime import datetime, timedelta, timezone
-from pathlib import Path
-from typing import Optional
+from typing import Dict, List, Optional, Sequence, Tuple
 
 from aiogram import Bot
 
-from config import CHANNEL_ID, DATABASE_PATH, SUBSCRIPTION_CHECK_HOUR, SUBSCRIPTION_CHECK_TZ_OFFSET
-from database import (
-    expire_subscription,
-    get_expired_active_subscriptions,
-    get_expiring_subscriptions,
-    mark_notification,
+from backup import backup_database
+from churn_terms import churn_terms_indexer
+from config import (
+    CHANNEL_ID,
+    STRIPE_MAX_CONCURRENCY,
+    SUBSCRIPTION_BATCH_SIZE,
+    SUBSCRIPTION_CHECK_HOUR,
+    SUBSCRIPTION_CHECK_TZ_OFFSET,
 )
+from database import add_subscription_listener, remove_subscription_listener
 from keyboards import renewal_offer_keyboard, subscription_offer_keyboard
 from messages import format_message
 from payments import PaymentFactory
+from storage import (
+    expire_subscriptions,
+    get_expired_active_columns,
+    get_expiring_columns,
+    get_storage,
+    get_upcoming_expiries,
+    mark_notifications,
+    purge_expired_checkout_sessions,
+)
+from throttling import TelegramRateLimiter, call_limited, send_message_limited
 
 logger = logging.getLogger(__name__)
 
 WARNING_DAYS = (3, 1)
-BACKUP_KEEP_COUNT = 7
+# Насколько вперед планировщик подгружает сроки из БД
+SCHEDULER_LOAD_WINDOW = timedelta(hours=6)
 
 
-async def backup_database() -> Optional[Path]:
-    """
-    Создаёт бекап базы данных с временной меткой.
-    Хранит последние BACKUP_KEEP_COUNT копий, более старые удаляет.
-    Возвращает путь к созданному файлу или None при ошибке.
-    """
-    db_path = Path(DATABASE_PATH)
-    if not db_path.exists():
-        logger.warning("⚠️ Файл БД не найден, бекап пропущен: %s", db_path)
-        return None
+async def _build_payment_links(user_ids: Sequence[int]) -> Dict[int, Optional[str]]:
+    """Ссылки на оплату для пачки пользователей, не больше STRIPE_MAX_CONCURRENCY одновременно."""
+    semaphore = asyncio.Semaphore(STRIPE_MAX_CONCURRENCY)
 
-    backup_dir = db_path.parent / "backups"
-    backup_dir.mkdir(parents=True, exist_ok=True)
-
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    backup_path = backup_dir / f"bot_{timestamp}.db"
+    async def build(user_id: int):
+        async with semaphore:
+            try:
+                return user_id, await PaymentFactory.create_payment(user_id)
+            except Exception as e:
+                logger.warning(f"Failed to create payment URL for {user_id}: {e}")
+                return user_id, None
 
-    try:
-        shutil.copy2(db_path, backup_path)
-        logger.info("✅ Бекап создан: %s", backup_path)
-    except OSError as e:
-        logger.error("❌ Ошибка создания бекапа: %s", e)
-        return None
-
-    # Удаляем старые бекапы, оставляем последние BACKUP_KEEP_COUNT
-    backups = sorted(backup_dir.glob("bot_*.db"))
-    for old in backups[:-BACKUP_KEEP_COUNT]:
-        try:
-            old.unlink()
-            logger.info("🗑 Старый бекап удалён: %s", old)
-        except OSError:
-            pass
+    return dict(await asyncio.gather(*(build(user_id) for user_id in user_ids)))
 
-    return backup_path
 
+async def _send_expiry_warnings(bot: Bot, limiter: Optional[TelegramRateLimiter] = None) -> None:
+    """
+    Предупреждения об окончании подписки конвейером по страницам:
+    выборка -> ссылки на оплату (параллельно) -> отправка через лимитер ->
+    отметка об уведомлении одной транзакцией на страницу.
+    """
+    limiter = limiter or TelegramRateLimiter()
 
-async def _send_expiry_warnings(bot: Bot) -> None:
     for warning_days in WARNING_DAYS:
-        expiring = await get_expiring_subscriptions(days=warning_days)
-        if not expiring:
-            continue
+        notification_type = f"expiry_{warning_days}d"
+        timings = {"fetch": 0.0, "links": 0.0, "send": 0.0, "mark": 0.0}
+        sent = failed = 0
+        after_user_id = 0
 
-        for item in expiring:
-            user_id = item["user_id"]
-            expires_at = item["expires_at"]
-            days_left = max((expires_at - datetime.now()).days, 0)
+        while True:
+            started = time.monotonic()
+            page = await get_expiring_columns(
+                days=warning_days, after_user_id=after_user_id, limit=SUBSCRIPTION_BATCH_SIZE
+            )
+            timings["fetch"] += time.monotonic() - started
+            if not page:
+                break
+            after_user_id = page.last_user_id
 
-            try:
-                payment_url = await PaymentFactory.create_payment(user_id)
-            except Exception as e:
-                logger.warning(f"Failed to create payment URL for {user_id}: {e}")
-                payment_url = None
+            started = time.monotonic()
+            links = await _build_payment_links(page.user_ids)
+            timings["links"] += time.monotonic() - started
 
-            keyboard = renewal_offer_keyboard(payment_url) if payment_url else None
+            async def send(item) -> Optional[int]:
+                user_id = item.user_id
+                days_left = max((item.expires_at - datetime.now()).days, 0)
+                payment_url = links.get(user_id)
+                try:
+                    await send_message_limited(
+                        bot,
+                        limiter,
+                        user_id,
+                        format_message("subscription_expiring_soon", days_left=days_left),
+                        reply_markup=renewal_offer_keyboard(payment_url) if payment_url else None,
+                        parse_mode="HTML",
+                    )
+                    return user_id
+                except Exception as e:
+                    logger.warning(f"Failed to send expiry warning to {user_id}: {e}")
+                    return None
 
-            try:
-                await bot.send_message(
-                    user_id,
-                    format_message("subscription_expiring_soon", days_left=days_left),
-                    reply_markup=keyboard,
-                    parse_mode="HTML",
-                )
-                await mark_notification(user_id, f"expiry_{warning_days}d")
-                logger.info("Sent expiry warning (%sd) to %s", warning_days, user_id)
-            except Exception as e:
-                logger.warning(f"Failed to send expiry warning to {user_id}: {e}")
+            started = time.monotonic()
+            delivered = [u for u in await asyncio.gather(*(send(item) for item in page)) if u]
+            timings["send"] += time.monotonic() - started
+            sent += len(delivered)
+            failed += len(page) - len(delivered)
 
+            started = time.monotonic()
+            await mark_notifications(delivered, notification_type)
+            timings["mark"] += time.monotonic() - started
 
-async def _revoke_expired(bot: Bot) -> None:
-    expired = await get_expired_active_subscriptions()
-    if not expired:
-        return
+            if len(page) < SUBSCRIPTION_BATCH_SIZE:
+                break
 
-    for item in expired:
-        user_id = item["user_id"]
-        try:
-            # Исключаем пользователя из канала; сразу снимаем бан,
-            # чтобы он мог вернуться после оплаты
-            await bot.ban_chat_member(chat_id=int(CHANNEL_ID), user_id=user_id)
-            await bot.unban_chat_member(chat_id=int(CHANNEL_ID), user_id=user_id)
-            logger.info(f"Kicked expired user {user_id} from channel")
-        except Exception as e:
-            logger.warning(f"Failed to kick user {user_id}: {e}")
+        if sent or failed:
+            logger.info(
+                "Expiry warnings (%sd): sent=%s failed=%s | fetch %.2fs, links %.2fs, send %.2fs, mark %.2fs",
+                warning_days,
+                sent,
+                failed,
+                timings["fetch"],
+                timings["links"],
+                timings["send"],
+                timings["mark"],
+            )
 
-        try:
-            await expire_subscription(user_id)
-        except Exception as e:
-            logger.warning(f"Failed to expire subscription for {user_id}: {e}")
 
-        try:
-            payment_url = await PaymentFactory.create_payment(user_id)
-        except Exception as e:
-            logger.warning(f"Failed to create payment URL for {user_id}: {e}")
-            payment_url = None
+async def _kick_from_channel(bot: Bot, limiter: TelegramRateLimiter, user_id: int) -> bool:
+    # Исключаем пользователя из канала; сразу снимаем бан,
+    # чтобы он мог вернуться после оплаты
+    try:
+        await call_limited(limiter, user_id, bot.ban_chat_member, chat_id=int(CHANNEL_ID), user_id=user_id)
+        await call_limited(limiter, user_id, bot.unban_chat_member, chat_id=int(CHANNEL_ID), user_id=user_id)
+        return True
+    except Exception as e:
+        logger.warning(f"Failed to kick user {user_id}: {e}")
+        return False
 
-        keyboard = renewal_offer_keyboard(payment_url) if payment_url else subscription_offer_keyboard()
 
+async def _send_renewal_offers(bot: Bot, limiter: TelegramRateLimiter, user_ids: Sequence[int]) -> int:
+    links = await _build_payment_links(user_ids)
+
+    async def send(user_id: int) -> bool:
+        payment_url = links.get(user_id)
+        keyboard = renewal_offer_keyboard(payment_url) if payment_url else subscription_offer_keyboard()
         try:
-            await bot.send_message(
+            await send_message_limited(
+                bot,
+                limiter,
                 user_id,
                 format_message("subscription_expired"),
                 reply_markup=keyboard,
                 parse_mode="HTML",
             )
+            return True
         except Exception as e:
             logger.warning(f"Failed to notify user {user_id} about expiration: {e}")
+            return False
+
+    return sum(await asyncio.gather(*(send(user_id) for user_id in user_ids)))
+
+
+async def _revoke_expired(bot: Bot, limiter: Optional[TelegramRateLimiter] = None) -> Dict:
+    """
+    Исключение истекших подписок по страницам: сначала смена статуса всей
+    страницы одним UPDATE, затем параллельные исключения из канала через
+    лимитер - только тех, кого UPDATE действительно перевел в expired
+    (продленные после выборки не трогаются).
+    Предложения продлить отправляются после того, как все исключения выполнены.
+    """
+    limiter = limiter or TelegramRateLimiter()
+    report = {"expired": 0, "kicked": 0, "kick_failed": 0, "offers_sent": 0}
+    timings = {"fetch": 0.0, "kick": 0.0, "expire": 0.0, "offers": 0.0}
+    revoked = array("q")
+    after_user_id = 0
+
+    while True:
+        started = time.monotonic()
+        page = await get_expired_active_columns(
+            after_user_id=after_user_id, limit=SUBSCRIPTION_BATCH_SIZE
+        )
+        timings["fetch"] += time.monotonic() - started
+        if not page:
+            break
+        after_user_id = page.last_user_id
+
+        started = time.monotonic()
+        try:
+            expired = await expire_subscriptions(page.user_ids)
+        except Exception as e:
+            logger.warning(f"Failed to expire subscriptions for {len(page)} users: {e}")
+            expired = []
+        timings["expire"] += time.monotonic() - started
+        report["expired"] += len(expired)
+
+        started = time.monotonic()
+        kicked = await asyncio.gather(*(_kick_from_channel(bot, limiter, u) for u in expired))
+        timings["kick"] += time.monotonic() - started
+        report["kicked"] += sum(kicked)
+        report["kick_failed"] += len(kicked) - sum(kicked)
+        revoked.extend(expired)
+
+        if len(page) < SUBSCRIPTION_BATCH_SIZE:
+            break
+
+    started = time.monotonic()
+    for i in range(0, len(revoked), SUBSCRIPTION_BATCH_SIZE):
+        report["offers_sent"] += await _send_renewal_offers(
+            bot, limiter, revoked[i : i + SUBSCRIPTION_BATCH_SIZE]
+        )
+    timings["offers"] += time.monotonic() - started
+
+    if revoked:
+        logger.info(
+            "Revocation: expired=%s kicked=%s kick_failed=%s offers=%s | "
+            "fetch %.2fs, kick %.2fs, expire %.2fs, offers %.2fs",
+            report["expired"],
+            report["kicked"],
+            report["kick_failed"],
+            report["offers_sent"],
+            timings["fetch"],
+            timings["kick"],
+            timings["expire"],
+            timings["offers"],
+        )
+    return report
 
 
 def _seconds_until_next_check(now: datetime) -> int:
@@ -146,21 +241,116 @@ def _seconds_until_next_check(now: datetime) -> int:
     return int((next_check - now).total_seconds())
 
 
-async def subscription_enforcer(bot: Bot) -> None:
-    """Проверяет подписки раз в сутки в заданный час."""
+class ExpiryScheduler:
+    """
+    Непрерывный планировщик сроков подписок на min-куче.
+
+    В куче лежат моменты (предупреждения за WARNING_DAYS и окончание подписки)
+    на окне SCHEDULER_LOAD_WINDOW вперед; окно подгружается из БД по индексу
+    idx_sub_active_expires, а записи подписок добавляют новые сроки через
+    add_subscription_listener. Планировщик просыпается к ближайшему сроку и
+    выполняет идемпотентные проходы _send_expiry_warnings / _revoke_expired,
+    поэтому устаревшие записи в куче лишь вызывают пустой проход.
+    """
+
+    def __init__(self, bot: Bot, limiter: Optional[TelegramRateLimiter] = None) -> None:
+        self.bot = bot
+        self.limiter = limiter or TelegramRateLimiter()
+        self._heap: List[Tuple[datetime, int]] = []
+        self._loaded_until: Optional[datetime] = None
+        self._wakeup = asyncio.Event()
+
+    @staticmethod
+    def _deadlines(expires_at: datetime) -> List[datetime]:
+        return [expires_at - timedelta(days=days) for days in WARNING_DAYS] + [expires_at]
+
+    def _push(self, user_id: int, expires_at: datetime, after: datetime, until: datetime) -> None:
+        for deadline in self._deadlines(expires_at):
+            if after < deadline <= until:
+                heapq.heappush(self._heap, (deadline, user_id))
+
+    def on_subscription_changed(self, user_id: int, expires_at: Optional[datetime]) -> None:
+        """Слушатель записей в subscriptions."""
+        if expires_at is None or self._loaded_until is None:
+            return
+        self._push(user_id, expires_at, datetime.now() - timedelta(seconds=1), self._loaded_until)
+        self._wakeup.set()
+
+    async def _load_window(self) -> None:
+        now = datetime.now()
+        after = self._loaded_until or now
+        until = now + SCHEDULER_LOAD_WINDOW
+        # Предупреждения в окне относятся к подпискам, истекающим до until + max(WARNING_DAYS)
+        upcoming = await get_upcoming_expiries(after, until + timedelta(days=max(WARNING_DAYS)))
+        for item in upcoming:
+            self._push(item.user_id, item.expires_at, after, until)
+        self._loaded_until = until
+        logger.debug(f"Expiry scheduler loaded window until {until}: heap={len(self._heap)}")
+
+    def _pop_due(self, now: datetime) -> int:
+        due = 0
+        while self._heap and self._heap[0][0] <= now:
+            heapq.heappop(self._heap)
+            due += 1
+        return due
+
+    async def _process(self) -> None:
+        await _send_expiry_warnings(self.bot, self.limiter)
+        await _revoke_expired(self.bot, self.limiter)
+
+    async def _process_safely(self) -> None:
+        try:
+            await self._process()
+        except Exception as e:
+            logger.error(f"Subscription task error: {e}", exc_info=True)
+
+    async def run(self) -> None:
+        add_subscription_listener(self.on_subscription_changed)
+        try:
+            # Догоняем все, что просрочено, пока бот не работал
+            await self._process_safely()
+
+            while True:
+                self._wakeup.clear()
+                if self._loaded_until is None or self._loaded_until <= datetime.now():
+                    await self._load_window()
+                next_wakeup = self._loaded_until
+                if self._heap and self._heap[0][0] < next_wakeup:
+                    next_wakeup = self._heap[0][0]
+
+                delay = max((next_wakeup - datetime.now()).total_seconds(), 0)
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                    continue  # добавлен более ранний срок - пересчитываем ожидание
+                except asyncio.TimeoutError:
+                    pass
+
+                if self._pop_due(datetime.now()):
+                    await self._process_safely()
+        finally:
+            remove_subscription_listener(self.on_subscription_changed)
+
+
+async def _daily_maintenance() -> None:
+    """Ежедневное обслуживание в заданный час: очистка и бекап (бекап - только файла SQLite)."""
     tz = timezone(timedelta(hours=SUBSCRIPTION_CHECK_TZ_OFFSET))
-    logger.info(
-        "🔄 Мониторинг подписок: ежедневно в %02d:00 (UTC%+d)",
-        SUBSCRIPTION_CHECK_HOUR,
-        SUBSCRIPTION_CHECK_TZ_OFFSET,
-    )
     while True:
         delay = _seconds_until_next_check(datetime.now(tz))
         await asyncio.sleep(delay)
 
         try:
-            await _send_expiry_warnings(bot)
-            await _revoke_expired(bot)
-            await backup_database()
+            await purge_expired_checkout_sessions()
+            if get_storage().name == "sqlite":
+                await backup_database()
         except Exception as e:
-            logger.error(f"Subscription task error: {e}", exc_info=True)
+            logger.error(f"Daily maintenance error: {e}", exc_info=True)
+
+
+async def subscription_enforcer(bot: Bot) -> None:
+    """Следит за сроками подписок непрерывно, бекап - раз в сутки в заданный час."""
+    logger.info(
+        "🔄 Мониторинг подписок: непрерывно, бекап ежедневно в %02d:00 (UTC%+d)",
+        SUBSCRIPTION_CHECK_HOUR,
+        SUBSCRIPTION_CHECK_TZ_OFFSET,
+    )
+    await asyncio.gather(ExpiryScheduler(bot).run(), _daily_maintenance(), churn_terms_indexer())
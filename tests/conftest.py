@@ -3,12 +3,21 @@ from pathlib import Path
 import pytest
 
 import database
+import storage
+from storage.sqlite import SqliteStorage
 
 TEST_SUITES = {
     "test_database.py": "Database lifecycle and subscription state",
     "test_subscription_tasks.py": "Background subscription jobs",
     "test_payments.py": "Stripe webhook and payment factory",
     "test_admin_and_messages.py": "Admin helpers and message templates",
+    "test_broadcast.py": "Broadcast engine and Telegram rate limiting",
+    "test_export.py": "Streaming CSV export",
+    "test_backup.py": "Online SQLite backups",
+    "test_analytics.py": "Read-only analytics snapshots",
+    "test_churn_terms.py": "Cancellation search and churn themes",
+    "test_storage.py": "Storage backend conformance (SQLite, PostgreSQL)",
+    "test_fsm_storage.py": "Persistent FSM storage",
 }
 
 
@@ -16,11 +25,18 @@ TEST_SUITES = {
 def isolated_db(tmp_path, monkeypatch):
     db_path = tmp_path / "test_bot.db"
     monkeypatch.setattr(database, "DATABASE_PATH", str(db_path))
+    monkeypatch.setattr(storage, "_storage", SqliteStorage())
     data_dir = Path(database.DATABASE_PATH).parent
     data_dir.mkdir(parents=True, exist_ok=True)
     return db_path
 
 
+@pytest.fixture(autouse=True)
+async def close_db_pool():
+    yield
+    await database.close_db()
+
+
 def pytest_report_header(config):
     lines = ["Subscription Bot Test Plan:"]
     for filename, description in TEST_SUITES.items():
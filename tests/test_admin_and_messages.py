@@ -1,21 +1,26 @@
-from admin import UsersPaginator, _parse_usernames
+from admin import UsersPaginator, _decode_users_cursor, _parse_usernames
 from messages import format_message
 
 
 def test_users_paginator_page_and_keyboard():
     users = [
-        {"user_id": 1, "username": "user1", "first_name": "User One"},
-        {"user_id": 2, "username": "", "first_name": "User Two"},
-        {"user_id": 3, "username": "user3", "first_name": "User Three"},
+        {"user_id": 1, "username": "user1", "first_name": "User One", "join_date": 1767348000},
+        {"user_id": 2, "username": "", "first_name": "User Two", "join_date": 1767259815},
     ]
-    paginator = UsersPaginator(users, page=0, per_page=2)
+    paginator = UsersPaginator(users, page=1, total=5, per_page=2, has_prev=True, has_next=True)
     page_users = paginator.get_page_users()
 
     assert [u["user_id"] for u in page_users] == [1, 2]
+    assert paginator.total_pages == 3
     keyboard = paginator.get_keyboard()
     assert keyboard.inline_keyboard[0][0].callback_data == "user_profile_1"
     assert keyboard.inline_keyboard[1][0].callback_data == "user_profile_2"
 
+    prev_button, _, next_button = keyboard.inline_keyboard[2]
+    assert prev_button.callback_data == "users_prev_0_1767348000_1"
+    assert next_button.callback_data == "users_next_2_1767259815_2"
+    assert _decode_users_cursor("1767259815_2") == (1767259815, 2)
+
 
 def test_format_message_with_known_and_unknown_key():
     rendered = format_message("status_active", days_left=7)
@@ -0,0 +1,76 @@
+import asyncio
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+import analytics
+import database
+
+
+@pytest.fixture(autouse=True)
+async def analytics_pool():
+    yield
+    await analytics.shutdown_analytics()
+
+
+async def test_reports_read_one_read_only_snapshot(isolated_db):
+    await database.init_db()
+    for user_id in range(1, 4):
+        await database.save_user(user_id, f"user{user_id}", "Name")
+    await database.create_subscription(2, "stripe", "https://t.me/+a")
+    await database.save_cancellation_reason(3, "user3", "дорого")
+
+    # Отложенные записи users попадают в снимок
+    users, has_more, total = await analytics.users_page(limit=2)
+    assert [u["user_id"] for u in users] == [3, 2] and has_more and total == 3
+
+    report = await analytics.stats_report(datetime.now() - timedelta(minutes=5), days=30)
+    assert report["counters"]["users_total"] == 3
+    assert report["recent"] == {"users": 3, "subscriptions": 1, "cancellations": 1}
+    assert report["series"]["signups"][-1] == 3
+
+    rows = await analytics.recent_cancellations()
+    assert [(row["username"], row["reason"]) for row in rows] == [("user3", "дорого")]
+
+    def count_during_write(conn):
+        before = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+        writer = sqlite3.connect(isolated_db)
+        writer.execute("INSERT INTO users (user_id) VALUES (100)")
+        writer.commit()
+        writer.close()
+        after = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+        with pytest.raises(sqlite3.OperationalError):
+            conn.execute("DELETE FROM users")
+        return before, after
+
+    assert await analytics.run_snapshot(count_during_write) == (3, 3)
+    assert await database.count_users() == 4
+
+
+async def test_snapshot_jobs_are_capped_by_worker_count(isolated_db, monkeypatch):
+    monkeypatch.setattr(analytics, "ANALYTICS_MAX_WORKERS", 2)
+    await database.init_db()
+    lock = threading.Lock()
+    running = peak = 0
+
+    def slow_job(conn):
+        nonlocal running, peak
+        with lock:
+            running += 1
+            peak = max(peak, running)
+        time.sleep(0.05)
+        with lock:
+            running -= 1
+        return conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    jobs_before = analytics.get_analytics_stats()["jobs"]
+    jobs = [analytics.run_snapshot(slow_job) for _ in range(6)]
+    assert await asyncio.gather(*jobs) == [0] * 6
+    assert peak == 2
+
+    stats = analytics.get_analytics_stats()
+    assert stats["jobs"] - jobs_before == 6 and stats["max_in_flight"] > 2
+    assert stats["in_flight"] == 0 and stats["queued"] == 0
@@ -0,0 +1,132 @@
+import asyncio
+import time
+
+import pytest
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendMessage
+
+import database
+from broadcast import BroadcastEngine, BroadcastJob, launch_broadcast
+from throttling import TelegramRateLimiter
+
+
+class FakeBot:
+    def __init__(self, retry_after_for=None, fail_for=None):
+        self.messages = []
+        self.edits = []
+        self.retry_after_for = set(retry_after_for or ())
+        self.fail_for = set(fail_for or ())
+
+    async def send_message(self, user_id, text, **kwargs):
+        if user_id in self.retry_after_for:
+            self.retry_after_for.discard(user_id)
+            raise TelegramRetryAfter(
+                method=SendMessage(chat_id=user_id, text=text),
+                message="Too Many Requests",
+                retry_after=0,
+            )
+        if user_id in self.fail_for:
+            raise RuntimeError("bot was blocked by the user")
+        self.messages.append((user_id, text))
+
+    async def edit_message_text(self, text, **kwargs):
+        self.edits.append(text)
+
+
+@pytest.mark.asyncio
+async def test_broadcast_engine_retries_after_flood_wait_and_counts_failures():
+    bot = FakeBot(retry_after_for={2}, fail_for={3})
+    engine = BroadcastEngine(
+        bot,
+        "hello",
+        status_chat_id=1,
+        status_message_id=100,
+        concurrency=3,
+        limiter=TelegramRateLimiter(global_rate=1000, per_chat_interval=0),
+    )
+
+    result = await engine.run(range(1, 6))
+
+    assert result == {"sent": 4, "failed": 1, "total": 5}
+    assert sorted(user_id for user_id, _ in bot.messages) == [1, 2, 4, 5]
+    assert engine.limiter.retry_after_count == 1
+    assert "РАССЫЛКА ЗАВЕРШЕНА" in bot.edits[-1]
+
+
+@pytest.mark.asyncio
+async def test_rate_limiter_spaces_messages_to_the_same_chat():
+    limiter = TelegramRateLimiter(global_rate=1000, per_chat_interval=0.05)
+
+    started = time.monotonic()
+    await limiter.acquire(42)
+    await limiter.acquire(43)
+    await limiter.acquire(42)
+
+    assert time.monotonic() - started >= 0.05
+
+
+@pytest.mark.asyncio
+async def test_broadcast_job_resumes_from_checkpoint_without_double_send():
+    await database.init_db()
+    for user_id in range(1, 8):
+        await database.save_user(user_id, f"user{user_id}", "User")
+    job_id = await database.create_broadcast_job("promo", 1, 100, total=7)
+
+    # Первый запуск "упал" после того, как зарезервировал и отправил первую пачку
+    first_batch = await database.reserve_broadcast_recipients(job_id, limit=3)
+    assert list(first_batch) == [1, 2, 3]
+    await database.record_broadcast_results(job_id, [(1, "sent"), (2, "sent")])
+
+    [job] = await database.get_unfinished_broadcast_jobs()
+    bot = FakeBot(fail_for={6})
+    engine = BroadcastJob(
+        bot, job, concurrency=2, limiter=TelegramRateLimiter(global_rate=1000, per_chat_interval=0)
+    )
+    engine.batch_size = 2
+    await engine.run()
+
+    assert sorted(user_id for user_id, _ in bot.messages) == [4, 5, 7]
+    assert (engine.sent, engine.failed) == (5, 1)
+    assert await database.get_unfinished_broadcast_jobs() == []
+
+
+@pytest.mark.asyncio
+async def test_broadcast_job_retries_failed_checkpoint_and_raises_on_final(monkeypatch, caplog):
+    await database.init_db()
+    for user_id in range(1, 6):
+        await database.save_user(user_id, f"user{user_id}", "User")
+    limiter = TelegramRateLimiter(global_rate=1000, per_chat_interval=0)
+    record_results = database.record_broadcast_results
+    calls = []
+
+    async def flaky_record(job_id, results):
+        calls.append(list(results))
+        if len(calls) == 1:
+            raise RuntimeError("database is locked")
+        await record_results(job_id, results)
+
+    monkeypatch.setattr(database, "record_broadcast_results", flaky_record)
+    job_id = await database.create_broadcast_job("promo", 1, 100, total=5)
+    [job] = await database.get_unfinished_broadcast_jobs()
+    engine = BroadcastJob(FakeBot(), job, concurrency=1, limiter=limiter)
+    engine.batch_size = 2
+    await engine.run()
+
+    # Пачка из неудачной фиксации ушла со следующей
+    assert calls[1][:2] == calls[0]
+    assert (engine.sent, engine.failed) == (5, 0)
+
+    async def broken_record(job_id, results):
+        raise RuntimeError("disk I/O error")
+
+    monkeypatch.setattr(database, "record_broadcast_results", broken_record)
+    job_id = await database.create_broadcast_job("promo", 1, 101, total=5)
+    [job] = await database.get_unfinished_broadcast_jobs()
+    bot = FakeBot()
+    task = launch_broadcast(BroadcastJob(bot, job, concurrency=1, limiter=limiter))
+    with pytest.raises(RuntimeError, match="disk I/O error"):
+        await task
+    await asyncio.sleep(0)  # done-callback задачи
+    assert [job["id"] for job in await database.get_unfinished_broadcast_jobs()] == [job_id]
+    assert "РАССЫЛКА ПРЕРВАНА" in bot.edits[-1]
+    assert "Broadcast failed" in caplog.text
@@ -0,0 +1,82 @@
+from datetime import date, timedelta
+
+import pytest
+
+import analytics
+import churn_terms
+import database
+
+
+@pytest.fixture(autouse=True)
+async def analytics_pool():
+    yield
+    await analytics.shutdown_analytics()
+
+
+def test_tokenize_drops_stopwords_and_repeats():
+    assert churn_terms.tokenize("Слишком ДОРОГО, очень дорого! Ещё и 2 бага") == [
+        "слишком",
+        "дорого",
+        "бага",
+    ]
+    assert churn_terms.tokenize("") == []
+    # Слова длиннее MAX_TERM_LENGTH с общим началом - один термин
+    prefix = "а" * churn_terms.MAX_TERM_LENGTH
+    assert churn_terms.tokenize(f"{prefix}xyz {prefix}qqq") == [prefix]
+
+
+async def test_terms_are_indexed_incrementally_by_day(isolated_db):
+    await database.init_db()
+    await database.save_cancellation_reason(1, "a", "Слишком дорого")
+    await database.save_cancellation_reason(2, "b", "дорого и мало контента")
+
+    report = await churn_terms.catch_up(batch_size=1)
+    assert report == {"reasons": 2, "batches": 2}
+    # Повторный запуск без новых отмен ничего не добавляет
+    assert await churn_terms.catch_up() == {"reasons": 0, "batches": 0}
+
+    await database.save_cancellation_reason(3, "c", "мало контента")
+    themes = await analytics.churn_themes(30)
+    assert themes["pending"] == 1
+
+    await churn_terms.catch_up()
+    themes = await analytics.churn_themes(30, limit=3)
+    assert themes == {
+        "themes": [("дорого", 2), ("контента", 2), ("мало", 2)],
+        "pending": 0,
+    }
+
+    # Окно дат читается только из cancellation_terms
+    async with database.get_write_db() as db:
+        await db.execute(
+            "UPDATE cancellation_terms SET day = ? WHERE term = 'слишком'",
+            ((date.today() - timedelta(days=10)).isoformat(),),
+        )
+        await db.commit()
+    week = await analytics.churn_themes(7)
+    assert "слишком" not in dict(week["themes"])
+    assert dict((await analytics.churn_themes(30))["themes"])["слишком"] == 1
+
+
+async def test_cancellation_search_matches_word_prefixes(isolated_db):
+    await database.init_db()
+    for i, reason in enumerate(
+        ["Дорогая подписка", "нет времени", 'цена "дороговата" OR NOT', "дорого и скучно"], 1
+    ):
+        await database.save_cancellation_reason(i, f"user{i}", reason)
+
+    records, snippets, has_more = await analytics.search_cancellations("дорог", limit=2)
+    assert [r.user_id for r in records] == [4, 3] and has_more
+    assert analytics.MATCH_START + "дорого" + analytics.MATCH_END in snippets[0]
+
+    records, _, has_more = await analytics.search_cancellations(
+        "дорог", before_id=records[-1].id, limit=2
+    )
+    assert [r.user_id for r in records] == [1] and not has_more
+
+    # Все слова обязательны, операторы FTS5 в запросе - обычный текст
+    records, _, _ = await analytics.search_cancellations("дорог скучн")
+    assert [r.user_id for r in records] == [4]
+    records, _, _ = await analytics.search_cancellations('"OR')
+    assert [r.user_id for r in records] == [3]
+    assert await analytics.search_cancellations("  ?! ") == ([], [], False)
@@ -1,8 +1,14 @@
-from datetime import datetime, timedelta
+import asyncio
+import sqlite3
+from datetime import datetime, timedelta, timezone
 
 import pytest
 
 import database
+import migrations
+import rollups
+import stats
+from records import SubscriptionRecord, UserRecord
 
 
 @pytest.mark.asyncio
@@ -11,7 +17,8 @@ async def test_user_lifecycle_and_payment_attempt():
     await database.save_user(1001, "alice", "Alice")
 
     users = await database.get_all_users()
-    assert users == [{"user_id": 1001, "username": "alice", "first_name": "Alice"}]
+    assert [(u.user_id, u.username, u.first_name) for u in users] == [(1001, "alice", "Alice")]
+    assert users[0].join_date.date() == datetime.now().date()
 
     assert await database.has_payment_attempt(1001) is False
     await database.mark_payment_attempt(1001)
@@ -33,10 +40,10 @@ async def test_subscription_create_activate_cancel_and_expire():
 
     sub = await database.get_subscription(2002)
     assert sub is not None
-    assert sub["status"] == "active"
-    assert sub["payment_provider"] == "tribute"
-    assert sub["stripe_subscription_id"] == "tr_abc123"
-    assert sub["expires_at"] > datetime.now()
+    assert sub.status == "active"
+    assert sub.payment_provider == "tribute"
+    assert sub.stripe_subscription_id == "tr_abc123"
+    assert sub.expires_at > datetime.now()
     assert await database.is_subscription_active(2002) is True
 
     by_stripe = await database.get_subscription_by_stripe_id("tr_abc123")
@@ -44,12 +51,12 @@ async def test_subscription_create_activate_cancel_and_expire():
 
     await database.cancel_subscription(2002)
     cancelled = await database.get_subscription(2002)
-    assert cancelled["status"] == "cancelled"
+    assert cancelled.status == "cancelled"
     assert await database.is_subscription_active(2002) is False
 
     await database.expire_subscription(2002)
     expired = await database.get_subscription(2002)
-    assert expired["status"] == "expired"
+    assert expired.status == "expired"
 
 
 @pytest.mark.asyncio
@@ -65,12 +72,12 @@ async def test_notification_and_expiring_queries():
     )
 
     expiring = await database.get_expiring_subscriptions(days=3)
-    user_ids = {item["user_id"] for item in expiring}
+    user_ids = {item.user_id for item in expiring}
     assert 3003 in user_ids
 
     await database.mark_notification(3003, "expiry_3d")
     expiring_after_mark = await database.get_expiring_subscriptions(days=3)
-    user_ids_after = {item["user_id"] for item in expiring_after_mark}
+    user_ids_after = {item.user_id for item in expiring_after_mark}
     assert 3003 not in user_ids_after
 
 
@@ -89,10 +96,405 @@ async def test_expired_active_subscriptions_query_and_stats():
     await database.update_subscription_period(4004, past)
 
     expired = await database.get_expired_active_subscriptions()
-    expired_ids = {item["user_id"] for item in expired}
+    expired_ids = {item.user_id for item in expired}
     assert 4004 in expired_ids
 
+    assert await database.expire_subscriptions([4004, 9999]) == [4004]
+    assert await database.get_expired_active_subscriptions() == []
+    assert (await database.get_subscription(4004)).status == "expired"
+
     await database.save_cancellation_reason(4004, "dora", "Too expensive")
     stats = await database.get_user_stats()
     assert "Всего пользователей: 1" in stats
     assert "Отмен за 7 дней: 1" in stats
+
+
+@pytest.mark.asyncio
+async def test_connection_pool_reuses_connections():
+    await database.init_db()
+    before = database.get_pool_stats()
+
+    await database.save_user(5005, "eve", "Eve")
+    await database.get_subscription(5005)
+    assert await database.has_payment_attempt(5005) is False
+
+    stats = database.get_pool_stats()
+    assert stats["checkouts"] == before["checkouts"] + 3
+    assert stats["in_flight"] == 0
+    assert stats["idle_readers"] == stats["readers"]
+
+    await database.close_db()
+    assert database.get_pool_stats() is None
+
+
+@pytest.mark.asyncio
+async def test_load_user_context_upserts_and_reports_state():
+    await database.init_db()
+
+    context = await database.load_user_context(6006, "frank", "Frank")
+    assert context["is_active"] is False
+    assert context["has_payment_attempt"] is False
+    assert context["status"] is None
+    [user] = await database.get_all_users()
+    assert (user.user_id, user.username, user.first_name) == (6006, "frank", "Frank")
+
+    await database.mark_payment_attempt(6006)
+    await database.create_subscription(
+        user_id=6006, payment_provider="stripe", invite_link="https://t.me/+x", days=5
+    )
+    context = await database.load_user_context(6006)
+    assert context["is_active"] is True
+    assert context["has_payment_attempt"] is True
+    assert context["status"] == "active"
+    assert context["expires_at"] > datetime.now()
+
+
+@pytest.mark.asyncio
+async def test_subscription_cache_hits_and_write_through_invalidation():
+    await database.init_db()
+    await database.save_user(7007, "gina", "Gina")
+    await database.create_subscription(
+        user_id=7007, payment_provider="stripe", invite_link="https://t.me/+y", days=5
+    )
+
+    before = database.get_cache_stats()
+    assert (await database.get_subscription(7007)).status == "active"
+    assert await database.is_subscription_active(7007) is True
+    stats = database.get_cache_stats()
+    assert stats["misses"] == before["misses"] + 1
+    assert stats["hits"] == before["hits"] + 1
+
+    await database.cancel_subscription(7007)
+    assert (await database.get_subscription(7007)).status == "cancelled"
+
+    await database.expire_subscription(7007)
+    assert await database.is_subscription_active(7007) is False
+    assert (await database.get_subscription(7007)).status == "expired"
+
+
+def test_ttl_cache_evicts_least_recently_used():
+    cache = database.TTLCache(maxsize=2, ttl=60)
+    cache.put(1, "a", cache.generation)
+    cache.put(2, "b", cache.generation)
+    assert cache.get(1) == "a"
+    cache.put(3, "c", cache.generation)
+
+    assert cache.get(2, None) is None
+    assert cache.get(1) == "a"
+    assert cache.stats()["evictions"] == 1
+
+    stale_generation = cache.generation
+    cache.invalidate(1)
+    cache.put(1, "stale", stale_generation)
+    assert cache.get(1, None) is None
+
+
+@pytest.mark.asyncio
+async def test_expiring_subscriptions_paging_and_bulk_mark():
+    await database.init_db()
+    for user_id in (8001, 8002, 8003):
+        await database.create_subscription(
+            user_id=user_id, payment_provider="stripe", invite_link="https://t.me/+z", days=2
+        )
+
+    first = await database.get_expiring_subscriptions(days=3, limit=2)
+    assert [item.user_id for item in first] == [8001, 8002]
+    rest = await database.get_expiring_subscriptions(days=3, after_user_id=8002, limit=2)
+    assert [item.user_id for item in rest] == [8003]
+
+    await database.mark_notifications([8001, 8003], "expiry_3d")
+    remaining = await database.get_expiring_subscriptions(days=3)
+    assert [item.user_id for item in remaining] == [8002]
+
+
+@pytest.mark.asyncio
+async def test_users_page_keyset_navigation_and_counter():
+    await database.init_db()
+    for user_id in range(1, 6):
+        await database.save_user(user_id, f"user{user_id}", "User")
+    await database.save_user(3, "renamed", "User")  # upsert не меняет счетчик
+    assert await database.count_users() == 5
+
+    page, has_more = await database.get_users_page(limit=2)
+    assert [u["user_id"] for u in page] == [5, 4] and has_more
+
+    last = page[-1]
+    page, has_more = await database.get_users_page((last["join_date"], last["user_id"]), limit=2)
+    assert [u["user_id"] for u in page] == [3, 2] and has_more
+
+    first = page[0]
+    page, has_more = await database.get_users_page(
+        (first["join_date"], first["user_id"]), backwards=True, limit=2
+    )
+    assert [u["user_id"] for u in page] == [5, 4] and not has_more
+
+
+@pytest.mark.asyncio
+async def test_migrations_convert_legacy_text_timestamps(isolated_db):
+    legacy = sqlite3.connect(isolated_db)
+    legacy.executescript(
+        """
+        CREATE TABLE users (
+            user_id INTEGER PRIMARY KEY, username TEXT, first_name TEXT,
+            join_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP, has_payment_attempt BOOLEAN DEFAULT FALSE
+        );
+        CREATE TABLE subscriptions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL UNIQUE,
+            expires_at TIMESTAMP NOT NULL, invite_link TEXT, payment_provider TEXT,
+            stripe_customer_id TEXT, stripe_subscription_id TEXT, status TEXT DEFAULT 'active',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        INSERT INTO users (user_id, username, join_date) VALUES (1, 'old', '2025-03-01 12:00:00');
+        """
+    )
+    expires_at = (datetime.now() + timedelta(days=5)).replace(microsecond=0)
+    legacy.execute(
+        "INSERT INTO subscriptions (user_id, expires_at, status) VALUES (1, ?, 'active')",
+        (expires_at.isoformat(),),
+    )
+    legacy.commit()
+    legacy.close()
+
+    await database.init_db()
+
+    async with database.get_db() as db:
+        async with db.execute("PRAGMA user_version") as cursor:
+            assert (await cursor.fetchone())[0] == migrations.SCHEMA_VERSION
+        async with db.execute("SELECT join_date, typeof(join_date) FROM users") as cursor:
+            join_date, kind = await cursor.fetchone()
+    assert kind == "integer"
+    assert join_date == int(datetime(2025, 3, 1, 12, tzinfo=timezone.utc).timestamp())
+
+    sub = await database.get_subscription(1)
+    assert sub.expires_at == expires_at
+    assert await database.count_users() == 1
+    await database.save_user(2, "new", "New")
+    assert await database.count_users() == 2
+
+    # Повторный запуск ничего не применяет
+    async with database.get_write_db() as db:
+        assert await migrations.run_migrations(db) == 0
+
+
+@pytest.mark.asyncio
+async def test_enforcer_queries_use_partial_index():
+    await database.init_db()
+
+    plans = await database.check_query_plans()
+
+    assert database.find_full_scans(plans) == []
+    for name, steps in plans.items():
+        assert any("idx_sub_active_expires" in step for step in steps), name
+
+
+@pytest.mark.asyncio
+async def test_stats_counters_follow_writes_and_check_reports_drift(isolated_db, capsys):
+    await database.init_db()
+    for user_id in (1, 2, 3):
+        await database.save_user(user_id, f"user{user_id}", "User")
+    await database.create_subscription(1, "stripe", "https://t.me/+a", days=-1)
+    await database.create_subscription(2, "stripe", "https://t.me/+b")
+    await database.create_subscription(2, "stripe", "https://t.me/+b2")  # продление, не новая
+    await database.cancel_subscription(2)
+    await database.expire_subscriptions([1, 2])  # 2 уже отменена и не меняется
+    await database.save_cancellation_reason(2, "user2", "дорого")
+
+    counters = await database.get_stats_counters()
+    assert counters["users_total"] == 3
+    assert counters["subscriptions_total"] == 2
+    assert counters["subscriptions_active"] == 0
+    assert counters["subscriptions_cancelled"] == 1
+    assert counters["subscriptions_expired"] == 1
+    assert counters["cancellations_total"] == 1
+    assert await database.count_recent("users", datetime.now() - timedelta(minutes=5)) == 3
+    assert "Отмен за 7 дней: 1" in await database.get_user_stats()
+
+    assert await stats.check_counters() == 0
+    async with database.get_write_db() as db:
+        await db.execute("UPDATE stats_counters SET value = 10 WHERE name = 'users_total'")
+        await db.commit()
+    assert await stats.check_counters() == 1
+    assert "users_total: в счетчике 10, в таблицах 3" in capsys.readouterr().out
+    assert await stats.check_counters(fix=True) == 0
+    assert await database.count_users() == 3
+
+
+@pytest.mark.asyncio
+async def test_daily_rollups_follow_writes_and_backfill():
+    await database.init_db()
+    old_day = datetime.now() - timedelta(days=40)
+    async with database.get_write_db() as db:
+        await db.execute(
+            "INSERT INTO users (user_id, username, join_date) VALUES (1, 'old', ?)",
+            (database.to_epoch(old_day),),
+        )
+        await db.commit()
+    await database.save_user(2, "new", "New")
+    await database.create_subscription(2, "stripe", "https://t.me/+a", days=5)
+    await database.update_subscription_period(2, datetime.now() + timedelta(days=35))
+    await database.cancel_subscription(2)
+    await database.create_subscription(2, "stripe", "https://t.me/+b", days=40)  # повторно
+    async with database.get_write_db() as db:
+        await db.execute("UPDATE subscriptions SET expires_at = ? WHERE user_id = 2", (database.to_epoch(old_day),))
+        await db.commit()
+    await database.expire_subscriptions([2])
+
+    series = await database.get_daily_series(90)
+    assert series["signups"][-1] == 1 and series["signups"][-41] == 1
+    assert series["new_subscriptions"][-1] == 1
+    assert series["renewals"][-1] == 2
+    assert series["cancellations"][-1] == 1
+    assert series["expirations"][-1] == 1
+    assert sum(series["signups"][-30:]) == 1
+
+    async with database.get_write_db() as db:
+        await migrations.backfill_daily_stats(db)
+        await db.commit()
+    series = await database.get_daily_series(90)
+    assert series["signups"][-41] == 1
+    assert series["new_subscriptions"][-1] == 1
+    assert series["renewals"][-1] == 0  # по истории продления не восстанавливаются
+
+    lines = rollups.render_report(series)
+    assert lines[0] == "👥 Новые пользователи: 1 / 2 / 2"
+
+
+@pytest.mark.asyncio
+async def test_user_writes_are_coalesced_and_flushed(isolated_db):
+    await database.init_db()
+    buffer = database._user_writes
+    buffer.flush_interval = 60  # фоновый сброс не мешает проверкам
+
+    for user_id in range(1, 6):
+        await database.load_user_context(user_id, f"user{user_id}", "Name")
+    await database.load_user_context(1, "user1", "Name")  # без изменений
+    await database.mark_payment_attempt(2)
+    await database.mark_payment_attempt(2)
+
+    stats = database.get_user_write_stats()
+    assert stats["pending"] == 6 and stats["skipped"] == 2
+    assert stats["flushes"] == 0
+
+    # Чтения, не касающиеся users, буфер не сбрасывают
+    assert await database.get_subscription(1) is None
+    assert await database.count_user_cancellations(1) == 0
+    assert database.get_user_write_stats()["pending"] == 6
+
+    # Чтения users видят отложенные изменения
+    assert await database.has_payment_attempt(2) is True
+    assert await database.count_users() == 5
+    stats = database.get_user_write_stats()
+    assert stats["pending"] == 0 and stats["flushes"] == 1 and stats["rows_flushed"] == 6
+
+    context = await database.load_user_context(2, "user2", "Name")
+    assert context["has_payment_attempt"] is True
+    assert database.get_user_write_stats()["pending"] == 0
+
+    # Остаток записывается при закрытии
+    await database.save_user(3, "renamed", "Name")
+    await database.close_db()
+    conn = sqlite3.connect(isolated_db)
+    try:
+        assert conn.execute("SELECT username FROM users WHERE user_id = 3").fetchone()[0] == "renamed"
+    finally:
+        conn.close()
+
+
+@pytest.mark.asyncio
+async def test_write_queue_group_commits_and_isolates_failures():
+    await database.init_db()
+
+    async def broken(db):
+        await db.execute("INSERT INTO cancellations (user_id, reason) VALUES (999, 'lost')")
+        raise RuntimeError("boom")
+
+    writes = [database.save_cancellation_reason(user_id, "u", "reason") for user_id in range(1, 51)]
+    results = await asyncio.gather(*writes, database.run_write(broken), return_exceptions=True)
+
+    assert isinstance(results[-1], RuntimeError)
+    assert all(result is None for result in results[:-1])
+    stats = database.get_write_queue_stats()
+    assert stats["requests"] == 51 and stats["failed"] == 1
+    assert stats["batches"] < 10 and stats["max_batch"] > 1
+    assert stats["depth"] == 0
+
+    counters = await database.get_stats_counters()
+    assert counters["cancellations_total"] == 50
+    async with database.get_db() as db:
+        async with db.execute("SELECT COUNT(*) FROM cancellations WHERE user_id = 999") as cursor:
+            assert (await cursor.fetchone())[0] == 0
+
+
+@pytest.mark.asyncio
+async def test_records_and_column_fetches():
+    await database.init_db()
+    await database.save_user(1, "ann", "Ann")
+    await database.mark_payment_attempt(1)
+    for user_id in (1, 2, 3):
+        await database.create_subscription(user_id, "stripe", "https://t.me/+r", days=2)
+    await database.update_subscription_period(3, datetime.now() - timedelta(hours=1))
+
+    sub = await database.get_subscription(1)
+    assert isinstance(sub, SubscriptionRecord) and not hasattr(sub, "__dict__")
+    assert isinstance(sub.expires_epoch, int) and sub.is_active()
+    assert sub.expires_at == datetime.fromtimestamp(sub.expires_epoch)
+    assert await database.get_subscription(1) is sub  # из кэша без копии
+
+    user = await database.get_user(1)
+    assert user == UserRecord(1, "ann", "Ann", user.join_epoch, True)
+    assert await database.get_user(404) is None
+
+    columns = await database.get_expiring_columns(days=3)
+    assert columns.user_ids.typecode == "q" and list(columns.user_ids) == [1, 2]
+    assert [record.user_id for record in columns] == [1, 2]
+    assert columns.last_user_id == 2
+    expired = await database.get_expired_active_columns()
+    assert list(expired.user_ids) == [3] and not (await database.get_subscription(3)).is_active()
+
+    upcoming = await database.get_upcoming_expiries(datetime.now(), datetime.now() + timedelta(days=3))
+    assert {(r.user_id, r.expires_at) for r in upcoming} == {
+        (1, sub.expires_at),
+        (2, (await database.get_subscription(2)).expires_at),
+    }
+
+
+@pytest.mark.asyncio
+async def test_user_search_by_prefix_substring_and_id():
+    await database.init_db()
+    for user_id, username, first_name in [
+        (1, "AnnaK", "Анна"),
+        (2, "annette", "Аннет"),
+        (3, "bob_anna", "Боб"),
+        (4, "carl", "Карл"),
+        (5, None, "Жанна"),
+    ]:
+        await database.save_user(user_id, username, first_name)
+
+    users, has_more = await database.search_users("@ann")
+    assert [u.user_id for u in users] == [1, 2] and not has_more
+    users, _ = await database.search_users("anna")
+    assert [u.user_id for u in users] == [1, 3]
+    users, _ = await database.search_users("нна")
+    assert [u.user_id for u in users] == [1, 5]
+    assert [u.user_id for u in (await database.search_users("4"))[0]] == [4]
+    assert await database.search_users("@") == ([], False)
+
+    first, has_more = await database.search_users("ann", limit=2)
+    assert [u.user_id for u in first] == [1, 2] and has_more
+    rest, has_more = await database.search_users("ann", after_user_id=2, limit=2)
+    assert [u.user_id for u in rest] == [3] and not has_more
+
+    # Индекс FTS следует за переименованием
+    await database.save_user(4, "carl_anna", "Карл")
+    assert [u.user_id for u in (await database.search_users("anna"))[0]] == [1, 3, 4]
+    assert await database.find_users_by_usernames(["annak", "CARL_ANNA", "nobody"]) == {
+        "annak": 1,
+        "carl_anna": 4,
+    }
+
+    async with database.get_db() as db:
+        async with db.execute(
+            "EXPLAIN QUERY PLAN SELECT user_id FROM users WHERE lower(username) IN (?, ?)", ("a", "b")
+        ) as cursor:
+            plan = [row[3] for row in await cursor.fetchall()]
+    assert any("idx_users_username_lower" in step for step in plan)
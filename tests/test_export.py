@@ -0,0 +1,61 @@
+import csv
+import gzip
+import io
+
+import pytest
+
+import database
+import export
+
+
+async def _seed_users(count: int):
+    await database.init_db()
+    for user_id in range(1, count + 1):
+        await database.save_user(user_id, f"user{user_id}", f'Name, "{user_id}"')
+    await database.create_subscription(1, "stripe", "https://t.me/+invite")
+
+
+def _read_rows(path, compressed: bool):
+    raw = path.read_bytes()
+    if compressed:
+        raw = gzip.decompress(raw)
+    return list(csv.reader(io.StringIO(raw.decode("utf-8-sig"))))
+
+
+@pytest.mark.parametrize("compress", [False, True])
+async def test_export_users_streams_to_csv(isolated_db, compress):
+    await _seed_users(5)
+
+    parts, rows_total = await export.export_users_csv(compress=compress, db_path=str(isolated_db))
+    try:
+        assert rows_total == 5
+        assert len(parts) == 1
+        assert parts[0].name.endswith(".csv.gz" if compress else ".csv")
+
+        rows = _read_rows(parts[0], compress)
+        assert rows[0] == export.EXPORT_HEADER
+        by_id = {row[0]: row for row in rows[1:]}
+        assert by_id["3"][2] == 'Name, "3"'
+        assert by_id["1"][5] == "active"
+        assert by_id["2"][5] == "none"
+    finally:
+        export.cleanup_export(parts)
+    assert not parts[0].parent.exists()
+
+
+async def test_export_users_splits_parts_over_limit(isolated_db, monkeypatch):
+    await _seed_users(30)
+    monkeypatch.setattr(export, "EXPORT_BATCH_SIZE", 10)
+
+    parts, rows_total = await export.export_users_csv(part_limit=1, db_path=str(isolated_db))
+    try:
+        assert rows_total == 30
+        assert len(parts) == 3
+        all_rows = []
+        for path in parts:
+            rows = _read_rows(path, False)
+            assert rows[0] == export.EXPORT_HEADER
+            all_rows.extend(rows[1:])
+        assert sorted(int(row[0]) for row in all_rows) == list(range(1, 31))
+    finally:
+        export.cleanup_export(parts)
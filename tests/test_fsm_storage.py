@@ -0,0 +1,114 @@
+import asyncio
+import time
+from datetime import datetime, timedelta
+
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import StorageKey
+
+import database
+from fsm_storage import PersistentFSMStorage
+
+
+class Form(StatesGroup):
+    waiting = State()
+
+
+def _key(user_id: int) -> StorageKey:
+    return StorageKey(bot_id=42, chat_id=user_id, user_id=user_id)
+
+
+async def _stored_keys() -> list:
+    async with database.get_db() as db:
+        async with db.execute("SELECT key FROM fsm_states ORDER BY key") as cursor:
+            return [row[0] for row in await cursor.fetchall()]
+
+
+async def test_states_survive_restart_and_flush_in_batches(isolated_db):
+    await database.init_db()
+    fsm = PersistentFSMStorage(flush_interval=60)
+    fsm.start()
+    await fsm.set_state(_key(1), Form.waiting)
+    await fsm.update_data(_key(1), {"target": 7, "text": "привет"})
+    await fsm.set_state(_key(2), Form.waiting)
+    # Изменения пока только в памяти
+    assert await _stored_keys() == []
+    assert await fsm.get_state(_key(1)) == "Form:waiting"
+
+    await fsm.close()
+    assert fsm.stats()["flushes"] == 1 and fsm.stats()["rows_flushed"] == 2
+
+    restarted = PersistentFSMStorage()
+    assert await restarted.get_state(_key(1)) == "Form:waiting"
+    assert await restarted.get_data(_key(1)) == {"target": 7, "text": "привет"}
+    assert await restarted.get_state(_key(3)) is None
+
+    # state.clear() - пустое состояние удаляет строку
+    await restarted.set_state(_key(1), None)
+    await restarted.set_data(_key(1), {})
+    assert len(await _stored_keys()) == 1
+
+
+async def test_abandoned_states_expire_and_memory_is_bounded(isolated_db):
+    await database.init_db()
+    fsm = PersistentFSMStorage(ttl=3600, cache_size=2)
+    for user_id in range(1, 6):
+        await fsm.set_state(_key(user_id), Form.waiting)
+    assert fsm.stats()["size"] == 2
+    # Вытесненные ключи читаются из БД
+    assert await fsm.get_state(_key(1)) == "Form:waiting"
+
+    stale = int(time.time()) - 7200
+    await database.save_fsm_states([("fsm:42:9:9:default", "Form:waiting", "{}", stale)])
+    assert await fsm.get_state(_key(9)) is None
+    assert await fsm.purge() == 1
+    assert len(await _stored_keys()) == 5
+
+    # Состояние в памяти тоже истекает
+    fsm._entries[fsm.key_builder.build(_key(1))].updated_at = stale
+    assert await fsm.get_state(_key(1)) is None
+    assert fsm.stats()["expired"] == 1
+
+
+async def test_processes_share_state_without_losing_newer_writes(isolated_db):
+    await database.init_db()
+    first = PersistentFSMStorage(cache_seconds=0, flush_interval=60)
+    second = PersistentFSMStorage(cache_seconds=0)
+    assert await second.get_state(_key(1)) is None
+
+    first.start()
+    await first.set_state(_key(1), Form.waiting)
+    # Свои несброшенные изменения процесс видит, пока другой читает из БД
+    assert await first.get_state(_key(1)) == "Form:waiting"
+    assert await second.get_state(_key(1)) is None
+    await first.flush()
+    assert await second.get_state(_key(1)) == "Form:waiting"
+
+    # Запоздавший сброс более старой записи не затирает новую
+    await second.update_data(_key(1), {"step": 2})
+    await database.save_fsm_states(
+        [(first.key_builder.build(_key(1)), None, "{}", int(time.time()) - 10)]
+    )
+    assert await first.get_data(_key(1)) == {"step": 2}
+    await first.close()
+
+
+async def test_flush_failure_keeps_changes_pending(isolated_db, monkeypatch):
+    await database.init_db()
+    fsm = PersistentFSMStorage(flush_interval=0.01)
+    fsm.start()
+
+    save_fsm_states = database.save_fsm_states
+
+    async def failing_save(rows):
+        raise RuntimeError("db is down")
+
+    monkeypatch.setattr(database, "save_fsm_states", failing_save)
+    await fsm.set_state(_key(1), Form.waiting)
+    await asyncio.sleep(0.05)
+    assert fsm.stats()["pending"] == 1
+
+    monkeypatch.setattr(database, "save_fsm_states", save_fsm_states)
+    await fsm.close()
+    assert fsm.stats()["pending"] == 0
+    since = datetime.now() - timedelta(hours=1)
+    assert await database.load_fsm_state(fsm.key_builder.build(_key(1)), since) is not None
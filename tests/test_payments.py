@@ -2,6 +2,7 @@ import json
 
 import pytest
 
+import database
 import payments.stripe_pay as stripe_module
 from payments.factory import PaymentFactory
 from payments.stripe_pay import StripePaymentHandler
@@ -17,7 +18,15 @@ def disable_stripe_signature(monkeypatch):
     monkeypatch.setattr(stripe_module, "STRIPE_WEBHOOK_SECRET", "")
 
 
-def test_parse_stripe_webhook_checkout_completed():
+@pytest.fixture(autouse=True)
+def clear_checkout_cache():
+    PaymentFactory.clear_cache()
+    yield
+    PaymentFactory.clear_cache()
+
+
+@pytest.mark.asyncio
+async def test_parse_stripe_webhook_checkout_completed():
     payload = _make_payload(
         "checkout.session.completed",
         {
@@ -27,7 +36,7 @@ def test_parse_stripe_webhook_checkout_completed():
             "metadata": {"telegram_user_id": "42"},
         },
     )
-    result = StripePaymentHandler.parse_webhook(payload, "")
+    result = await StripePaymentHandler.parse_webhook(payload, "")
 
     assert result is not None
     assert result["user_id"] == 42
@@ -37,13 +46,15 @@ def test_parse_stripe_webhook_checkout_completed():
     assert result["status"] == "succeeded"
 
 
-def test_parse_stripe_webhook_unknown_event_returns_none():
+@pytest.mark.asyncio
+async def test_parse_stripe_webhook_unknown_event_returns_none():
     payload = _make_payload("payment_intent.created", {"id": "pi_test"})
-    result = StripePaymentHandler.parse_webhook(payload, "")
+    result = await StripePaymentHandler.parse_webhook(payload, "")
     assert result is None
 
 
-def test_parse_stripe_webhook_missing_user_id_returns_none():
+@pytest.mark.asyncio
+async def test_parse_stripe_webhook_missing_user_id_returns_none():
     payload = _make_payload(
         "checkout.session.completed",
         {
@@ -53,10 +64,39 @@ def test_parse_stripe_webhook_missing_user_id_returns_none():
             "metadata": {},  # нет telegram_user_id
         },
     )
-    result = StripePaymentHandler.parse_webhook(payload, "")
+    result = await StripePaymentHandler.parse_webhook(payload, "")
     assert result is None
 
 
+@pytest.mark.asyncio
+async def test_parse_stripe_webhook_renewal_retrieves_subscription_off_loop(monkeypatch):
+    import threading
+
+    threads = []
+
+    def fake_retrieve(subscription_id):
+        threads.append(threading.current_thread().name)
+        return stripe_module.stripe.StripeObject.construct_from(
+            {"id": subscription_id, "metadata": {"telegram_user_id": "77"}}, "sk_test"
+        )
+
+    monkeypatch.setattr(stripe_module.stripe.Subscription, "retrieve", fake_retrieve)
+    payload = _make_payload(
+        "invoice.payment_succeeded",
+        {
+            "billing_reason": "subscription_cycle",
+            "subscription": "sub_123",
+            "amount_paid": 1900,
+            "currency": "usd",
+        },
+    )
+    result = await StripePaymentHandler.parse_webhook(payload, "")
+
+    assert result["user_id"] == 77
+    assert result["status"] == "renewed"
+    assert threads and threads[0].startswith("stripe")
+
+
 @pytest.mark.asyncio
 async def test_payment_factory_returns_stripe_url(monkeypatch):
     async def fake_create(user_id, username=None):
@@ -64,6 +104,7 @@ async def test_payment_factory_returns_stripe_url(monkeypatch):
 
     monkeypatch.setattr(StripePaymentHandler, "create_payment", fake_create)
 
+    await database.init_db()
     result = await PaymentFactory.create_payment(123, "alice")
     assert result == "https://checkout.stripe.com/pay/cs_test_abc"
 
@@ -75,5 +116,29 @@ async def test_payment_factory_on_stripe_error_returns_none(monkeypatch):
 
     monkeypatch.setattr(StripePaymentHandler, "create_payment", failing_create)
 
+    await database.init_db()
     result = await PaymentFactory.create_payment(999)
     assert result is None
+
+
+@pytest.mark.asyncio
+async def test_payment_factory_reuses_open_session_across_restarts(monkeypatch):
+    created = []
+
+    async def fake_create(user_id, username=None):
+        created.append(user_id)
+        return f"https://checkout.stripe.com/pay/cs_{len(created)}"
+
+    monkeypatch.setattr(StripePaymentHandler, "create_payment", fake_create)
+    await database.init_db()
+
+    first = await PaymentFactory.create_payment(321)
+    assert await PaymentFactory.create_payment(321) == first
+
+    PaymentFactory.clear_cache()  # имитация перезапуска: остается только SQLite
+    assert await PaymentFactory.create_payment(321) == first
+    assert created == [321]
+
+    await PaymentFactory.invalidate(321)
+    assert await PaymentFactory.create_payment(321) != first
+    assert created == [321, 321]
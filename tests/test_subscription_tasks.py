@@ -1,8 +1,12 @@
 from datetime import datetime, timedelta, timezone
 
+import asyncio
+
 import pytest
 
+import database
 import subscription_tasks
+from records import ExpiryColumns
 
 
 class FakeBot:
@@ -28,22 +32,24 @@ async def test_send_expiry_warnings_marks_notification(monkeypatch):
     marked = []
     calls = []
 
-    async def fake_get_expiring_subscriptions(days):
+    async def fake_get_expiring_columns(days, after_user_id=0, limit=None):
         calls.append(days)
+        if after_user_id:
+            return ExpiryColumns()
         if days == 3:
-            return [{"user_id": 10, "expires_at": now + timedelta(days=2)}]
+            return ExpiryColumns([(10, int((now + timedelta(days=2)).timestamp()))])
         if days == 1:
-            return [{"user_id": 11, "expires_at": now + timedelta(days=1)}]
-        return []
+            return ExpiryColumns([(11, int((now + timedelta(days=1)).timestamp()))])
+        return ExpiryColumns()
 
-    async def fake_mark_notification(user_id, notification_type):
-        marked.append((user_id, notification_type))
+    async def fake_mark_notifications(user_ids, notification_type):
+        marked.extend((user_id, notification_type) for user_id in user_ids)
 
     async def fake_create_payment(user_id, username=None):
         return "https://checkout.stripe.com/pay/test"
 
-    monkeypatch.setattr(subscription_tasks, "get_expiring_subscriptions", fake_get_expiring_subscriptions)
-    monkeypatch.setattr(subscription_tasks, "mark_notification", fake_mark_notification)
+    monkeypatch.setattr(subscription_tasks, "get_expiring_columns", fake_get_expiring_columns)
+    monkeypatch.setattr(subscription_tasks, "mark_notifications", fake_mark_notifications)
     monkeypatch.setattr(subscription_tasks.PaymentFactory, "create_payment", fake_create_payment)
 
     await subscription_tasks._send_expiry_warnings(bot)
@@ -62,22 +68,26 @@ async def test_revoke_expired_bans_unbans_expires_and_notifies(monkeypatch):
     bot = FakeBot()
     expired_called = []
 
-    async def fake_get_expired_active_subscriptions():
-        return [{"user_id": 22, "expires_at": datetime.now() - timedelta(days=1)}]
+    async def fake_get_expired_active_columns(after_user_id=0, limit=None):
+        if after_user_id:
+            return ExpiryColumns()
+        return ExpiryColumns([(22, int((datetime.now() - timedelta(days=1)).timestamp()))])
 
-    async def fake_expire_subscription(user_id):
-        expired_called.append(user_id)
+    async def fake_expire_subscriptions(user_ids):
+        expired_called.extend(user_ids)
+        return list(user_ids)
 
     async def fake_create_payment(user_id, username=None):
         return "https://checkout.stripe.com/pay/test"
 
-    monkeypatch.setattr(subscription_tasks, "get_expired_active_subscriptions", fake_get_expired_active_subscriptions)
-    monkeypatch.setattr(subscription_tasks, "expire_subscription", fake_expire_subscription)
+    monkeypatch.setattr(subscription_tasks, "get_expired_active_columns", fake_get_expired_active_columns)
+    monkeypatch.setattr(subscription_tasks, "expire_subscriptions", fake_expire_subscriptions)
     monkeypatch.setattr(subscription_tasks, "CHANNEL_ID", "123456")
     monkeypatch.setattr(subscription_tasks.PaymentFactory, "create_payment", fake_create_payment)
 
-    await subscription_tasks._revoke_expired(bot)
+    report = await subscription_tasks._revoke_expired(bot)
 
+    assert report == {"expired": 1, "kicked": 1, "kick_failed": 0, "offers_sent": 1}
     assert bot.bans == [(123456, 22)]
     assert bot.unbans == [(123456, 22)]
     assert expired_called == [22]
@@ -86,6 +96,37 @@ async def test_revoke_expired_bans_unbans_expires_and_notifies(monkeypatch):
     assert "истёк" in bot.messages[0][1]
 
 
+async def test_revoke_expired_skips_subscription_renewed_after_fetch(isolated_db, monkeypatch):
+    await database.init_db()
+    for user_id in (31, 32):
+        await database.save_user(user_id, f"user{user_id}", "Name")
+        await database.create_subscription(user_id, "stripe", "link", days=-1)
+    bot = FakeBot()
+    fetch_expired = subscription_tasks.get_expired_active_columns
+
+    async def fetch_then_renew(after_user_id=0, limit=None):
+        page = await fetch_expired(after_user_id=after_user_id, limit=limit)
+        if page:
+            # Webhook продления пришел между выборкой и UPDATE
+            await database.update_subscription_period(32, datetime.now() + timedelta(days=30))
+        return page
+
+    async def fake_create_payment(user_id, username=None):
+        return "https://checkout.stripe.com/pay/test"
+
+    monkeypatch.setattr(subscription_tasks, "get_expired_active_columns", fetch_then_renew)
+    monkeypatch.setattr(subscription_tasks, "CHANNEL_ID", "123456")
+    monkeypatch.setattr(subscription_tasks.PaymentFactory, "create_payment", fake_create_payment)
+
+    report = await subscription_tasks._revoke_expired(bot)
+
+    assert report == {"expired": 1, "kicked": 1, "kick_failed": 0, "offers_sent": 1}
+    assert bot.bans == [(123456, 31)]
+    assert [user_id for user_id, _ in bot.messages] == [31]
+    assert (await database.get_subscription(31)).status == "expired"
+    assert (await database.get_subscription(32)).status == "active"
+
+
 def test_seconds_until_next_check_before_hour(monkeypatch):
     monkeypatch.setattr(subscription_tasks, "SUBSCRIPTION_CHECK_HOUR", 12)
     now = datetime(2026, 1, 1, 10, 30, 0, tzinfo=timezone.utc)
@@ -96,3 +137,42 @@ def test_seconds_until_next_check_after_hour(monkeypatch):
     monkeypatch.setattr(subscription_tasks, "SUBSCRIPTION_CHECK_HOUR", 12)
     now = datetime(2026, 1, 1, 12, 30, 0, tzinfo=timezone.utc)
     assert subscription_tasks._seconds_until_next_check(now) == 84600
+
+
+@pytest.mark.asyncio
+async def test_expiry_scheduler_loads_window_and_wakes_at_deadline(monkeypatch):
+    passes = []
+
+    async def fake_send_expiry_warnings(bot, limiter=None):
+        passes.append("warn")
+
+    async def fake_revoke_expired(bot, limiter=None):
+        passes.append("revoke")
+
+    monkeypatch.setattr(subscription_tasks, "_send_expiry_warnings", fake_send_expiry_warnings)
+    monkeypatch.setattr(subscription_tasks, "_revoke_expired", fake_revoke_expired)
+
+    await database.init_db()
+    # Предупреждение за 1 день попадает в окно планировщика, остальные сроки - нет
+    await database.create_subscription(
+        user_id=31, payment_provider="stripe", invite_link="l", days=1 + 1 / 24
+    )
+    await database.create_subscription(user_id=32, payment_provider="stripe", invite_link="l", days=20)
+
+    scheduler = subscription_tasks.ExpiryScheduler(FakeBot())
+    task = asyncio.create_task(scheduler.run())
+    await asyncio.sleep(0.2)
+    assert passes == ["warn", "revoke"]
+    assert [user_id for _, user_id in scheduler._heap] == [31]
+
+    # Новая подписка со сроком через 0.3 с будит планировщик без ожидания окна
+    await database.create_subscription(
+        user_id=33, payment_provider="stripe", invite_link="l", days=0.3 / 86400
+    )
+    await asyncio.sleep(0.6)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+    assert passes == ["warn", "revoke", "warn", "revoke"]
+    assert [user_id for _, user_id in scheduler._heap] == [31]
@@ -0,0 +1,104 @@
+"""
+Ограничение скорости отправки сообщений с учетом лимитов Telegram
+"""
+
+import asyncio
+import logging
+import time
+from typing import Dict, Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter
+
+from config import TELEGRAM_GLOBAL_RATE, TELEGRAM_PER_CHAT_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+MAX_SEND_ATTEMPTS = 3
+
+
+class TokenBucket:
+    """Классический token bucket: rate токенов в секунду, не больше capacity."""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None) -> None:
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            self._refill()
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= 1
+
+
+class TelegramRateLimiter:
+    """
+    Общий лимит бота (сообщений в секунду) плюс минимальный интервал
+    между сообщениями в один чат. RetryAfter от Telegram ставит на паузу
+    все отправки до указанного момента.
+    """
+
+    def __init__(
+        self,
+        global_rate: float = TELEGRAM_GLOBAL_RATE,
+        per_chat_interval: float = TELEGRAM_PER_CHAT_INTERVAL,
+    ) -> None:
+        self._bucket = TokenBucket(global_rate)
+        self.per_chat_interval = per_chat_interval
+        self._last_sent: Dict[int, float] = {}
+        self._paused_until = 0.0
+        self.retry_after_count = 0
+
+    def pause(self, seconds: float) -> None:
+        self.retry_after_count += 1
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self, chat_id: int) -> None:
+        while True:
+            delay = self._paused_until - time.monotonic()
+            last = self._last_sent.get(chat_id)
+            if last is not None:
+                delay = max(delay, last + self.per_chat_interval - time.monotonic())
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+
+        await self._bucket.acquire()
+        now = time.monotonic()
+        self._last_sent[chat_id] = now
+        if len(self._last_sent) > 10000:
+            horizon = now - self.per_chat_interval
+            self._last_sent = {k: v for k, v in self._last_sent.items() if v > horizon}
+
+
+async def call_limited(limiter: TelegramRateLimiter, key: int, func, *args, **kwargs):
+    """
+    Вызывает метод Bot API через лимитер. На RetryAfter ждет и повторяет,
+    остальные ошибки пробрасывает вызывающему коду.
+    """
+    for attempt in range(1, MAX_SEND_ATTEMPTS + 1):
+        await limiter.acquire(key)
+        try:
+            return await func(*args, **kwargs)
+        except TelegramRetryAfter as e:
+            logger.warning(f"Telegram RetryAfter {e.retry_after}s (key {key}, attempt {attempt})")
+            limiter.pause(e.retry_after)
+            if attempt == MAX_SEND_ATTEMPTS:
+                raise
+
+
+async def send_message_limited(
+    bot: Bot, limiter: TelegramRateLimiter, chat_id: int, text: str, **kwargs
+):
+    """Отправляет сообщение через лимитер (с учетом интервала для чата)."""
+    return await call_limited(limiter, chat_id, bot.send_message, chat_id, text, **kwargs)